@@ -0,0 +1,301 @@
+__author__ = 'cguo'
+
+from fakeFargoRun import writeFakeRun
+from fargoParser import FargoParser
+from gridGeometry import GridGeometry
+from densityMovie import DensityFrameRenderer
+from perfMonitor import monitor
+from optparse import OptionParser
+import fargoDiagnostics as fd
+import tqAnalysis
+import kernels
+import numpy as np
+import contextlib
+import platform
+import subprocess
+import json
+import time
+import sys
+import os
+
+"""
+benchmarks the parser, the batch diagnostics, the tqAnalysis computations and density frame
+rendering on synthetic runs written by fakeFargoRun, one run per grid size under a scratch
+directory (reused while its parameters are unchanged).
+
+every case is timed `repeats` times and the best wall time is kept. the results are appended
+as JSON lines to a results file, each tagged with the commit being measured (and whether the
+tree had uncommitted changes), the host, the python and numpy versions and the kernel backend
+(see kernels.py), so that
+    python benchmarkRunner.py --compare <commitA> <commitB>
+can show the speed-up of every case between two commits measured on the same host.
+
+the runs are read from the page cache after the first repeat, so the parser cases measure
+parsing and copying rather than the disk
+"""
+
+SUITES = ['parser', 'diagnostics', 'tq', 'movie']
+
+# fields identifying a case; records agreeing on all of them are comparable
+CASE_KEYS = ['suite', 'case', 'nr', 'ns', 'batchSize', 'host']
+
+
+def _commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--'], cwd=here) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, dirty
+
+
+@contextlib.contextmanager
+def _quiet():
+    # computeDiagnostics and runComputations report their progress on stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def _workingDirectory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _best(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def _parseAll(runDir, batchSize, **parserOptions):
+    parser = FargoParser(runDir, batchSize, **parserOptions)
+    try:
+        while parser.hasRemainingBatches():
+            parser.getNextBatch()
+    finally:
+        parser.stopPrefetch()
+
+
+def benchParser(runDir, params, batchSize, repeats):
+    cases = [('serial', {}), ('readThreads4', {'readThreads': 4}), ('prefetch2', {'prefetchDepth': 2})]
+
+    for case, options in cases:
+        yield case, _best(lambda: _parseAll(runDir, batchSize, **options), repeats), params['nt']
+
+
+def benchDiagnostics(runDir, params, batchSize, repeats):
+    parser = FargoParser(runDir, batchSize)
+    geometry = GridGeometry.fromParams(parser.getParams())
+    dens, vr, vtheta = parser.getNextBatch()
+    mkEngine = fd.MuellerKleyEngine(geometry)
+
+    for case, precision in (('double', None), ('single', 'single')):
+        def run():
+            with _quiet():
+                fd.computeDiagnostics(geometry, dens, vr, vtheta, mkEngine, precision)
+        yield case, _best(run, repeats), len(dens)
+
+
+def benchTq(runDir, params, batchSize, repeats):
+    with _workingDirectory(runDir):
+        geometry = GridGeometry.fromFile('used_rad.dat', params['ns'])
+        secr, sectheta = tqAnalysis.getTrajectory()
+        grid = {
+            'nr': params['nr'], 'ns': params['ns'], 'secr': secr, 'sectheta': sectheta,
+            'r_inf': geometry.rInfCol, 'r_sup': geometry.rSupCol, 'r_med': geometry.rCol,
+            'theta': geometry.thetaRow, 'dr': geometry.dr, 'geometry': geometry
+        }
+
+        for name in sorted(tqAnalysis.COMPUTATIONS):
+            def run():
+                with _quiet():
+                    tqAnalysis.runComputations([name], params['binaryMass'], grid, outputDir='benchmarkTq',
+                                               blockSize=batchSize)
+            yield name, _best(run, repeats), params['nt']
+
+
+def benchMovie(runDir, params, batchSize, repeats):
+    parser = FargoParser(runDir, batchSize)
+    geometry = GridGeometry.fromParams(parser.getParams())
+    dens, _, _ = parser.getNextBatch()
+    logDens = np.log10(dens)
+
+    for mode in ('contour', 'image'):
+        renderer = DensityFrameRenderer(geometry.radialIntervals, geometry.thetaIntervals, runDir, mode=mode,
+                                        radialEdges=geometry.radialEdges)
+
+        def render():
+            for i, frame in enumerate(logDens):
+                renderer.frameRGBA(i, frame, 0., 1.)
+        yield mode, _best(render, repeats), len(logDens)
+
+
+BENCHMARKS = {
+    'parser': benchParser,
+    'diagnostics': benchDiagnostics,
+    'tq': benchTq,
+    'movie': benchMovie
+}
+
+
+def runBenchmarks(scratchDir, grids, batchSizes, suites, nt=50, repeats=3):
+    """
+    run `suites` for every (nr, ns) in grids and every batch size, returning a list of records
+    """
+    commit, dirty = _commit()
+    common = {
+        'commit': commit, 'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__,
+        'kernels': kernels.backend()
+    }
+
+    records = []
+    for nr, ns in grids:
+        runDir = scratchDir + '/run' + str(nr) + 'x' + str(ns)
+        params = writeFakeRun(runDir, nr=nr, ns=ns, nt=nt)
+
+        for suite in suites:
+            for batchSize in batchSizes:
+                monitor.reset()
+                for case, wallTime, numSnapshots in BENCHMARKS[suite](runDir, params, batchSize, repeats):
+                    record = dict(common)
+                    record.update({'suite': suite, 'case': case, 'nr': nr, 'ns': ns, 'nt': nt,
+                                   'batchSize': batchSize, 'wallTime': wallTime,
+                                   'snapshotsPerSecond': numSnapshots / wallTime})
+                    records.append(record)
+                    print "%-12s %-14s %5d x %-5d batch %4d %9.3f s %10.1f snapshots/s" % \
+                          (suite, case, nr, ns, batchSize, wallTime, record['snapshotsPerSecond'])
+
+    return records
+
+
+def appendResults(path, records):
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def loadResults(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compareCommits(records, baseline, candidate, out=sys.stdout):
+    """
+    print the best wall time of every case measured at both commits (given as hash prefixes)
+    and the speed-up of candidate over baseline
+    """
+    def bestTimes(prefix):
+        best = {}
+        for record in records:
+            if record['commit'] and record['commit'].startswith(prefix):
+                key = tuple(record[k] for k in CASE_KEYS)
+                best[key] = min(best.get(key, float('inf')), record['wallTime'])
+        return best
+
+    before = bestTimes(baseline)
+    after = bestTimes(candidate)
+    if not before or not after:
+        raise ValueError('no results for ' + (baseline if not before else candidate))
+
+    out.write("%-12s %-14s %11s %6s %10s %10s %8s\n" % ('suite', 'case', 'grid', 'batch', 'before s', 'after s',
+                                                        'speedup'))
+    for key in sorted(set(before) & set(after)):
+        suite, case, nr, ns, batchSize, host = key
+        out.write("%-12s %-14s %11s %6d %10.3f %10.3f %7.2fx\n" %
+                  (suite, case, str(nr) + 'x' + str(ns), batchSize, before[key], after[key],
+                   before[key] / after[key]))
+
+
+def _parseGrids(spec):
+    grids = []
+    for grid in spec.split(','):
+        nr, ns = grid.lower().split('x')
+        grids.append((int(nr), int(ns)))
+    return grids
+
+
+def main():
+    optParser = OptionParser(usage='%prog [-d SCRATCHDIR] [-g GRIDS] [-b BATCHSIZES] [-s SUITES] '
+                                   '| --compare COMMITA COMMITB')
+    optParser.add_option('-d', '--scratchdirectory', action='store',
+                         type='string', dest='scratchDirectory', default='benchmarkRuns',
+                         help='where the synthetic runs are written (default %default)')
+
+    optParser.add_option('-g', '--grids', action='store',
+                         type='string', dest='grids', default='128x256,438x574',
+                         help='comma-separated nr x ns grid sizes (default %default)')
+
+    optParser.add_option('-b', '--batchsizes', action='store',
+                         type='string', dest='batchSizes', default='10,50',
+                         help='comma-separated batch sizes (default %default)')
+
+    optParser.add_option('-t', '--outputs', action='store',
+                         type='int', dest='nt', default=50,
+                         help='number of outputs in each synthetic run (default %default)')
+
+    optParser.add_option('-s', '--suites', action='store',
+                         type='string', dest='suites', default=','.join(SUITES),
+                         help='comma-separated list from ' + ', '.join(SUITES))
+
+    optParser.add_option('-r', '--repeats', action='store',
+                         type='int', dest='repeats', default=3,
+                         help='timings per case; the best is kept (default %default)')
+
+    optParser.add_option('-o', '--results', action='store',
+                         type='string', dest='results', default='benchmarkResults.jsonl',
+                         help='JSON-lines file the results are appended to (default %default)')
+
+    optParser.add_option('--kernels', action='store',
+                         type='choice', choices=['auto'] + kernels.BACKENDS, dest='kernels',
+                         help='kernel backend to measure (see kernels.py); default: $FARGO_KERNELS, else auto')
+
+    optParser.add_option('--compare', action='store', nargs=2,
+                         type='string', dest='compare',
+                         help='compare the results stored for two commits instead of running')
+
+    (options, args) = optParser.parse_args()
+
+    if options.compare:
+        try:
+            compareCommits(loadResults(options.results), *options.compare)
+        except (IOError, ValueError) as e:
+            optParser.error(str(e))
+        return
+
+    suites = [suite.strip() for suite in options.suites.split(',')]
+    for suite in suites:
+        if suite not in BENCHMARKS:
+            optParser.error('unknown suite ' + suite + '; choose from ' + ', '.join(SUITES))
+
+    try:
+        grids = _parseGrids(options.grids)
+        batchSizes = [int(b) for b in options.batchSizes.split(',')]
+    except ValueError:
+        optParser.error('grids are given as NRxNS and batch sizes as integers')
+
+    try:
+        kernels.setBackend(options.kernels or kernels.backend())
+    except ValueError as e:
+        optParser.error(str(e))
+
+    records = runBenchmarks(options.scratchDirectory, grids, batchSizes, suites, options.nt, options.repeats)
+    appendResults(options.results, records)
+    print "appended " + str(len(records)) + " results to " + options.results
+
+if __name__ == '__main__':
+    main()
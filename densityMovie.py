@@ -1,6 +1,12 @@
 __author__ = 'cguo'
 
 from fargoParser import FargoParser
+from renderPool import RenderPool
+from frameSinks import canvasToRGBA, openFrameSink
+from polarResampler import PolarResampler
+from snapshotPyramid import SnapshotPyramid
+from planetTables import loadTable
+from perfMonitor import monitor, timed, printReport
 from optparse import OptionParser
 import numpy as np
 import matplotlib
@@ -8,14 +14,141 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 
+class DensityFrameRenderer:
+    """
+    draws log-density frames with the secondary's position marked. frame() saves each as
+    <outputDir>/figs/dens<index>.png; frameRGBA() returns its pixels instead, for streaming
+    into a frame sink.
+
+    mode 'contour' draws a polar contourf of the full field for every frame. mode 'image'
+    resamples the field onto a Cartesian image through a PolarResampler built once for the
+    grid (interpolation 'nearest' or 'bilinear'), and updates a single persistent imshow with
+    set_data. with fixedScale, the colour scale of the first frame is kept for every frame, or
+    clim (low, high) when given -- each render worker has its own renderer, so its first frame
+    is not the movie's; imageRange(logDens) gives the scale to pass
+
+    DensityFrameRenderer.frameDiameter(mode, imageSize): number of pixels a frame spans across
+        the 2 rmax of the disk shown
+    """
+
+    def __init__(self, radialIntervals, thetaIntervals, outputDir, rmax=1.5, mode='contour',
+                 imageSize=512, interpolation='nearest', fixedScale=False, radialEdges=None, clim=None):
+        self.r, self.theta = np.meshgrid(radialIntervals, thetaIntervals)
+        self.outputDir = outputDir
+        self.rmax = rmax
+        self.mode = mode
+
+        if mode == 'image':
+            self.resampler = PolarResampler(radialIntervals, thetaIntervals, rmax, imageSize, interpolation,
+                                            radialEdges)
+            self.fixedScale = fixedScale
+            self.clim = clim
+            self.fig = None
+
+        plt.ioff()
+
+    @staticmethod
+    def frameDiameter(mode='contour', imageSize=512):
+        if mode == 'image':
+            return imageSize
+
+        fig = plt.figure()
+        bbox = plt.subplot(111, polar=True).get_window_extent()
+        plt.close(fig)
+        return min(bbox.width, bbox.height)
+
+    def imageRange(self, logDens):
+        image = self.resampler.resample(logDens)
+        return np.nanmin(image), np.nanmax(image)
+
+    def _drawContour(self, logDens, secondaryTheta, secondaryRadius):
+        fig = plt.figure()
+        ax = plt.subplot(111, polar=True)
+        ax.contourf(self.theta, self.r, logDens.transpose(), cmap=plt.cm.afmhot)
+        ax.scatter([secondaryTheta], [secondaryRadius], s=150)
+        ax.set_rmax(self.rmax)
+        #ax.set_title(r"$\theta_{sec}=" + "{0:.2f}$ rad".format(secondaryTheta % 6.283), va='bottom')
+        return fig
+
+    def _drawImage(self, logDens, secondaryTheta, secondaryRadius):
+        image = self.resampler.resample(logDens)
+
+        if self.fig is None:
+            self.fig = plt.figure()
+            ax = self.fig.add_subplot(111, aspect='equal')
+            self.image = ax.imshow(image, origin='lower', extent=self.resampler.extent,
+                                   cmap=plt.cm.afmhot, interpolation='nearest')
+            self.secondary, = ax.plot([], [], 'o', markersize=12)
+        else:
+            self.image.set_data(image)
+
+        if self.clim is None or not self.fixedScale:
+            self.clim = (np.nanmin(image), np.nanmax(image))
+        self.image.set_clim(*self.clim)
+
+        self.secondary.set_data([secondaryRadius * np.cos(secondaryTheta)],
+                                [secondaryRadius * np.sin(secondaryTheta)])
+        return self.fig
+
+    def _draw(self, logDens, secondaryTheta, secondaryRadius):
+        """
+        logDens has shape (nr, ns)
+        """
+        if self.mode == 'image':
+            return self._drawImage(logDens, secondaryTheta, secondaryRadius)
+        return self._drawContour(logDens, secondaryTheta, secondaryRadius)
+
+    def _release(self, fig):
+        # image mode reuses one figure for every frame
+        if self.mode != 'image':
+            plt.close(fig)
+
+    @timed('frame')
+    def frame(self, index, logDens, secondaryTheta, secondaryRadius):
+        fig = self._draw(logDens, secondaryTheta, secondaryRadius)
+        fig.savefig(self.outputDir + "/figs/dens" + str(index) + ".png")
+        self._release(fig)
+
+    @timed('frame')
+    def frameRGBA(self, index, logDens, secondaryTheta, secondaryRadius):
+        fig = self._draw(logDens, secondaryTheta, secondaryRadius)
+        rgba = canvasToRGBA(fig)
+        self._release(fig)
+        return rgba
+
+
 class FargoMovieMaker:
+    """
+    renders log-density frames for a range of outputs. with encoder 'png' every frame is
+    saved to figs/ and finish() tars them up; with 'ffmpeg', 'apng' or 'auto' the frames are
+    streamed straight from the canvas into <outputDir>/animation.mp4 (or .png, animated).
+    frameOptions are passed on to DensityFrameRenderer (e.g. mode='image').
+
+    frames are drawn from level `level` of the run's SnapshotPyramid; by default, from the
+    coarsest level built whose cells are no larger than a pixel of the frame
+    """
 
-    def __init__(self, inputDir, outputDir, batchSize):
+    def __init__(self, inputDir, outputDir, batchSize, renderWorkers=0, encoder='png', fps=24, frameOptions=None,
+                 level=None):
         self.outputDir = outputDir
         self.batchSize = batchSize
-        self.parser = FargoParser(inputDir, batchSize)
+        self.renderWorkers = renderWorkers
+        self.encoder = encoder
+        self.fps = fps
+        self.sink = None
+        self.frameOptions = frameOptions or {}
+
+        if level is None:
+            options = self.frameOptions
+            rmax = options.get('rmax', 1.5)
+            diameter = DensityFrameRenderer.frameDiameter(options.get('mode', 'contour'),
+                                                          options.get('imageSize', 512))
+            level = SnapshotPyramid.coarsestLevel(inputDir, 2. * rmax / diameter, rmax)
+        print "drawing frames from pyramid level " + str(level)
 
-        secondaryOrbit = np.loadtxt(inputDir + "/planet0.dat")
+        self.parser = FargoParser(inputDir, batchSize, level=level)
+
+        secondaryOrbit = loadTable(inputDir + "/planet0.dat")
         secondaryX = secondaryOrbit[:, 1]
         secondaryY = secondaryOrbit[:, 2]
 
@@ -26,36 +159,61 @@ class FargoMovieMaker:
         self.params = params
         self.outputDir = outputDir
 
-    def go(self, start, end):
+    def _nextDensities(self):
+        if not self.parser.hasRemainingBatches():
+            return None
+        dens, _, _ = self.parser.getNextBatch()
+        return dens
+
+    def go(self, start, end, stride=1):
+        """
+        render outputs start, start + stride, ... up to and including end; the parser seeks
+        straight to them, so skipped outputs are never read
+        """
+        self.parser.select(start, end + 1, stride)
+        outputIndices = self.parser.getSelectedIndices()
+        position = 0
 
-        start = (start / self.batchSize) * self.batchSize
-        end = (end / self.batchSize + 1) * self.batchSize
-        cur = 0
+        options = self.frameOptions
+        rendererArgs = (self.params['radialIntervals'], self.params['thetaIntervals'], self.outputDir,
+                        options.get('rmax', 1.5), options.get('mode', 'contour'), options.get('imageSize', 512),
+                        options.get('interpolation', 'nearest'), options.get('fixedScale', False),
+                        self.params['radialEdges'])
 
-        # skip to the start
-        for _ in range(start / self.batchSize):
-            cur += self.batchSize
-            self.parser.getNextBatch()
+        dens = self._nextDensities()
+        if options.get('fixedScale', False) and options.get('mode', 'contour') == 'image' \
+                and dens is not None and len(dens):
+            # settle the scale of the first frame here, once, rather than in every worker
+            clim = DensityFrameRenderer(*rendererArgs).imageRange(np.log(dens[0]))
+            rendererArgs += (clim,)
 
-        for _ in range((end - start) / self.batchSize):
-            dens, _, _ = self.parser.getNextBatch()
+        if self.encoder == 'png':
+            method = 'frame'
+            pool = RenderPool(self.renderWorkers, DensityFrameRenderer, rendererArgs)
+        else:
+            method = 'frameRGBA'
+            if self.sink is None:
+                self.sink = openFrameSink(self.outputDir + '/animation', self.fps, self.encoder)
+            pool = RenderPool(self.renderWorkers, DensityFrameRenderer, rendererArgs, onResult=self.sink.write)
 
-            r, theta = np.meshgrid(self.params['radialIntervals'], self.params['thetaIntervals'])
-            plt.ioff()
-            #-- Plot... ------------------------------------------------
+        while dens is not None:
             for i in range(len(dens)):
-                fig = plt.figure()
-                ax = plt.subplot(111, polar=True)
-                ax.contourf(theta, r, np.log(dens[i]).transpose(), cmap=plt.cm.afmhot)
-                ax.scatter([self.secondaryTheta[cur]], [self.secondaryRadius[cur]], s=150)
-                ax.set_rmax(1.5)
-                #ax.set_title(r"$\theta_{sec}=" + "{0:.2f}$ rad".format(self.secondaryTheta[cur] % 6.283), va='bottom')
-                plt.savefig(self.outputDir + "/figs/dens" + str(cur) + ".png")
-                plt.close(fig)
+                cur = outputIndices[position]
+                pool.submit(method, cur, np.log(dens[i]),
+                            self.secondaryTheta[cur], self.secondaryRadius[cur])
 
-                cur += 1
+                position += 1
+
+            dens = self._nextDensities()
+
+        pool.close()
 
     def finish(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+            return
+
         os.system("tar -zcvf " + self.outputDir + "/animation.tar.gz " + self.outputDir + "/figs")
 
 
@@ -73,17 +231,62 @@ def main():
     optParser.add_option('-e', '--end', action='store',
                          type='int', dest='endIndex', default=100)
     
+    optParser.add_option('--stride', action='store',
+                         type='int', dest='stride', default=1,
+                         help='render every stride-th output between start and end')
+
     optParser.add_option('-o', '--outputdirectory', action='store',
                          type='string', dest='outputDirectory')
 
+    optParser.add_option('-r', '--renderworkers', action='store',
+                         type='int', dest='renderWorkers', default=0,
+                         help='number of processes drawing frames concurrently (0 draws inline)')
+
+    optParser.add_option('-f', '--format', action='store',
+                         type='choice', choices=['png', 'auto', 'ffmpeg', 'apng'], dest='encoder', default='png',
+                         help='png: one file per frame plus a tarball; auto, ffmpeg, apng: stream frames into '
+                              'one video (auto uses ffmpeg when installed, else an animated PNG)')
+
+    optParser.add_option('--fps', action='store',
+                         type='int', dest='fps', default=24)
+
+    optParser.add_option('--image', action='store_true', dest='imageMode',
+                         help='draw frames by resampling onto a precomputed Cartesian pixel map instead of contouring')
+
+    optParser.add_option('--interpolation', action='store',
+                         type='choice', choices=['nearest', 'bilinear'], dest='interpolation', default='nearest',
+                         help='pixel map interpolation in --image mode')
+
+    optParser.add_option('--imagesize', action='store',
+                         type='int', dest='imageSize', default=512,
+                         help='pixel map resolution in --image mode')
+
+    optParser.add_option('--fixedscale', action='store_true', dest='fixedScale',
+                         help='in --image mode, keep the colour scale of the first frame')
+
+    optParser.add_option('-l', '--level', action='store',
+                         type='int', dest='level',
+                         help='pyramid level to draw frames from (see snapshotPyramid.py); by default the '
+                              'coarsest one built that still resolves every pixel')
+
     (options, args) = optParser.parse_args()
 
     if not options.inputDirectory:
         optParser.error('you must specify an input directory with -i or --inputdirectory')
 
-    movies = FargoMovieMaker(options.inputDirectory, options.outputDirectory, options.batchSize)
-    movies.go(options.startIndex, options.endIndex)
+    frameOptions = {
+        'mode': 'image' if options.imageMode else 'contour',
+        'imageSize': options.imageSize,
+        'interpolation': options.interpolation,
+        'fixedScale': options.fixedScale
+    }
+
+    movies = FargoMovieMaker(options.inputDirectory, options.outputDirectory, options.batchSize,
+                             options.renderWorkers, options.encoder, options.fps, frameOptions, options.level)
+    movies.go(options.startIndex, options.endIndex, options.stride)
     movies.finish()
 
+    printReport(monitor.writeReport(options.outputDirectory + '/perfReport.json'))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -2,31 +2,281 @@ __author__ = 'cguo'
 
 from fargoParser import FargoParser
 from fargoPlotter import FargoPlotter
+from gridGeometry import GridGeometry
+from timeSeriesStore import TimeSeriesStore
+from renderPool import RenderPool
+from snapshotPyramid import SnapshotPyramid
+from runningStats import RunStatistics, RunningMoments, RunningExtrema, FixedHistogram
+from perfMonitor import monitor, printReport
 from optparse import OptionParser
 import fargoDiagnostics as fd
+import kernels
 import numpy as np
 import glob
+import json
+import os
+import multiprocessing
+import matplotlib
+import logging
 
 
-class FargoDiagnosticsRunner:
+# per-process runner used by the --workers pool; built once by _initWorker in each worker
+_workerRunner = None
+
+
+def _initWorker(inputDir, outputDir, plotDir, batchSize, selection, readThreads=0, precision='double', level=0,
+                diagnostics=None):
+    global _workerRunner
+    start, stop, stride = selection
+    _workerRunner = FargoDiagnosticsRunner(inputDir, outputDir, plotDir, batchSize,
+                                           start=start, stop=stop, stride=stride, readThreads=readThreads,
+                                           precision=precision, level=level, diagnostics=diagnostics)
+
+
+def _runBatchRange(batchRange):
+    startIndex, endIndex = batchRange
+
+    monitor.reset()
+    outputs = _workerRunner.runBatchRange(startIndex, endIndex)
+    return batchRange, outputs, monitor.stats()
+
 
-    def __init__(self, inputDir, outputDir, plotDir, batchSize):
+class FargoDiagnosticsRunner:
+    """
+    runs the per-batch diagnostics over a Fargo2D output directory and the disk-vs-time
+    reductions over their results. per-output diagnostics are written to a TimeSeriesStore
+    (timeSeries/ in the output directory), one dataset per diagnostic, indexed by output number.
+
+    runBatches records every completed batch range in a manifest (batchManifest.json in
+    the output directory) together with its output files and the sizes and mtimes of its
+    input files. a restarted run skips ranges whose outputs exist and whose inputs are
+    unchanged, and recomputes only missing or stale ones. a dataset's rows are only committed as
+    valid up to the first batch range that has not completed, so a failed or unfinished batch never
+    leaves unwritten rows inside the time series.
+
+    with level > 0 the whole analysis runs on that level of the run's SnapshotPyramid, as a quick
+    look; level='auto' picks the coarsest level built whose radial profiles still have a cell
+    per pixel of the radial plots. the default, level 0, keeps the stored diagnostics at full resolution.
+    coarse levels only serve the diagnostics of density alone (DIAGNOSTIC_GROUPS['density']): averaging
+    the velocities over merged cells biases every eccentricity and periastron. on a synthetic 40 x 64 run
+    the Mueller-Kley precession falls from 0.063 per output to 0.048, 0.039 and 0.022 at levels 1 to 3,
+    while diskEccMK rises from 0.046 to 0.048, 0.062 and 0.124 (see resolveLevel)
+
+    diagnostics, a list of store datasets (see batchOutputs), restricts the analysis to those: only
+    they are computed and stored, through fargoDiagnostics' dependency graph, and the parser only reads
+    the gas variables they depend on -- e.g. totalMass, radialDens and the disk radii need density alone.
+    a batch recorded as complete with a superset of the datasets is not recomputed
+
+    every batch also accumulates whole-run statistics (see runningStats and _newStatistics) and
+    checkpoints them as one of its outputs, runStatistics/<start>-<end>.npz; runDiskTime merges
+    the batches' partial statistics into runStatistics.npz in the output directory
+
+    methods:
+    FargoDiagnosticsRunner(inputDir, outputDir, plotDir, batchSize, prefetchDepth=0, maxPrefetchBytes=None,
+                           renderWorkers=0, start=0, stop=None, stride=1, readThreads=0, precision='double',
+                           level=0, geometry=None, mkEngine=None, diagnostics=None)
+        geometry and mkEngine may be shared with runners of other runs on the same grid (see sweepRunner)
+
+    runBatches(workers=1, resume=True)
+
+    prepareBatches(resume=True), runBatchRange(startIndex, endIndex), completeBatch(manifest, startIndex,
+        endIndex, outputs, stats): the steps of runBatches, for schedulers that run the ranges elsewhere
+
+    mergeStatistics(): merges the partial statistics of every completed batch, and saves them
+
+    runDiskTime()
+    """
+
+    manifestName = 'batchManifest.json'
+    storeName = 'timeSeries'
+    statisticsName = 'runStatistics'
+
+    # (store dataset, computeDiagnostics key, True if the dataset has one value per radius)
+    batchOutputs = [
+        ('radialEccMK', 'radialEccMK', True),
+        ('radialEccLubow', 'radialEccLubow', True),
+
+        ('radialPeriMK', 'radialPeriMK', True),
+        ('radialPeriLubow', 'radialPeriLubow', True),
+
+        ('radialDens', 'radialDens', True),
+        ('diskEccMK', 'diskEccMK', False),
+        ('diskPeriMK', 'diskPeriMK', False),
+
+        ('diskEccLubow', 'diskEccLubow', False),
+        ('diskPeriLubow', 'diskPeriLubow', False),
+
+        ('totalMass', 'totalMass', False),
+
+        ('diskRadius90', 'diskRad90', False),
+        ('diskRadius95', 'diskRad95', False),
+
+        ('lubowVsin', 'lubowVsin', False),
+        ('lubowVcos', 'lubowVcos', False)
+    ]
+
+    def __init__(self, inputDir, outputDir, plotDir, batchSize, prefetchDepth=0, maxPrefetchBytes=None,
+                 renderWorkers=0, start=0, stop=None, stride=1, readThreads=0, precision='double', level=0,
+                 geometry=None, mkEngine=None, diagnostics=None):
+        self.inputDir = inputDir
         self.outputDir = outputDir
+        self.plotDir = plotDir
+        self.batchSize = batchSize
+        self.readThreads = readThreads
+        self.precision = precision
+
+        resolved = self.resolveLevel(inputDir, level, diagnostics)
+        if level == 'auto':
+            print "analyzing pyramid level " + str(resolved)
+        self.level = resolved
+
+        self.diagnostics = diagnostics
+        self.outputs = self.selectOutputs(diagnostics)
 
-        self.parser = FargoParser(inputDir, batchSize)
+        self.selectionArgs = (start, stop, stride)
+        self.parser = FargoParser(inputDir, batchSize, prefetchDepth, maxPrefetchBytes, start, stop, stride,
+                                  readThreads, precision, self.level, self._gasVariables())
 
         params = self.parser.getParams()
         radIntervals = params['radialIntervals']
         numOutputs = params['totalNumOutputs']
-        timeIntervals = np.linspace(0, numOutputs/5.0, num=numOutputs)
+        timeIntervals = np.linspace(0, numOutputs/5.0, num=numOutputs)[self.parser.getSelectedIndices()]
 
         self.params = params
+        self.geometry = geometry if geometry is not None else GridGeometry.fromParams(params)
+        self.mkEngine = mkEngine if mkEngine is not None else fd.MuellerKleyEngine(self.geometry)
+        self.store = TimeSeriesStore(outputDir + '/' + self.storeName)
 
         self.outputDir = outputDir
 
-        self.plotter = FargoPlotter(radIntervals * 20.0, timeIntervals, plotDir, 'Radius, AU', 'Time, binary periods')
-
-    def _getDiagnostic(self, fmt):
+        self.plotterArgs = (radIntervals * 20.0, timeIntervals, plotDir, 'Radius, AU', 'Time, binary periods')
+        self.plotter = FargoPlotter(*self.plotterArgs)
+
+        # when set, per-batch plots are drawn by a pool of rendering processes
+        self.renderWorkers = renderWorkers
+        self.renderPool = None
+
+    @classmethod
+    def selectOutputs(cls, diagnostics=None):
+        """
+        the entries of batchOutputs for the datasets named in `diagnostics`, or all of them
+        """
+        if diagnostics is None:
+            return list(cls.batchOutputs)
+
+        known = [name for name, _, _ in cls.batchOutputs]
+        unknown = [name for name in diagnostics if name not in known]
+        if unknown:
+            raise ValueError('unknown diagnostics ' + ', '.join(unknown) + '; choose from ' + ', '.join(known))
+
+        return [entry for entry in cls.batchOutputs if entry[0] in diagnostics]
+
+    def _gasVariables(self):
+        """
+        the gas variables the selected diagnostics depend on; density is always read, for the
+        plots and run statistics
+        """
+        return self._neededGasVariables(self.outputs)
+
+    @staticmethod
+    def _neededGasVariables(outputs):
+        needed = fd.dependencies([key for _, key, _ in outputs])
+        return ['dens'] + [varType for varType, name in [('vrad', 'vr'), ('vtheta', 'vtheta')] if name in needed]
+
+    @classmethod
+    def resolveLevel(cls, inputDir, level, diagnostics=None):
+        """
+        the pyramid level to analyze `diagnostics` on, for a level number or 'auto'. coarse levels
+        are only used for diagnostics of density alone, so 'auto' means level 0 for any others, and
+        an explicit level > 0 raises ValueError
+        """
+        densityOnly = cls._neededGasVariables(cls.selectOutputs(diagnostics)) == ['dens']
+        if level == 'auto':
+            return cls._profileLevel(inputDir) if densityOnly else 0
+
+        if level > 0 and not densityOnly:
+            raise ValueError('pyramid level ' + str(level) + ' only serves the density diagnostics (' +
+                             ', '.join(DIAGNOSTIC_GROUPS['density']) + '): averaging the velocities over merged '
+                             'cells biases every eccentricity and periastron. select them with --diagnostics '
+                             'density, or analyze level 0')
+        return level
+
+    def _hasOutputs(self, *names):
+        return all(any(name == key for _, key, _ in self.outputs) for name in names)
+
+    @staticmethod
+    def _profileLevel(inputDir):
+        """
+        coarsest pyramid level with a cell per pixel across the radial profile plots
+        """
+        width, _ = FargoPlotter.threePanelSize
+        rc = matplotlib.rcParams
+        pixels = width * rc['figure.dpi'] * (rc['figure.subplot.right'] - rc['figure.subplot.left'])
+
+        radialEdges = np.loadtxt(inputDir + '/used_rad.dat')
+        return SnapshotPyramid.coarsestLevel(inputDir, (radialEdges[-1] - radialEdges[0]) / pixels,
+                                             radialOnly=True)
+
+    def _plot(self, methodName, *args):
+        if self.renderPool is not None:
+            self.renderPool.submit(methodName, *args)
+        else:
+            getattr(self.plotter, methodName)(*args)
+
+    def _prepareStore(self):
+        """
+        preallocate every dataset for the whole run, so that workers can fill their own rows
+        """
+        numOutputs = self.parser.numSelected
+        numRadialIntervals = self.params['numRadialIntervals']
+
+        for name, _, isRadial in self.outputs:
+            rowShape = (numRadialIntervals,) if isRadial else ()
+            self.store.create(name, rowShape, capacity=numOutputs)
+        self.store.create('outputIndex', (), 'int64', capacity=numOutputs)
+
+        self.store.commit()
+
+        if not os.path.isdir(self._statisticsDir()):
+            os.makedirs(self._statisticsDir())
+
+    def _statisticsDir(self):
+        return self.outputDir + '/' + self.statisticsName
+
+    def _statisticsPath(self, startIndex, endIndex):
+        return self._statisticsDir() + '/' + self._batchKey(startIndex, endIndex) + '.npz'
+
+    def _newStatistics(self):
+        """
+        the whole-run statistics: mean, variance and extrema of the density field and of the radial
+        profiles, and per-radius histograms of the eccentricities (the m = 1 mode amplitudes)
+        """
+        statistics = RunStatistics()
+        for quantity in self._statisticsQuantities():
+            statistics.add(quantity, RunningMoments()).add(quantity, RunningExtrema())
+            if quantity in ['radialEccMK', 'radialEccLubow']:
+                statistics.add(quantity, FixedHistogram(0., 1., 50))
+        return statistics
+
+    def _statisticsQuantities(self):
+        return ['dens'] + [name for name in ['radialDens', 'radialEccMK', 'radialEccLubow'] if self._hasOutputs(name)]
+
+    def mergeStatistics(self):
+        paths = [self._statisticsPath(startIndex, endIndex) for startIndex, endIndex in self._batchRanges()]
+        present = [path for path in paths if os.path.exists(path)]
+        if len(present) < len(paths):
+            print "run statistics are missing " + str(len(paths) - len(present)) + " batches"
+
+        statistics = RunStatistics.mergeFiles(present)
+        statistics.save(self.outputDir + '/' + self.statisticsName + '.npz')
+        return statistics
+
+    def _getDiagnostic(self, name):
+        if name in self.store.names():
+            return self.store.open(name)
+
+        # output directories written before the store existed hold one .npy file per batch
+        fmt = '/' + name + '*.npy'
         filePaths = glob.glob(self.outputDir + fmt)
         sortedPaths = sorted(filePaths, key=self.parser._extractFileIndex)
 
@@ -37,52 +287,228 @@ class FargoDiagnosticsRunner:
 
         return np.concatenate(arrays)
 
-    def runBatches(self):
-        i = 0
-        while self.parser.hasRemainingBatches():
-            dens, vrad, vtheta = self.parser.getNextBatch()
-            calculations = fd.computeDiagnostics(self.params['radialEdges'], self.params['radialIntervals'],
-                                                             self.params['thetaIntervals'], dens, vrad, vtheta)
-
-            avgDens = np.average(dens, axis=2)
+    def _processBatch(self, i, dens, vrad, vtheta):
+        """
+        compute, plot and save the diagnostics for a batch whose first output has index i
+        """
+        calculations = fd.computeDiagnostics(self.geometry, dens, vrad, vtheta, self.mkEngine,
+                                             names=[key for _, key, _ in self.outputs])
+
+        avgDens = np.average(dens, axis=2)
+
+        with monitor.stage('statistics'):
+            statistics = self._newStatistics()
+            statistics.update('dens', dens)
+            for quantity in self._statisticsQuantities()[1:]:
+                statistics.update(quantity, calculations[quantity])
+
+        # i is a position in the parser's selection; plots and outputIndex use output numbers
+        outputIndices = self.parser.getSelectedIndices(i, i + len(dens))
+        plotEvery = max(1, 20 // self.parser.selection[2])
+        plotted = range(0, len(dens), plotEvery)
+        if not self._hasOutputs('radialEccMK', 'radialEccLubow', 'radialPeriMK', 'radialPeriLubow'):
+            plotted = []
+
+        for j in plotted:
+            print 'plotting'
+            print "length of radialDens: " + str(len(avgDens))
+
+            outputIndex = outputIndices[j]
+            self._plot('threePanelVsRadius', avgDens[j],
+                       calculations['radialEccMK'][j], calculations['radialEccLubow'][j],
+                       calculations['radialPeriMK'][j], calculations['radialPeriLubow'][j],
+                       "%.1f" % (outputIndex/5.0), 'threePanel', outputIndex)
+
+        outputs = []
+        with monitor.stage('store'):
+            for name, key, _ in self.outputs:
+                self.store.write(name, i, calculations[key])
+                outputs.append(self.store.pathTo(name))
+
+            self.store.write('outputIndex', i, outputIndices)
+            outputs.append(self.store.pathTo('outputIndex'))
+
+            statisticsPath = self._statisticsPath(i, i + len(dens))
+            statistics.save(statisticsPath)
+            outputs.append(statisticsPath)
+
+        return outputs
+
+    def _batchRanges(self):
+        numOutputs = self.parser.numSelected
+        return [(start, min(start + self.batchSize, numOutputs)) for start in range(0, numOutputs, self.batchSize)]
+
+    def runBatchRange(self, startIndex, endIndex):
+        dens, vrad, vtheta = self.parser.getBatch(startIndex, endIndex)
+        return self._processBatch(startIndex, dens, vrad, vtheta)
+
+    def _manifestPath(self):
+        return self.outputDir + '/' + self.manifestName
+
+    def _loadManifest(self):
+        try:
+            with open(self._manifestPath()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'batches': {}}
+
+    def _saveManifest(self, manifest):
+        # write-then-rename, so a run killed mid-write never leaves a truncated manifest
+        tmpPath = self._manifestPath() + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True, separators=(',', ': '))
+        os.rename(tmpPath, self._manifestPath())
+
+    def _inputSignature(self, startIndex, endIndex):
+        signature = {}
+        for varType in self.parser.variables:
+            for path in self.parser.getSelectedPaths(varType, startIndex, endIndex):
+                stat = os.stat(path)
+                signature[os.path.basename(path)] = [stat.st_size, stat.st_mtime]
+
+        return signature
+
+    def _batchKey(self, startIndex, endIndex):
+        return str(startIndex) + '-' + str(endIndex)
+
+    def _isComplete(self, manifest, startIndex, endIndex):
+        entry = manifest['batches'].get(self._batchKey(startIndex, endIndex))
+        if entry is None:
+            return False
+
+        if not all(self._isStored(path, endIndex) for path in entry['outputs']):
+            return False
+
+        # the batch may have been computed with more diagnostics, and so more inputs, than selected now
+        required = [os.path.abspath(self.store.pathTo(name)) for name, _, _ in self.outputs]
+        if not set(required) <= set(os.path.abspath(path) for path in entry['outputs']):
+            return False
+
+        signature = self._inputSignature(startIndex, endIndex)
+        return all(entry['inputs'].get(name) == value for name, value in signature.items())
+
+    def _isStored(self, path, endIndex):
+        # store datasets are shared by every batch, so the file existing says little: the dataset must
+        # still be in the store's index (not reallocated empty since) and hold the batch's rows
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.store.directory):
+            return os.path.exists(path)
+
+        name = os.path.basename(path)[:-len('.npy')]
+        return name in self.store.names() and self.store._capacity(name) >= endIndex
+
+    def _validLengths(self, manifest, names):
+        """
+        the valid length of each dataset in names: the end of the leading run of batch ranges the manifest
+        records as having written it. batches finish out of order under a pool, and a failed one leaves a
+        gap, so rows after the first missing batch are not valid yet, however many of them were written
+        """
+        lengths = {}
+        for name in names:
+            path = os.path.abspath(self.store.pathTo(name))
+            lengths[name] = 0
+            for startIndex, endIndex in self._batchRanges():
+                entry = manifest['batches'].get(self._batchKey(startIndex, endIndex))
+                if entry is None or path not in [os.path.abspath(output) for output in entry['outputs']]:
+                    break
+                lengths[name] = endIndex
+
+        return lengths
+
+    def _commitStore(self, manifest, names=None):
+        """
+        commit the store, setting the valid length of the datasets in names (by default those the
+        selected diagnostics write) from the manifest
+        """
+        if names is None:
+            names = [name for name, _, _ in self.outputs] + ['outputIndex']
+        self.store.commit(self._validLengths(manifest, names))
+
+    def _recordBatch(self, manifest, startIndex, endIndex, outputs):
+        manifest['batches'][self._batchKey(startIndex, endIndex)] = {
+            'start': startIndex,
+            'end': endIndex,
+            'outputs': outputs,
+            'inputs': self._inputSignature(startIndex, endIndex)
+        }
+        self._saveManifest(manifest)
+
+    def prepareBatches(self, resume=True):
+        """
+        load the manifest and preallocate the store. returns (manifest, pending batch ranges);
+        with resume, batch ranges recorded as complete in the manifest are left out
+        """
+        manifest = self._loadManifest() if resume else {'batches': {}}
+
+        # batch ranges are positions in the selection, so a different selection invalidates them all,
+        # as does a change of precision or pyramid level
+        selection = list(self.parser.selection)
+        settings = {'selection': selection, 'precision': self.precision, 'level': self.level}
+        defaults = {'precision': 'double', 'level': 0}
+        if any(manifest.get(key, defaults.get(key)) != value for key, value in settings.items()):
+            manifest = dict(settings, batches={})
+
+        pending = [(startIndex, endIndex) for startIndex, endIndex in self._batchRanges()
+                   if not (resume and self._isComplete(manifest, startIndex, endIndex))]
+
+        print "skipping " + str(len(self._batchRanges()) - len(pending)) + " completed batches"
+
+        self._prepareStore()
+        # bring every dataset's valid length in line with the manifest, which may have been reset
+        self._commitStore(manifest, self.store.names())
+        return manifest, pending
+
+    def completeBatch(self, manifest, startIndex, endIndex, outputs, stats):
+        """
+        record a batch range computed by another process in the manifest and commit the store;
+        datasets only become valid up to the first batch range that has not completed
+        """
+        monitor.merge(stats)
+        self._recordBatch(manifest, startIndex, endIndex, outputs)
+        self._commitStore(manifest)
+        print "finished batch " + str(startIndex) + " to " + str(endIndex)
+
+    def runBatches(self, workers=1, resume=True):
+        """
+        compute diagnostics for every batch. with workers > 1 the batches are spread over a
+        multiprocessing pool; each worker parses, computes, saves and plots its own batches,
+        using the same batch boundaries (and so the same output files) as the serial path.
+        in serial mode, plots are handed to a pool of renderWorkers processes if one was requested.
+
+        with resume, batch ranges recorded as complete in the manifest are skipped
+        """
+        manifest, pending = self.prepareBatches(resume)
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _initWorker,
+                                        (self.inputDir, self.outputDir, self.plotDir, self.batchSize,
+                                         self.selectionArgs, self.readThreads, self.precision, self.level,
+                                         self.diagnostics))
+            for (startIndex, endIndex), outputs, stats in pool.imap_unordered(_runBatchRange, pending):
+                self.completeBatch(manifest, startIndex, endIndex, outputs, stats)
+            pool.close()
+            pool.join()
+            return
+
+        if self.renderWorkers > 0:
+            self.renderPool = RenderPool(self.renderWorkers, FargoPlotter, self.plotterArgs)
+
+        for startIndex, endIndex in pending:
+            if self.parser.startIndex != startIndex:
+                self.parser.seek(startIndex)
 
-            for j in range(0, len(dens), 20):
-                print 'plotting'
-                print "length of radialDens: " + str(len(calculations['radialDens']))
-
-                self.plotter.threePanelVsRadius(avgDens[j],
-                                                calculations['radialEccMK'][j], calculations['radialEccLubow'][j],
-                                                calculations['radialPeriMK'][j], calculations['radialPeriLubow'][j],
-                                                "%.1f" % ((i + j)/5.0), 'threePanel', i + j)
-
-            np.save(self.outputDir + '/radialEccMK' + str(i), calculations['radialEccMK'])
-            np.save(self.outputDir + '/radialEccLubow' + str(i), calculations['radialEccLubow'])
-
-            np.save(self.outputDir + '/radialPeriMK' + str(i), calculations['radialPeriMK'])
-            np.save(self.outputDir + '/radialPeriLubow' + str(i), calculations['radialPeriLubow'])
-
-            np.save(self.outputDir + '/radialDens' + str(i), calculations['radialDens'])
-            np.save(self.outputDir + '/diskEccMK' + str(i), calculations['diskEccMK'])
-            np.save(self.outputDir + '/diskPeriMK' + str(i), calculations['diskPeriMK'])
-
-            np.save(self.outputDir + '/diskEccLubow' + str(i), calculations['diskEccLubow'])
-            np.save(self.outputDir + '/diskPeriLubow' + str(i), calculations['diskPeriLubow'])
-
-            np.save(self.outputDir + '/totalMass' + str(i), calculations['totalMass'])
-
-            np.save(self.outputDir + '/diskRadius90' + str(i), calculations['diskRad90'])
-            np.save(self.outputDir + '/diskRadius95' + str(i), calculations['diskRad95'])
-
-            np.save(self.outputDir + '/lubowVsin' + str(i), calculations['lubowVsin'])
-            np.save(self.outputDir + '/lubowVcos' + str(i), calculations['lubowVcos'])
+            dens, vrad, vtheta = self.parser.getNextBatch()
+            outputs = self._processBatch(startIndex, dens, vrad, vtheta)
+            self._recordBatch(manifest, startIndex, endIndex, outputs)
+            self._commitStore(manifest)
 
-            i += len(dens)
+        if self.renderPool is not None:
+            self.renderPool.close()
+            self.renderPool = None
 
 
     def runDiskTime(self):
         diagnosticTypes = [
             {
-                'fileFormat': '/diskEccMK*.npy',
                 'arrayFilename': 'eccMKVsTime.npy',
                 'yName': 'diskEccMK',
                 'yLabel': 'Disk eccentricity (Mueller-Kley)',
@@ -90,7 +516,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/diskPeriMK*.npy',
                 'arrayFilename': 'periMKVsTime.npy',
                 'yName': 'diskPeriMK',
                 'yLabel': 'Disk periastron angle (MK)',
@@ -98,7 +523,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/diskEccLubow*.npy',
                 'arrayFilename': 'eccLubowVsTime.npy',
                 'yName': 'diskEccLubow',
                 'yLabel': 'Disk eccentricity (Lubow)',
@@ -106,7 +530,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/diskPeriLubow*.npy',
                 'arrayFilename': 'periLubowVsTime.npy',
                 'yName': 'diskPeriLubow',
                 'yLabel': 'Disk periastron angle (Lubow)',
@@ -114,7 +537,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/totalMass*.npy',
                 'arrayFilename': 'massVsTime.npy',
                 'yName': 'totalMass',
                 'yLabel': 'Disk mass (code units)',
@@ -122,7 +544,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/diskRadius90*.npy',
                 'arrayFilename': 'radius90VsTime.npy',
                 'yName': 'diskRadius90',
                 'yLabel': 'Disk radius (a, 90%)',
@@ -130,7 +551,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/diskRadius95*.npy',
                 'arrayFilename': 'radius95VsTime.npy',
                 'yName': 'diskRadius95',
                 'yLabel': 'Disk radius (a, 95%)',
@@ -138,7 +558,6 @@ class FargoDiagnosticsRunner:
                 'plot': True
             },
             {
-                'fileFormat': '/lubowVsin*.npy',
                 'arrayFilename': 'vsinVsTime.npy',
                 'yName': 'lubowVsin',
                 'yLabel': 'Lubow V_sin',
@@ -146,7 +565,6 @@ class FargoDiagnosticsRunner:
                 'plot': False
             },
             {
-                'fileFormat': '/lubowVcos*.npy',
                 'arrayFilename': 'vcosVsTime.npy',
                 'yName': 'lubowVcos',
                 'yLabel': 'Lubow V_cos',
@@ -155,11 +573,20 @@ class FargoDiagnosticsRunner:
             }
         ]
 
+        self.mergeStatistics()
+
+        selected = [name for name, _, _ in self.outputs]
+        diagnosticTypes = [type for type in diagnosticTypes if type['yName'] in selected]
+
         diags = {}
 
+        numOutputs = self.parser.numSelected
         for type in diagnosticTypes:
-            diag = self._getDiagnostic(type['fileFormat'])
+            diag = self._getDiagnostic(type['yName'])
             diags[type['yName']] = diag
+            if len(diag) < numOutputs:
+                print "warning: " + type['yName'] + " holds only the first " + str(len(diag)) + " of " + \
+                      str(numOutputs) + " outputs; the batch after them has not completed (rerun without -d)"
 
             np.save(self.outputDir + '/' + type['arrayFilename'], diag)
 
@@ -169,10 +596,35 @@ class FargoDiagnosticsRunner:
                 print "plotting vs time " + type['yName']
                 self.plotter.vsTime(diag, type['yName'], type['yLabel'], type['title'])
 
-        eccMK = diags['diskEccMK']
-        periMK = diags['diskPeriMK']
-        print "plotting twopanel vs time"
-        self.plotter.twoPanelVsTime(eccMK, periMK, "eccPeriMK_vs_time")
+        if 'diskEccMK' in diags and 'diskPeriMK' in diags:
+            eccMK = diags['diskEccMK']
+            periMK = diags['diskPeriMK']
+            print "plotting twopanel vs time"
+            self.plotter.twoPanelVsTime(eccMK, periMK, "eccPeriMK_vs_time")
+
+
+# shorthands accepted by --diagnostics
+DIAGNOSTIC_GROUPS = {
+    'density': ['radialDens', 'totalMass', 'diskRadius90', 'diskRadius95']
+}
+
+
+def parseDiagnostics(spec):
+    """
+    turn a --diagnostics argument such as 'totalMass,diskRadius90', 'density' or 'all' into a
+    list of store datasets, or None for all of them
+    """
+    names = []
+    for name in spec.split(','):
+        name = name.strip()
+        if name == 'all':
+            return None
+        for expanded in DIAGNOSTIC_GROUPS.get(name, [name]):
+            if expanded not in names:
+                names.append(expanded)
+
+    FargoDiagnosticsRunner.selectOutputs(names)
+    return names
 
 
 def main():
@@ -192,15 +644,103 @@ def main():
     optParser.add_option('-d', '--diskonly', action='store_true',
                          dest='diskOnly')
 
+    optParser.add_option('-w', '--workers', action='store',
+                         type='int', dest='workers', default=1,
+                         help='number of worker processes to spread batches over')
+
+    optParser.add_option('-r', '--renderworkers', action='store',
+                         type='int', dest='renderWorkers', default=0,
+                         help='number of processes drawing per-batch plots (0 draws inline)')
+
+    optParser.add_option('--start', action='store',
+                         type='int', dest='start', default=0,
+                         help='first output to analyze')
+
+    optParser.add_option('--stop', action='store',
+                         type='int', dest='stop',
+                         help='analyze outputs before this one')
+
+    optParser.add_option('--stride', action='store',
+                         type='int', dest='stride', default=1,
+                         help='analyze every stride-th output; the others are never read')
+
+    optParser.add_option('--fresh', action='store_true', dest='fresh',
+                         help='ignore the batch manifest and recompute every batch')
+
+    optParser.add_option('--prefetch', action='store',
+                         type='int', dest='prefetchDepth', default=0,
+                         help='number of batches to read ahead on a background thread (0 disables)')
+
+    optParser.add_option('--prefetchmemory', action='store',
+                         type='int', dest='prefetchMemory',
+                         help='cap on memory held by read-ahead batches, in MB')
+
+    optParser.add_option('--readthreads', action='store',
+                         type='int', dest='readThreads', default=0,
+                         help='number of threads reading the gas files of each batch concurrently (0 reads serially)')
+
+    optParser.add_option('--precision', action='store',
+                         type='choice', choices=['double', 'single'], dest='precision', default='double',
+                         help='precision of the gas fields in memory; single halves memory and bandwidth, '
+                              'with every sum still accumulated in double (see fargoDiagnostics for error bounds)')
+
+    optParser.add_option('--level', action='store',
+                         type='string', dest='level', default='0',
+                         help='pyramid level to analyze (see snapshotPyramid.py), or auto for the coarsest one '
+                              'that resolves the radial plots; default 0, full resolution. levels above 0 '
+                              'only serve --diagnostics density, and auto picks 0 for any other diagnostics')
+
+    optParser.add_option('--report', action='store',
+                         type='string', dest='reportPath',
+                         help='where to write the JSON performance report (default: perfReport.json in the '
+                              'output directory)')
+
+    optParser.add_option('--diagnostics', action='store',
+                         type='string', dest='diagnostics', default='all',
+                         help='comma-separated datasets to compute, from ' +
+                              ', '.join(name for name, _, _ in FargoDiagnosticsRunner.batchOutputs) +
+                              ', or density (' + ', '.join(DIAGNOSTIC_GROUPS['density']) + ') or all; '
+                              'only the gas variables they need are read')
+
+    optParser.add_option('--kernels', action='store',
+                         type='choice', choices=['auto'] + kernels.BACKENDS, dest='kernels',
+                         help='backend of the Mueller-Kley kernel (see kernels.py); auto picks numba, else numexpr, '
+                              'else numpy. default: $FARGO_KERNELS, else auto')
+
+    optParser.add_option('--crosscheck', action='store_true', dest='crossCheck',
+                         help='repeat every accelerated kernel call with numpy and stop if they disagree')
+
+    optParser.add_option('-v', '--verbose', action='store_true', dest='verbose',
+                         help='log every file the parser touches')
+
     (options, args) = optParser.parse_args()
 
     if not options.inputDirectory:
         optParser.error('you must specify an input directory with -i or --inputdirectory')
 
-    runner = FargoDiagnosticsRunner(options.inputDirectory, options.outputDirectory, options.plotDirectory, options.batchSize)
+    if options.verbose:
+        logging.getLogger('').setLevel(logging.DEBUG)
+
+    maxPrefetchBytes = options.prefetchMemory * 1024 * 1024 if options.prefetchMemory else None
+
+    try:
+        diagnostics = parseDiagnostics(options.diagnostics)
+        kernels.setBackend(options.kernels or kernels.backend(), options.crossCheck)
+        level = options.level if options.level == 'auto' else int(options.level)
+        FargoDiagnosticsRunner.resolveLevel(options.inputDirectory, level, diagnostics)
+    except ValueError as e:
+        optParser.error(str(e))
+
+    runner = FargoDiagnosticsRunner(options.inputDirectory, options.outputDirectory, options.plotDirectory,
+                                    options.batchSize, options.prefetchDepth, maxPrefetchBytes,
+                                    options.renderWorkers, options.start, options.stop, options.stride,
+                                    options.readThreads, options.precision, level, diagnostics=diagnostics)
     if not options.diskOnly:
-        runner.runBatches()
+        runner.runBatches(options.workers, not options.fresh)
     runner.runDiskTime()
 
+    reportPath = options.reportPath or options.outputDirectory + '/perfReport.json'
+    printReport(monitor.writeReport(reportPath))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,148 @@
+__author__ = 'cguo'
+
+from gridGeometry import GridGeometry
+from optparse import OptionParser
+import numpy as np
+import json
+import math
+import os
+
+"""
+writes a synthetic Fargo2D output directory -- dims.dat, used_rad.dat, orbit0.dat, planet0.dat,
+bigplanet0.dat and gasdens/gasvrad/gasvtheta<i>.dat -- for benchmarking and for checking the
+diagnostics against a known answer.
+
+the disk is an analytic, linearly eccentric Keplerian disk around a primary of unit mass
+(G = 1), with eccentricity profile e(r) = e0 exp(-((r - rEcc) / wEcc)^2) and a periastron
+that precesses at precessionRate. to first order in e, at fixed r and with phi = theta - peri,
+    vr     = e r^-1/2 sin(phi)
+    vtheta = r^-1/2 (1 + e/2 cos(phi))
+    dens   = sigma(r) (1 + delta(r) cos(phi)),  sigma = sigma0 r^-1/2 exp(-(r / rTaper)^4)
+with delta = r de/dr - 4 e (r / rTaper)^4 - e/2 from the continuity equation, so the
+Mueller-Kley eccentricity recovers e(r) and its periastron recovers peri.
+
+the secondary, of mass binaryMass, is on a circular orbit of unit radius with period 2 pi;
+outputs are 1/5 of an orbit apart, as diagnosticsRunner assumes, and planet0.dat holds
+planetRowsPerOutput rows per output, as tqAnalysis.getTrajectory assumes
+"""
+
+DEFAULTS = {
+    'nr': 128, 'ns': 256, 'nt': 50,
+    'rmin': 0.1, 'rmax': 3.0,
+    'e0': 0.1, 'rEcc': 0.6, 'wEcc': 0.4, 'precessionRate': 0.05, 'rTaper': 1.5,
+    'sigma0': 1e-3, 'binaryMass': 0.2857, 'noise': 0.0, 'seed': 0,
+    'planetRowsPerOutput': 20
+}
+
+outputInterval = 2 * math.pi / 5.0
+
+
+def eccentricDiskSnapshot(geometry, t, params):
+    """
+    (dens, vr, vtheta) of shape (nr, ns) at time t
+    """
+    r = geometry.rCol
+    peri = params['precessionRate'] * t
+    phase = geometry.thetaRow - peri
+
+    ecc = params['e0'] * np.exp(-np.square((r - params['rEcc']) / params['wEcc']))
+    rDedr = -2. * ecc * r * (r - params['rEcc']) / params['wEcc'] ** 2
+    delta = rDedr - 4. * ecc * np.power(r / params['rTaper'], 4) - 0.5 * ecc
+
+    keplerSpeed = 1. / np.sqrt(r)
+    vr = ecc * keplerSpeed * np.sin(phase)
+    vtheta = keplerSpeed * (1. + 0.5 * ecc * np.cos(phase))
+
+    sigma = params['sigma0'] / np.sqrt(r) * np.exp(-np.power(r / params['rTaper'], 4))
+    dens = sigma * (1. + delta * np.cos(phase))
+
+    return dens, vr, vtheta
+
+
+def _writeOrbitFiles(outputDir, params):
+    rows = params['nt'] * params['planetRowsPerOutput']
+    t = np.arange(rows) * (outputInterval / params['planetRowsPerOutput'])
+    x, y = np.cos(t), np.sin(t)
+    vx, vy = -np.sin(t), np.cos(t)
+    mass = np.zeros_like(t) + params['binaryMass']
+
+    # index x y vx vy mass date omegaframe
+    planet = np.column_stack([np.arange(rows), x, y, vx, vy, mass, t, np.zeros_like(t)])
+    np.savetxt(outputDir + '/planet0.dat', planet)
+    # Fargo repeats lines in bigplanet0.dat after a restart
+    np.savetxt(outputDir + '/bigplanet0.dat', np.vstack([planet, planet[-params['planetRowsPerOutput']:]]))
+
+    # date e a mean-anomaly true-anomaly periastron
+    orbit = np.column_stack([t, np.zeros_like(t), np.ones_like(t), t % (2 * math.pi), t % (2 * math.pi),
+                             np.zeros_like(t)])
+    np.savetxt(outputDir + '/orbit0.dat', orbit)
+
+
+def writeFakeRun(outputDir, **params):
+    """
+    write a synthetic run to outputDir; params override DEFAULTS. the parameters are saved
+    to fakeRun.json, and a directory already holding a run with the same parameters is left
+    as it is. returns the parameters
+    """
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('unknown parameters ' + ', '.join(sorted(unknown)))
+
+    full = dict(DEFAULTS)
+    full.update(params)
+
+    paramsPath = outputDir + '/fakeRun.json'
+    if os.path.exists(paramsPath):
+        with open(paramsPath) as f:
+            if json.load(f) == full:
+                return full
+
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+
+    nr, ns, nt = full['nr'], full['ns'], full['nt']
+
+    radialEdges = np.logspace(math.log10(full['rmin']), math.log10(full['rmax']), nr + 1)
+    np.savetxt(outputDir + '/used_rad.dat', radialEdges)
+    np.savetxt(outputDir + '/dims.dat', [[0, 0, 0, 0, full['rmax'], nt, nr, ns]])
+    _writeOrbitFiles(outputDir, full)
+
+    geometry = GridGeometry(radialEdges, ns)
+    rng = np.random.RandomState(full['seed'])
+
+    for i in range(nt):
+        dens, vr, vtheta = eccentricDiskSnapshot(geometry, i * outputInterval, full)
+        if full['noise'] > 0:
+            dens = dens * (1. + full['noise'] * rng.standard_normal(dens.shape))
+
+        for varType, field in (('dens', dens), ('vrad', vr), ('vtheta', vtheta)):
+            np.ascontiguousarray(field, dtype='double').tofile(outputDir + '/gas' + varType + str(i) + '.dat')
+
+    with open(paramsPath, 'w') as f:
+        json.dump(full, f, indent=1, sort_keys=True, separators=(',', ': '))
+
+    return full
+
+
+def main():
+    optParser = OptionParser(usage='%prog -o OUTPUTDIR [--nr NR] [--ns NS] [--nt NT] ...')
+    optParser.add_option('-o', '--outputdirectory', action='store',
+                         type='string', dest='outputDirectory')
+
+    for name, value in sorted(DEFAULTS.items()):
+        optParser.add_option('--' + name.lower(), action='store',
+                             type='int' if isinstance(value, int) else 'float', dest=name, default=value,
+                             help='default %default')
+
+    (options, args) = optParser.parse_args()
+
+    if not options.outputDirectory:
+        optParser.error('you must specify an output directory with -o or --outputdirectory')
+
+    params = dict((name, getattr(options, name)) for name in DEFAULTS)
+    writeFakeRun(options.outputDirectory, **params)
+    print "wrote " + str(params['nt']) + " outputs of " + str(params['nr']) + " x " + str(params['ns']) + \
+          " to " + options.outputDirectory
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,62 @@
+from perfMonitor import monitor
+import kernels
 import numpy as np
 import math
 
-
-def _thetaBroadcast(row, numRows, numFrames):
-    """
-    broadcast a theta row into a numFrames x numRows x len(row) array
+"""
+precision: every function here works at the precision of the gas fields it is given. with float32
+fields (FargoParser(precision='single')) the per-cell arithmetic and temporaries are float32, while
+every reduction -- azimuthal and radial sums, mass totals, the cumulative sums in diskRadius -- is
+accumulated in float64 (ACCUMULATOR), and all returned diagnostics are float64.
+
+error bounds against the float64 path: each field is rounded once on read (relative error 6e-8),
+and each per-cell product adds a few more roundings of the same size. the bounds below are upper
+estimates; the figures in brackets are the largest differences measured on a synthetic 40 x 64 run
+of 50 outputs (fakeFargoRun.py with its default disk).
+  totalMass, radialDens: relative error ~1e-7 [1.5e-9, 3.2e-8]
+  Lubow vsin/vcos (sums of signed terms): absolute error ~1e-7 * sum |vtheta| dtheta / pi [2.3e-8 of it]
+  eccentricities: Mueller-Kley e = |r vtheta (...) - (cos, sin)| has an absolute error of ~1e-6
+    per cell; radial and disk averages of e, MK or Lubow, are within ~1e-6 absolute [9.5e-8]
+  radial periastron angles: absolute error ~1e-6 / e radians [2.3e-8 / e MK, 7.9e-8 / e Lubow],
+    meaningless where e is below ~1e-6, as the rounding of vr and vtheta alone moves e by ~1e-7
+  diskPeriMK: NOT bounded like the other disk averages. it averages the periastron angle of every
+    cell by mass, including cells where e is too small for the angle to mean anything, and those
+    angles can land anywhere in [-pi, pi]. its error is up to ~pi times the fraction of the disk
+    mass where e is below ~1e-6. accumulating in float64 does not help, because the noise is
+    already in the float32 fields [1.3e-2 rad, with 1% of the mass at e < 1e-6]. where the outer
+    disk is close to circular, use double precision for diskPeriMK, or use diskPeriLubow, which
+    averages the radial Lubow angles [2.2e-7 rad]
+  diskRadius90/95: exact, unless a cumulative mass fraction lies within ~1e-7 of the threshold,
+    in which case the neighbouring cell's radius [exact]
+"""
+
+ACCUMULATOR = np.float64
+
+
+def _azimuthalMassAverage(arr, density, radialDensity=None):
     """
-
-    arr = np.vstack([row] * numRows)
-    return np.array([arr] * numFrames)
-
-
-def _radialBroadcast(row, numCols, numFrames):
+    compute and return the azimuthal mass-weighted average of `arr`; radialDensity, if given,
+    is the azimuthal sum of density
     """
-    broadcast a radial row into a numFrames x len(row) x numCols array
-    """
-
-    col = np.array(row).reshape([-1, 1])
-    arr = np.hstack([col] * numCols)
-    return np.array([arr] * numFrames)
-
-
-def _azimuthalMassAverage(arr, density):
-    """
-    compute and return the azimuthal mass-weighted average of `arr`
-    """
-    weightedSum = np.einsum("abc,abc->ab", arr, density)
-    radialDensity = np.sum(density, 2)
+    weightedSum = np.einsum("abc,abc->ab", arr, density, dtype=ACCUMULATOR)
+    if radialDensity is None:
+        radialDensity = np.sum(density, 2, dtype=ACCUMULATOR)
     return np.divide(weightedSum, radialDensity)
 
 
-def _lubowDiagnostics(radialIntervals, thetaIntervals, dens, vr, vtheta):
-    numRadialIntervals = len(radialIntervals)
-    numThetaIntervals = len(thetaIntervals)
-    numTimeIntervals = len(vr)
-
-    thetaDeltas = np.zeros_like(thetaIntervals) + (2 * math.pi)/numThetaIntervals
-
-    # numTimeIntervals x numRadialIntervals x numThetaIntervals
-    r = _radialBroadcast(radialIntervals, numThetaIntervals, numTimeIntervals)
-    theta = _thetaBroadcast(thetaIntervals, numRadialIntervals, numTimeIntervals)
-    dtheta = _thetaBroadcast(thetaDeltas, numRadialIntervals, numTimeIntervals)
+def _lubowDiagnostics(geometry, dens, vr, vtheta, radialDensity=None):
+    fieldGeometry = geometry.astype(vtheta.dtype)
 
     # vtheta/r averaged azimuthally
-    omega = _azimuthalMassAverage(np.divide(vtheta, r), dens)
+    omega = _azimuthalMassAverage(np.divide(vtheta, fieldGeometry.rCol), dens, radialDensity)
 
-    vsin = np.multiply(np.multiply(vtheta, dtheta), np.sin(theta)).sum(2) / math.pi
-    vcos = np.multiply(np.multiply(vtheta, dtheta), np.cos(theta)).sum(2) / math.pi
+    vsin = np.multiply(np.multiply(vtheta, geometry.dtheta),
+                       fieldGeometry.sinThetaRow).sum(2, dtype=ACCUMULATOR) / math.pi
+    vcos = np.multiply(np.multiply(vtheta, geometry.dtheta),
+                       fieldGeometry.cosThetaRow).sum(2, dtype=ACCUMULATOR) / math.pi
 
     # numTimeIntervals x numRadialIntervals
-    r2d = np.array([radialIntervals] * numTimeIntervals)
-
-    e = (2.0 / np.multiply(r2d, omega)) * np.sqrt(np.add(np.square(vsin), np.square(vcos)))
+    e = (2.0 / np.multiply(geometry.radialIntervals, omega)) * np.sqrt(np.add(np.square(vsin), np.square(vcos)))
     peri = np.arctan2(vsin, vcos)
 
     return {
@@ -74,21 +79,12 @@ def _fourierRadialDiagnostics(dens):
     }
 
 
-def _computeCellDiagnostics(radialIntervals, thetaIntervals, vr, vtheta):
-    numRadialIntervals = len(radialIntervals)
-    numThetaIntervals = len(thetaIntervals)
-    numTimeIntervals = len(vr)
-
-    # numTimeIntervals x numRadialIntervals x numThetaIntervals
-    r = _radialBroadcast(radialIntervals, numThetaIntervals, numTimeIntervals)
-    
-    theta = _thetaBroadcast(thetaIntervals, numRadialIntervals, numTimeIntervals)
-    
+def _computeCellDiagnostics(geometry, vr, vtheta):
     # r * v_theta
-    r_vtheta = np.multiply(r, vtheta)
+    r_vtheta = np.multiply(geometry.rCol, vtheta)
 
-    sin_theta = np.sin(theta)
-    cos_theta = np.cos(theta)
+    sin_theta = geometry.sinThetaRow
+    cos_theta = geometry.cosThetaRow
 
     e_x = np.subtract(
             np.multiply(
@@ -114,25 +110,168 @@ def _computeCellDiagnostics(radialIntervals, thetaIntervals, vr, vtheta):
         "cellPeriastron": cellPeriastron
         }
 
-def diskRadius(dens, radialEdges, radialIntervals):
-    nt, nr, ns = dens.shape
-    rmid = np.array([np.array([radialIntervals]* ns).transpose()] * nt)
-    rdiff = np.array([np.array([np.ediff1d(radialEdges)]* ns).transpose()] * nt)
+class MuellerKleyEngine:
+    """
+    fused, bounded-memory evaluation of the Mueller-Kley cell eccentricity and periastron
+    (see _computeCellDiagnostics) together with their azimuthal and disk mass-weighted averages.
+
+    the grid is processed in chunks of chunkRows radial rings. every per-cell temporary lives in
+    one of four (nt, chunkRows, ns) workspace buffers that are written with out= and reused for
+    every chunk and every batch, so peak memory is a handful of chunk-sized fields rather than a
+    dozen full (nt, nr, ns) arrays. the per-cell fields themselves are only assembled if asked for.
+    workspaces (and the cell fields) have the precision of vr and vtheta; the averages are
+    accumulated and returned in float64. without keepCellFields the averages go through the
+    'muellerKley' kernel (see kernels), whose numpy implementation is this one.
+
+    methods:
+    MuellerKleyEngine(geometry, chunkRows=32)
+
+    compute(dens, vr, vtheta, keepCellFields=False, radialDensity=None): returns a dict with radialEccMK,
+        radialPeriMK, diskEccMK and diskPeriMK (and cellEccentricity, cellPeriastron if keepCellFields);
+        radialDensity, if given, is dens summed over theta
+    """
+
+    def __init__(self, geometry, chunkRows=32):
+        self.geometry = geometry
+        self.chunkRows = min(chunkRows, geometry.numRadialIntervals)
+        self._workspace = None
+
+    def _getWorkspace(self, numTimeIntervals, dtype):
+        ws = self._workspace
+        if ws is None or ws[0].shape[0] < numTimeIntervals or ws[0].dtype != dtype:
+            shape = (numTimeIntervals, self.chunkRows, self.geometry.numThetaIntervals)
+            ws = tuple(np.empty(shape, dtype=dtype) for _ in range(4))
+            self._workspace = ws
+
+        return ws
+
+    def compute(self, dens, vr, vtheta, keepCellFields=False, radialDensity=None):
+        if keepCellFields:
+            return self._compute(dens, vr, vtheta, True, radialDensity)
+        return kernels.run('muellerKley', self._averages, self.geometry, dens, vr, vtheta, radialDensity)
+
+    def _averages(self, geometry, dens, vr, vtheta, radialDensity):
+        return self._compute(dens, vr, vtheta, False, radialDensity)
+
+    def _compute(self, dens, vr, vtheta, keepCellFields, radialDensity):
+        nt, nr, ns = vr.shape
+        dtype = np.result_type(vr, vtheta)
+        geometry = self.geometry.astype(dtype)
+
+        radialEcc = np.empty((nt, nr), dtype=ACCUMULATOR)
+        radialPeri = np.empty((nt, nr), dtype=ACCUMULATOR)
+
+        # disk averages skip the innermost ring and weight by r * dr between cell centres
+        eccAcc = np.zeros((nt, ns))
+        periAcc = np.zeros((nt, ns))
+        massAcc = np.zeros((nt, ns))
+
+        if keepCellFields:
+            cellEccentricity = np.empty((nt, nr, ns), dtype=dtype)
+            cellPeriastron = np.empty((nt, nr, ns), dtype=dtype)
+
+        ws = self._getWorkspace(nt, dtype)
+        sin_theta = geometry.sinThetaRow
+        cos_theta = geometry.cosThetaRow
+
+        for start in range(0, nr, self.chunkRows):
+            end = min(start + self.chunkRows, nr)
+            rows = end - start
+            t1, t2, e_x, e_y = [buf[:nt, :rows] for buf in ws]
+
+            vr_c = vr[:, start:end]
+            vtheta_c = vtheta[:, start:end]
+            dens_c = dens[:, start:end]
+
+            # e_x = r vtheta (vr sin + vtheta cos) - cos
+            np.multiply(vr_c, sin_theta, out=t1)
+            np.multiply(vtheta_c, cos_theta, out=t2)
+            np.add(t1, t2, out=t1)
+            np.multiply(geometry.rCol[start:end], vtheta_c, out=t2)
+            np.multiply(t2, t1, out=e_x)
+            np.subtract(e_x, cos_theta, out=e_x)
+
+            # e_y = r vtheta (vtheta sin - vr cos) - sin
+            np.multiply(vtheta_c, sin_theta, out=t1)
+            np.multiply(vr_c, cos_theta, out=e_y)
+            np.subtract(t1, e_y, out=t1)
+            np.multiply(t2, t1, out=e_y)
+            np.subtract(e_y, sin_theta, out=e_y)
+
+            # t1 = eccentricity, t2 = periastron
+            np.square(e_x, out=t1)
+            np.square(e_y, out=t2)
+            np.add(t1, t2, out=t1)
+            np.sqrt(t1, out=t1)
+            np.arctan2(e_y, e_x, out=t2)
+
+            if keepCellFields:
+                cellEccentricity[:, start:end] = t1
+                cellPeriastron[:, start:end] = t2
+
+            if radialDensity is None:
+                chunkDensity = np.sum(dens_c, 2, dtype=ACCUMULATOR)
+            else:
+                chunkDensity = radialDensity[:, start:end]
+            np.divide(np.einsum("abc,abc->ab", t1, dens_c, dtype=ACCUMULATOR), chunkDensity,
+                      out=radialEcc[:, start:end])
+            np.divide(np.einsum("abc,abc->ab", t2, dens_c, dtype=ACCUMULATOR), chunkDensity,
+                      out=radialPeri[:, start:end])
+
+            first = max(start, 1)
+            if first >= end:
+                continue
+
+            weights = geometry.centerRdr[first - 1:end - 1].reshape(-1, 1).astype(dtype)
+            skip = first - start
+
+            np.multiply(t1[:, skip:], dens_c[:, skip:], out=e_x[:, skip:])
+            np.multiply(weights, e_x[:, skip:], out=e_x[:, skip:])
+            np.multiply(t2[:, skip:], dens_c[:, skip:], out=e_y[:, skip:])
+            np.multiply(weights, e_y[:, skip:], out=e_y[:, skip:])
+            np.multiply(weights, dens_c[:, skip:], out=t1[:, skip:])
+
+            # accumulate ring by ring, in the same order as summing over the radial axis
+            for k in range(skip, rows):
+                eccAcc += e_x[:, k]
+                periAcc += e_y[:, k]
+                massAcc += t1[:, k]
+
+        totalMass = massAcc.sum(1)
+
+        ret = {
+            "radialEccMK": radialEcc,
+            "radialPeriMK": radialPeri,
+            "diskEccMK": np.divide(eccAcc.sum(1), totalMass),
+            "diskPeriMK": np.divide(periAcc.sum(1), totalMass)
+        }
+
+        if keepCellFields:
+            ret["cellEccentricity"] = cellEccentricity
+            ret["cellPeriastron"] = cellPeriastron
 
-    weighted = (dens * rmid * rdiff).sum(axis=2)
-    totals = weighted.sum(axis=1)
+        return ret
 
-    totalsMat = np.array([totals] * nr).transpose()
+def diskRadius(dens, geometry, radialDensity=None):
+    """
+    radialDensity, if given, is the azimuthal sum of dens
+    """
+    radialIntervals = geometry.radialIntervals
+
+    if radialDensity is None:
+        radialDensity = np.sum(dens, 2, dtype=ACCUMULATOR)
+    weighted = radialDensity * geometry.rdr
+    totals = weighted.sum(axis=1).reshape(-1, 1)
 
     cumuWeights = np.cumsum(weighted, axis=1)
 
     thresh = 0.9
-    threshWeights = thresh * totalsMat
+    threshWeights = thresh * totals
     diskRadiiIx = np.argmax(cumuWeights > threshWeights, axis=1)
     diskRadii90 = radialIntervals[diskRadiiIx]
 
     thresh = 0.95
-    threshWeights = thresh * totalsMat
+    threshWeights = thresh * totals
     diskRadiiIx = np.argmax(cumuWeights > threshWeights, axis=1)
     diskRadii95 = radialIntervals[diskRadiiIx]
 
@@ -142,116 +281,202 @@ def diskRadius(dens, radialEdges, radialIntervals):
     }
 
 
-def diskMassAverage(arr, density, radialIntervals, numThetaIntervals):
+def diskMassAverage(arr, density, geometry):
     """
     return average of `arr` weighted by density
     """
-    if len(arr.shape) == 3:
-        numUsedTimeIntervals = len(arr)
-    else:
-        arr = np.array([arr])
-        numUsedTimeIntervals = 1
+    if len(arr.shape) == 2:
+        arr = arr[np.newaxis]
 
     arr = arr[:, 1:, :]
     density = density[:, 1:, :]
 
-    delta_r = np.ediff1d(radialIntervals)
-
-    delta_r_mat = _radialBroadcast(delta_r, numThetaIntervals, numUsedTimeIntervals)
-    r_mat = _radialBroadcast(radialIntervals[1:], numThetaIntervals, numUsedTimeIntervals)
-
-    r_delta_r = np.multiply(delta_r_mat, r_mat)
+    r_delta_r = geometry.centerRdr.reshape(-1, 1).astype(density.dtype)
     weightedArr = np.multiply(arr, density)
 
-    weightedSum = np.multiply(r_delta_r, weightedArr).sum(1).sum(1)
-    totalMass = np.multiply(r_delta_r, density).sum(1).sum(1)
+    weightedSum = np.multiply(r_delta_r, weightedArr).sum(1, dtype=ACCUMULATOR).sum(1)
+    totalMass = np.multiply(r_delta_r, density).sum(1, dtype=ACCUMULATOR).sum(1)
 
     return np.divide(weightedSum, totalMass)
 
-def radialDiskMassAverage(arr, dens, radialEdges, radialIntervals, numThetaIntervals):
-    numUsedTimeIntervals = len(dens)
+def _ringMassAverage(arr, azimuthalDensity, totalMass, geometry):
+    weighted = np.multiply(geometry.rdr, np.multiply(azimuthalDensity, arr)).sum(1)
 
-    d_theta = 2.*math.pi / numThetaIntervals
+    return np.divide(weighted, totalMass)
 
-    sumRadialDens = dens.sum(2) * d_theta
-    sumRadialWeights = np.multiply(sumRadialDens, arr)
+def radialDiskMassAverage(arr, dens, geometry):
+    azimuthalDensity = dens.sum(2, dtype=ACCUMULATOR) * geometry.dtheta
 
-    delta_r = np.ediff1d(radialEdges)
+    return _ringMassAverage(arr, azimuthalDensity, _ringTotalMass(azimuthalDensity, geometry), geometry)
 
-    dr_mat = np.array([delta_r] * numUsedTimeIntervals)
-    r_mat = np.array([radialIntervals] * numUsedTimeIntervals)
+def _ringTotalMass(azimuthalDensity, geometry):
+    return np.multiply(geometry.rdr, azimuthalDensity).sum(1)
 
-    r_dr = np.multiply(dr_mat, r_mat)
+def computeTotalMass(dens, geometry):
+    return _ringTotalMass(dens.sum(2, dtype=ACCUMULATOR) * geometry.dtheta, geometry)
 
-    weighted = np.multiply(r_dr, sumRadialWeights).sum(1)
 
-    totalMass = np.multiply(r_dr, sumRadialDens).sum(1)
+"""
+dependency graph of the diagnostics. every node -- a diagnostic or an intermediate shared by
+several of them -- is registered with @node under a name, with the names of the nodes it is
+computed from as its arguments. evaluate() computes the nodes asked for in dependency order,
+each at most once per batch, so e.g. the azimuthal density sum is taken once however many
+diagnostics use it. the leaves are the batch's INPUTS.
 
-    return np.divide(weighted, totalMass)
+a new diagnostic only has to be registered here (and listed in DIAGNOSTICS, if computeDiagnostics
+should return it by default) to reuse every intermediate already in the graph
+"""
 
-def computeTotalMass(dens, radialEdges, radialIntervals, numThetaIntervals):
-    numUsedTimeIntervals = len(dens)
-    
-    d_theta = 2.*math.pi / numThetaIntervals
-    
-    sumRadialDens = dens.sum(2) * d_theta
-    
-    delta_r = np.ediff1d(radialEdges)
-    
-    dr_mat = np.array([delta_r] * numUsedTimeIntervals)
-    r_mat = np.array([radialIntervals] * numUsedTimeIntervals)
-    
-    r_dr = np.multiply(dr_mat, r_mat)
-    
-    return np.multiply(r_dr, sumRadialDens).sum(1)
-
-def computeDiagnostics(radialEdges, radialIntervals, thetaIntervals, dens, vr, vtheta):
-    diags = _computeCellDiagnostics(radialIntervals, thetaIntervals, vr, vtheta)
-    radialEccMK = _azimuthalMassAverage(diags['cellEccentricity'], dens)
-    radialPeriMK = _azimuthalMassAverage(diags['cellPeriastron'], dens)
-
-    lubowDiagnostics = _lubowDiagnostics(radialIntervals, thetaIntervals, dens, vr, vtheta)
-    radialEccLubow = lubowDiagnostics['radialEccLubow']
-    radialPeriLubow = lubowDiagnostics['radialPeriLubow']
-    radialLubowVsin = lubowDiagnostics['lubowVsin']
-    radialLubowVcos = lubowDiagnostics['lubowVcos']
-
-    numThetaIntervals = len(thetaIntervals)
-    diskEccMK = diskMassAverage(diags['cellEccentricity'], dens, radialIntervals, numThetaIntervals)
-    diskPeriMK = diskMassAverage(diags['cellPeriastron'], dens, radialIntervals, numThetaIntervals)
-
-    radialDens = 2.0 * radialIntervals * math.pi / numThetaIntervals * dens.sum(2)
-
-    totalMass = computeTotalMass(dens, radialEdges, radialIntervals, numThetaIntervals)
-
-    diskEccLubow = radialDiskMassAverage(radialEccLubow, dens, radialEdges, radialIntervals, numThetaIntervals)
-    diskPeriLubow = radialDiskMassAverage(radialPeriLubow, dens, radialEdges, radialIntervals, numThetaIntervals)
-
-    lubowVsin = radialDiskMassAverage(radialLubowVsin, dens, radialEdges, radialIntervals, numThetaIntervals)
-    lubowVcos = radialDiskMassAverage(radialLubowVcos, dens, radialEdges, radialIntervals, numThetaIntervals)
-
-    diskRadii = diskRadius(dens, radialEdges, radialIntervals)
-    diskRad90 = diskRadii['diskRadii90']
-    diskRad95 = diskRadii['diskRadii95']
-
-    print "totalmass: " + str(totalMass)
+INPUTS = ('geometry', 'dens', 'vr', 'vtheta', 'mkEngine')
 
-    return {
-        "radialEccMK": radialEccMK,
-        "radialPeriMK": radialPeriMK,
-        "radialEccLubow": radialEccLubow,
-        "radialPeriLubow": radialPeriLubow,
-
-        "radialDens": radialDens,
-        "diskEccMK": diskEccMK,
-        "diskPeriMK": diskPeriMK,
-        "diskEccLubow": diskEccLubow,
-        "diskPeriLubow": diskPeriLubow,
-        "totalMass": totalMass,
-
-        "diskRad90": diskRad90,
-        "diskRad95": diskRad95,
-
-        "lubowVsin": lubowVsin,
-        "lubowVcos": lubowVcos
-    }
\ No newline at end of file
+NODES = {}
+
+def node(name, *inputs):
+    """
+    register the decorated function as node `name`, computed from the nodes `inputs`
+    """
+    def register(function):
+        NODES[name] = (inputs, function)
+        return function
+    return register
+
+# the diagnostics computeDiagnostics returns by default
+DIAGNOSTICS = ['radialEccMK', 'radialPeriMK', 'radialEccLubow', 'radialPeriLubow', 'radialDens',
+               'diskEccMK', 'diskPeriMK', 'diskEccLubow', 'diskPeriLubow', 'totalMass',
+               'diskRad90', 'diskRad95', 'lubowVsin', 'lubowVcos']
+
+
+def dependencies(names):
+    """
+    every node and input that evaluating `names` touches, including `names`
+    """
+    found = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        if name not in NODES and name not in INPUTS:
+            raise KeyError('unknown diagnostic ' + name)
+        found.add(name)
+        if name in NODES:
+            pending.extend(NODES[name][0])
+
+    return found
+
+
+def evaluate(names, values):
+    """
+    compute the nodes `names` from `values`, a dict holding the INPUTS they depend on. every
+    intermediate is stored in `values` as it is computed, and reused from there.
+    returns a dict of `names`
+    """
+    def resolve(name, visiting):
+        if name in values:
+            return values[name]
+        if name not in NODES:
+            raise KeyError('no value for ' + name)
+        if name in visiting:
+            raise ValueError('dependency cycle through ' + name)
+
+        inputs, function = NODES[name]
+        visiting.add(name)
+        args = [resolve(dependency, visiting) for dependency in inputs]
+        visiting.discard(name)
+
+        values[name] = function(*args)
+        return values[name]
+
+    return dict((name, resolve(name, set())) for name in names)
+
+
+# shared intermediates
+
+@node('radialDensitySum', 'dens')
+def _radialDensitySum(dens):
+    return dens.sum(2, dtype=ACCUMULATOR)
+
+@node('azimuthalDensity', 'geometry', 'radialDensitySum')
+def _azimuthalDensity(geometry, radialDensitySum):
+    return radialDensitySum * geometry.dtheta
+
+@node('mk', 'mkEngine', 'dens', 'vr', 'vtheta', 'radialDensitySum')
+def _mk(mkEngine, dens, vr, vtheta, radialDensitySum):
+    return mkEngine.compute(dens, vr, vtheta, radialDensity=radialDensitySum)
+
+# the Lubow diagnostics only use vtheta
+@node('lubow', 'geometry', 'dens', 'vtheta', 'radialDensitySum')
+def _lubow(geometry, dens, vtheta, radialDensitySum):
+    return _lubowDiagnostics(geometry, dens, None, vtheta, radialDensitySum)
+
+@node('diskRadii', 'dens', 'geometry', 'radialDensitySum')
+def _diskRadii(dens, geometry, radialDensitySum):
+    return diskRadius(dens, geometry, radialDensitySum)
+
+
+# diagnostics
+
+def _selectNode(name, source, key):
+    node(name, source)(lambda values: values[key])
+
+for _name in ['radialEccMK', 'radialPeriMK', 'diskEccMK', 'diskPeriMK']:
+    _selectNode(_name, 'mk', _name)
+
+for _name in ['radialEccLubow', 'radialPeriLubow']:
+    _selectNode(_name, 'lubow', _name)
+_selectNode('radialLubowVsin', 'lubow', 'lubowVsin')
+_selectNode('radialLubowVcos', 'lubow', 'lubowVcos')
+
+_selectNode('diskRad90', 'diskRadii', 'diskRadii90')
+_selectNode('diskRad95', 'diskRadii', 'diskRadii95')
+
+@node('radialDens', 'geometry', 'radialDensitySum')
+def _radialDens(geometry, radialDensitySum):
+    return 2.0 * geometry.radialIntervals * math.pi / geometry.numThetaIntervals * radialDensitySum
+
+@node('totalMass', 'azimuthalDensity', 'geometry')
+def _totalMass(azimuthalDensity, geometry):
+    return _ringTotalMass(azimuthalDensity, geometry)
+
+def _ringAverageNode(name, radialName):
+    @node(name, radialName, 'azimuthalDensity', 'totalMass', 'geometry')
+    def average(arr, azimuthalDensity, totalMass, geometry):
+        return _ringMassAverage(arr, azimuthalDensity, totalMass, geometry)
+
+_ringAverageNode('diskEccLubow', 'radialEccLubow')
+_ringAverageNode('diskPeriLubow', 'radialPeriLubow')
+_ringAverageNode('lubowVsin', 'radialLubowVsin')
+_ringAverageNode('lubowVcos', 'radialLubowVcos')
+
+
+def computeDiagnostics(geometry, dens, vr, vtheta, mkEngine=None, precision=None, names=None):
+    """
+    compute the radial and disk diagnostics `names` (by default every one in DIAGNOSTICS) for a
+    batch, through the dependency graph above. pass the same mkEngine for every batch of a run
+    so that its workspace buffers are reused. vr and vtheta may be None if no diagnostic asked
+    for needs them.
+    precision ('double' or 'single') converts the fields first; by default they are used at
+    the precision they were read with. see the note at the top of this module for error bounds.
+    timed as the 'diagnostics' stage of perfMonitor.monitor
+    """
+    with monitor.stage('diagnostics', numSnapshots=len(dens)):
+        return _computeDiagnostics(geometry, dens, vr, vtheta, mkEngine, precision, names)
+
+def _computeDiagnostics(geometry, dens, vr, vtheta, mkEngine, precision, names):
+    if precision is not None:
+        dens, vr, vtheta = [None if field is None else np.asarray(field, dtype=precision)
+                            for field in (dens, vr, vtheta)]
+
+    if names is None:
+        names = DIAGNOSTICS
+
+    if mkEngine is None and 'mkEngine' in dependencies(names):
+        mkEngine = MuellerKleyEngine(geometry)
+
+    values = {'geometry': geometry, 'dens': dens, 'vr': vr, 'vtheta': vtheta, 'mkEngine': mkEngine}
+    diagnostics = evaluate(names, values)
+
+    if 'totalMass' in diagnostics:
+        print "totalmass: " + str(diagnostics['totalMass'])
+
+    return diagnostics
@@ -1,10 +1,18 @@
 __author__ = 'cguo'
 
 import numpy as np
+from snapshotStore import SnapshotStore
+from snapshotPyramid import SnapshotPyramid
+from planetTables import loadTable
+from perfMonitor import monitor
 import glob
 import re
 import math
 import logging
+import os
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 class FargoParser:
     """
@@ -13,38 +21,115 @@ class FargoParser:
                   'timeIntervals', 'maxRadius', 'totalNumOutputs']
 
     methods:
-    FargoParser(outputDirectory, batchSize): creates parser, reads run parameters
+    FargoParser(outputDirectory, batchSize, prefetchDepth=0, maxPrefetchBytes=None, start=0, stop=None, stride=1,
+                readThreads=0, precision='double', level=0, variables=None):
+        creates parser, reads run parameters. with prefetchDepth > 0, batches are read ahead on a background
+        thread, at most prefetchDepth batches (and at most maxPrefetchBytes bytes of them) ahead of the caller,
+        counting the one being read. a maxPrefetchBytes below one batch disables read-ahead.
+        start, stop and stride are passed to select().
+        with readThreads > 0, the files of a batch (all three variables) are read concurrently by that many
+        threads, with readinto straight into preallocated (batchSize, nr, ns) arrays. getNextBatch then reuses
+        those arrays from one batch to the next, so a batch is only valid until the following getNextBatch
+        call; getBatch always returns new arrays. when prefetching, a ring of depth + 1 sets of arrays is used,
+        depth being prefetchDepth after the maxPrefetchBytes cap: the batches read ahead plus the one the
+        caller holds.
+        with precision='single', gas fields are converted to float32 as they are read, halving batch memory;
+        see fargoDiagnostics for the effect on the diagnostics.
+        level > 0 reads level `level` of the run's SnapshotPyramid (coarsened 2^level times in r and theta)
+        instead of the full-resolution outputs; run parameters then describe the coarse grid, with the
+        centres of its cells as the pyramid recorded them.
+        variables, a subset of gasVarTypes, restricts the batches to the gas variables a caller needs: the
+        others are never read, and are None in the batch tuples
 
     getParams(): returns a dict of params : param value, for each param in paramNames above
 
-    getNextBatch(): returns a three-tuple of (density, vr, vtheta) for the next batch
+    getNextBatch(): returns a three-tuple of (density, vr, vtheta) for the next batch, with None in place
+                    of variables left out of `variables`
 
     hasRemainingBatches(): returns True iff there are batches left
+
+    select(start=0, stop=None, stride=1): restricts the parser to outputs start, start + stride, ... < stop.
+        batches, seek and getBatch then count positions within the selection, and outputs outside it
+        are never opened. without a selection, positions are output indices
+
+    getSelectedIndices(startPosition=0, endPosition=None): output indices of a range of positions
+
+    getSelectedPaths(varType, startPosition=0, endPosition=None): gas files of a range of positions
+
+    seek(position): moves the getNextBatch cursor to `position` in the selection
+
+    getBatch(startPosition, endPosition): returns a three-tuple of (density, vr, vtheta) for positions
+                                          [startPosition, endPosition), independently of the getNextBatch cursor
+
+    getStore(varType): returns the memory-mapped SnapshotStore for "dens", "vrad" or "vtheta",
+                       indexable as store[time, r, theta]
+
+    reads are timed as the 'read' stage of perfMonitor.monitor, and time spent waiting on the
+    prefetch queue as 'readWait'. per-file messages are only logged at DEBUG level, which is off
+    unless enabled with logging.getLogger('').setLevel(logging.DEBUG)
     """
 
-    logging.basicConfig(level=logging.DEBUG, filename='parserDiagnostics.log', filemode='a')
+    gasVarTypes = ['dens', 'vrad', 'vtheta']
+
+    logging.basicConfig(level=logging.INFO, filename='parserDiagnostics.log', filemode='a')
     console = logging.StreamHandler()
     console.setLevel(logging.DEBUG)
     logging.getLogger('').addHandler(console)
 
-    def __init__(self, outputDir, batchSize=100):
+    def __init__(self, outputDir, batchSize=100, prefetchDepth=0, maxPrefetchBytes=None, start=0, stop=None, stride=1,
+                 readThreads=0, precision='double', level=0, variables=None):
         if outputDir.endswith('/'):
             outputDir = outputDir[:-1]
 
+        self.runDir = outputDir
+        self.level = level
+        if level > 0:
+            outputDir = SnapshotPyramid.levelDirectory(outputDir, level)
+            if not os.path.isdir(outputDir):
+                raise IOError('pyramid level ' + str(level) + ' of ' + self.runDir +
+                              ' has not been built; run snapshotPyramid.py first')
+            logging.info("reading pyramid level " + str(level))
+
         self.outputDir = outputDir
         self._readRunParams()
 
         self.batchSize = batchSize
         self.startIndex = 0
+        self.dtype = np.dtype(precision)
+
+        if variables is None:
+            variables = self.gasVarTypes
+        unknown = set(variables) - set(self.gasVarTypes)
+        if unknown or not variables:
+            raise ValueError('variables must be a non-empty subset of ' + ', '.join(self.gasVarTypes))
+        self.variables = [varType for varType in self.gasVarTypes if varType in variables]
+
+        self.prefetchDepth = prefetchDepth
+        self.maxPrefetchBytes = maxPrefetchBytes
+        self._prefetchQueue = None
+        self._prefetchThread = None
+        self._prefetchSlots = None
+        self._stopPrefetch = threading.Event()
+        self._warnedPrefetchCap = False
+
+        self.readThreads = readThreads
+        self._readPool = None
+        self._batchBuffers = []
+        self._nextBuffer = 0
 
         self.sortedPaths = {}
+        self.stores = {}
 
-        gasVarTypes = ["dens", "vrad", "vtheta"]
-        for varType in gasVarTypes:
+        for varType in self.gasVarTypes:
             fileFormat = "gas" + varType + "*.dat"
 
             filePaths = glob.glob(self._pathTo(fileFormat))
             self.sortedPaths[varType] = sorted(filePaths, key=self._extractFileIndex)
+            self.stores[varType] = SnapshotStore(self.sortedPaths[varType],
+                                                 self.numRadialIntervals, self.numThetaIntervals,
+                                                 outDtype=self.dtype)
+
+        self.select(start, stop, stride)
 
 
     def _pathTo(self, endPath):
@@ -74,8 +159,17 @@ class FargoParser:
 
         self.thetaIntervals = np.linspace(0, 2*math.pi, num=self.numThetaIntervals)
 
-        planetData = np.loadtxt(self._pathTo("orbit0.dat"))
-        self.timeIntervals = planetData[:, 0]
+        if self.level > 0:
+            # the centres of merged cells, which the edges and counts above do not determine
+            try:
+                self.radialIntervals = np.loadtxt(self._pathTo(SnapshotPyramid.radialIntervalsName), ndmin=1)
+                self.thetaIntervals = np.loadtxt(self._pathTo(SnapshotPyramid.thetaIntervalsName), ndmin=1)
+            except IOError:
+                raise IOError('pyramid level ' + str(self.level) + ' of ' + self.runDir +
+                              ' has no cell centres; rerun snapshotPyramid.py to add them')
+
+        # a copy, as the params are pickled for pool workers
+        self.timeIntervals = np.array(loadTable(self._pathTo("orbit0.dat"))[:, 0])
 
         filePaths = glob.glob(self._pathTo('gasdens*.dat'))
         self.totalNumOutputs = len(filePaths)
@@ -87,7 +181,7 @@ class FargoParser:
 
 
     def _extractFileIndex(self, filePath):
-        logging.info('extracting file index from ' + filePath)
+        logging.debug('extracting file index from ' + filePath)
         name = filePath.split('/')[-1]
         return int(re.search('[0-9]+', name).group(0))
 
@@ -96,55 +190,250 @@ class FargoParser:
         return self.outputDir + "/" + endpoint
 
 
+    def _selectionSlice(self, startPosition, endPosition):
+        """
+        slice of output indices covering positions [startPosition, endPosition) of the selection
+        """
+        first, _, stride = self.selection
+        return slice(first + startPosition * stride, first + endPosition * stride, stride)
+
+
     def _parseGasValue(self, varType, startIndex, endIndex):
         """
         :param varType: "dens", "vrad", or "vtheta"
+        :param startIndex, endIndex: range of positions in the selection
         :return:
         """
 
         logging.info("\n*** parsing values for gas" + varType + " ***\n")
 
-        arrays = []
-        for path in self.sortedPaths[varType][startIndex : endIndex]:
-            arr = np.fromfile(path, dtype='double')
-            print "array shape is " + str(arr.shape)
-            arr.shape = (self.numRadialIntervals, self.numThetaIntervals)
-            arrays.append(arr)
+        store = self.stores[varType]
+        with monitor.stage('read') as stage:
+            ret = store[self._selectionSlice(startIndex, endIndex)]
 
-            logging.info("parsed gas output file: " + path.split('/')[-1])
-            logging.info("with shape: " + str(arr.shape))
+            stage.numBytes = len(ret) * store.dtype.itemsize * self.numRadialIntervals * self.numThetaIntervals
+            # an output counts as one snapshot, on the first variable read
+            if varType == self.variables[0]:
+                stage.numSnapshots = len(ret)
 
-        ret = np.array(arrays)
+        logging.info("parsed gas" + varType + " files " + str(startIndex) + " to " + str(endIndex) +
+                     " with shape: " + str(ret.shape))
 
+        return ret
 
 
-        return ret
+    def _allocateBatch(self, numRows):
+        shape = (numRows, self.numRadialIntervals, self.numThetaIntervals)
+        return tuple(np.empty(shape, dtype=self.dtype) if varType in self.variables else None
+                     for varType in self.gasVarTypes)
 
 
-    def _parseGasOutput(self, startIndex, endIndex):
+    def _reusableBatch(self, ringSize):
+        """
+        next set of preallocated batch arrays, cycling through a ring of ringSize sets
+        """
+        while len(self._batchBuffers) < ringSize:
+            self._batchBuffers.append(self._allocateBatch(self.batchSize))
+
+        buffers = self._batchBuffers[self._nextBuffer % ringSize]
+        self._nextBuffer += 1
+        return buffers
+
+
+    def _readConcurrently(self, startIndex, endIndex, buffers):
+        """
+        fill buffers[v][:n] with the n files of each variable in positions [startIndex, endIndex),
+        issuing every read of the batch at once on the read thread pool
+        """
+        if self._readPool is None:
+            self._readPool = ThreadPool(self.readThreads)
+
+        indices = range(*self._selectionSlice(startIndex, endIndex).indices(self.totalNumOutputs))
+        out = tuple(None if buf is None else buf[:len(indices)] for buf in buffers)
+
+        reads = [(self.stores[varType], ix, out[v][k])
+                 for v, varType in enumerate(self.gasVarTypes) if varType in self.variables
+                 for k, ix in enumerate(indices)]
+        frameBytes = self.stores['dens'].dtype.itemsize * self.numRadialIntervals * self.numThetaIntervals
+        with monitor.stage('read', len(reads) * frameBytes, len(indices)):
+            self._readPool.map(lambda read: read[0].readInto(read[1], read[2]), reads, chunksize=1)
+
+        logging.info("read gas files " + str(startIndex) + " to " + str(endIndex) + " on " +
+                     str(self.readThreads) + " threads")
+        return out
+
+
+    def _parseGasOutput(self, startIndex, endIndex, buffers=None):
         """
         read and parse gas density, vrad, vtheta
-        :return: tuple of (gasdens, gasvrad, gasvtheta)
+        :param buffers: with readThreads > 0, preallocated arrays to read into; new ones if None
+        :return: tuple of (gasdens, gasvrad, gasvtheta), None for variables not in self.variables
         """
 
-        varTypes = ['dens', 'vrad', 'vtheta']
+        if self.readThreads > 0:
+            if buffers is None:
+                buffers = self._allocateBatch(endIndex - startIndex)
+            return (arr for arr in self._readConcurrently(startIndex, endIndex, buffers))
 
-        return (self._parseGasValue(varType, startIndex, endIndex) for varType in varTypes)
+        return (self._parseGasValue(varType, startIndex, endIndex) if varType in self.variables else None
+                for varType in self.gasVarTypes)
 
 
     def getParams(self):
         return self.params
 
 
+    def getStore(self, varType):
+        return self.stores[varType]
+
+
+    def select(self, start=0, stop=None, stride=1):
+        if stride < 1:
+            raise ValueError('stride must be a positive integer')
+
+        self.stopPrefetch()
+
+        # normalized (first, stop, stride) of the selected output indices
+        self.selection = slice(start, stop, stride).indices(self.totalNumOutputs)
+        self.numSelected = len(xrange(*self.selection))
+        self.startIndex = 0
+
+
+    def getSelectedIndices(self, startPosition=0, endPosition=None):
+        if endPosition is None:
+            endPosition = self.numSelected
+        return np.arange(*self.selection)[startPosition:endPosition]
+
+
+    def getSelectedPaths(self, varType, startPosition=0, endPosition=None):
+        if endPosition is None:
+            endPosition = self.numSelected
+        return self.stores[varType].paths[self._selectionSlice(startPosition, endPosition)]
+
+
     def hasRemainingBatches(self):
-        return (self.totalNumOutputs - self.startIndex) > 0
+        return (self.numSelected - self.startIndex) > 0
+
+
+    def _batchBytes(self):
+        itemSize = self.dtype.itemsize
+        return len(self.variables) * self.batchSize * self.numRadialIntervals * self.numThetaIntervals * itemSize
+
+
+    def _effectivePrefetchDepth(self):
+        depth = self.prefetchDepth
+        if self.maxPrefetchBytes is not None:
+            depth = min(depth, self.maxPrefetchBytes // self._batchBytes())
+            if depth < 1 <= self.prefetchDepth and not self._warnedPrefetchCap:
+                self._warnedPrefetchCap = True
+                logging.warning("a batch of " + str(self._batchBytes()) + " bytes exceeds the read-ahead cap of " +
+                                str(self.maxPrefetchBytes) + " bytes; reading serially")
+
+        return max(0, depth)
+
+
+    def _prefetchBatches(self, startIndex, ringSize):
+        """
+        background thread body: read batches from startIndex onwards and queue them as
+        tuples of (density, vr, vtheta). an exception is queued in place of a batch and
+        re-raised by getNextBatch
+        """
+        try:
+            while startIndex < self.numSelected and not self._stopPrefetch.is_set():
+                # a slot is freed each time the caller takes a batch, so that queued batches and the
+                # one being read never exceed the prefetch depth
+                while not self._prefetchSlots.acquire(False):
+                    if self._stopPrefetch.wait(0.01):
+                        return
+
+                endIndex = min(startIndex + self.batchSize, self.numSelected)
+                buffers = self._reusableBatch(ringSize) if self.readThreads > 0 else None
+                batch = tuple(self._parseGasOutput(startIndex, endIndex, buffers))
+                startIndex = endIndex
+
+                self._prefetchQueue.put(batch)
+        except Exception as e:
+            self._prefetchQueue.put(e)
+
+
+    def _startPrefetch(self, startIndex, depth):
+        logging.info("prefetching up to " + str(depth) + " batches")
+
+        self._stopPrefetch.clear()
+        self._prefetchQueue = Queue.Queue()
+        self._prefetchSlots = threading.Semaphore(depth)
+        # batches read ahead, plus the one the caller is still using
+        ringSize = depth + 1
+        self._prefetchThread = threading.Thread(target=self._prefetchBatches, args=(startIndex, ringSize))
+        self._prefetchThread.daemon = True
+        self._prefetchThread.start()
+
+
+    def stopPrefetch(self):
+        """
+        stop the background reader, if any, and drop the batches it has queued
+        """
+        if self._prefetchThread is None:
+            return
+
+        self._stopPrefetch.set()
+        self._prefetchThread.join()
+        self._prefetchThread = None
+        self._prefetchQueue = None
+
+
+    def _takePrefetched(self):
+        batch = self._prefetchQueue.get()
+        self._prefetchSlots.release()
+        return batch
+
+
+    def seek(self, position):
+        """
+        move the getNextBatch cursor. read-ahead is kept when position is the cursor, or a later batch
+        boundary whose batch has already been read ahead (the batches before it are dropped);
+        otherwise it is stopped and restarts from position
+        """
+        skipped = position - self.startIndex
+        if self._prefetchThread is not None and skipped >= 0 and skipped % self.batchSize == 0 and \
+                skipped // self.batchSize <= self._prefetchQueue.qsize():
+            for _ in range(skipped // self.batchSize):
+                if isinstance(self._takePrefetched(), Exception):
+                    self.stopPrefetch()
+                    break
+        else:
+            self.stopPrefetch()
+
+        self.startIndex = position
+
+
+    def getBatch(self, startIndex, endIndex):
+        logging.info("\nreading batch from " + str(startIndex) + " to " + str(endIndex) + "\n")
+        return self._parseGasOutput(startIndex, endIndex)
 
 
     def getNextBatch(self):
         # read files in [startIndex, endIndex)
         startIndex = self.startIndex
-        endIndex = min(self.startIndex + self.batchSize, self.totalNumOutputs)
+        endIndex = min(self.startIndex + self.batchSize, self.numSelected)
         self.startIndex = endIndex
 
-        logging.info("\nreading batch from " + str(startIndex) + " to " + str(endIndex) + "\n")
-        return self._parseGasOutput(startIndex, endIndex)
+        depth = self._effectivePrefetchDepth()
+        if depth <= 0 or startIndex >= self.numSelected:
+            # past the last batch this is the empty batch, as on the serial path; nothing is queued for it
+            if self.readThreads > 0:
+                logging.info("\nreading batch from " + str(startIndex) + " to " + str(endIndex) + "\n")
+                return self._parseGasOutput(startIndex, endIndex, self._reusableBatch(1))
+            return self.getBatch(startIndex, endIndex)
+
+        if self._prefetchThread is None:
+            self._startPrefetch(startIndex, depth)
+
+        with monitor.stage('readWait'):
+            batch = self._takePrefetched()
+        if isinstance(batch, Exception):
+            self.stopPrefetch()
+            raise batch
+
+        logging.info("\ntook prefetched batch from " + str(startIndex) + " to " + str(endIndex) + "\n")
+        return (arr for arr in batch)
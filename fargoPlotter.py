@@ -4,6 +4,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
+from perfMonitor import timed
 
 class FargoPlotter:
     """
@@ -14,6 +15,8 @@ class FargoPlotter:
     vsRadius(array, yName='', yDisplayLabel='', title='')
 
     vsTime(array, yName='', yDisplayLabel='', title='')
+
+    every plot is timed as the 'plot' stage of perfMonitor.monitor
     """
     def __init__(self, radialIntervals, timeIntervals, outputDir, radialLabel='', timeLabel=''):
         self.radialIntervals = radialIntervals
@@ -36,8 +39,12 @@ class FargoPlotter:
         return self.outputDir + fileName
 
 
+    # figure size of threePanelVsRadius, in inches
+    threePanelSize = (7, 11)
+
+    @timed('plot')
     def threePanelVsRadius(self, density, eccMK, eccLubow, periMK, periLubow, time, fname, index):
-        self._setFigsize((7, 11))
+        self._setFigsize(self.threePanelSize)
 
         fig = plt.figure()
 
@@ -71,6 +78,7 @@ class FargoPlotter:
 
         self._resetFigsize()
 
+    @timed('plot')
     def twoPanelVsTime(self, ecc, peri, fname):
         self._setFigsize((8, 12))
 
@@ -98,6 +106,7 @@ class FargoPlotter:
         self._resetFigsize()
 
 
+    @timed('plot')
     def vsRadius(self, array, yName='', yDisplayLabel='', title='', index='', ylim=None):
         fig = plt.figure()
         plt.semilogx(self.radialIntervals, array)
@@ -114,6 +123,7 @@ class FargoPlotter:
         plt.close(fig)
 
 
+    @timed('plot')
     def vsTime(self, array, yName='', yDisplayLabel='', title=''):
         plt.rcParams['figure.figsize'] = 9, 6
 
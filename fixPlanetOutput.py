@@ -1,9 +1,7 @@
 import numpy as np
+from planetTables import loadTable, DATE_COLUMN
 
 
 if __name__ == '__main__':
-    sec = np.loadtxt('bigplanet0.dat')
-    date = sec[:, -2]
-    _, ixs = np.unique(date, return_index=True)
-    newSec = sec[ixs]
+    newSec = loadTable('bigplanet0.dat', DATE_COLUMN)
     np.save('sec', newSec)
\ No newline at end of file
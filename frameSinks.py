@@ -0,0 +1,159 @@
+__author__ = 'cguo'
+
+from distutils.spawn import find_executable
+import numpy as np
+import subprocess
+import struct
+import zlib
+
+
+def canvasToRGBA(fig):
+    """
+    draw a figure on its Agg canvas and return the pixels as an (height, width, 4) uint8 array
+    """
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
+    return np.frombuffer(fig.canvas.buffer_rgba(), dtype=np.uint8).reshape(height, width, 4).copy()
+
+
+class FfmpegSink:
+    """
+    streams RGBA frames into a local ffmpeg process, which encodes them as H.264
+
+    methods:
+    FfmpegSink(path, fps=24)
+
+    write(rgba): rgba has shape (height, width, 4), the same for every frame
+
+    close(): waits for ffmpeg to finish writing the video
+    """
+
+    def __init__(self, path, fps=24):
+        self.path = path
+        self.fps = fps
+        self.process = None
+
+    def _start(self, width, height):
+        executable = find_executable('ffmpeg')
+        if executable is None:
+            raise IOError('ffmpeg not found on the PATH')
+
+        command = [executable, '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', str(width) + 'x' + str(height),
+                   '-r', str(self.fps), '-i', '-',
+                   # yuv420p needs even dimensions
+                   '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                   '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', self.path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, rgba):
+        if self.process is None:
+            height, width, _ = rgba.shape
+            self._start(width, height)
+
+        self.process.stdin.write(np.ascontiguousarray(rgba, dtype=np.uint8).tostring())
+
+    def close(self):
+        if self.process is None:
+            return
+
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError('ffmpeg failed while writing ' + self.path)
+
+
+class ApngSink:
+    """
+    writes RGBA frames into an animated PNG, in pure Python. each frame is compressed as it
+    arrives; only the frame count in the header is patched when the sink is closed
+
+    methods:
+    ApngSink(path, fps=24)
+
+    write(rgba): rgba has shape (height, width, 4), the same for every frame
+
+    close()
+    """
+
+    def __init__(self, path, fps=24):
+        self.path = path
+        self.fps = fps
+        self.file = None
+        self.numFrames = 0
+        self.sequence = 0
+
+    def _chunk(self, chunkType, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunkType + data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff))
+
+    def _start(self, width, height):
+        self.width = width
+        self.height = height
+
+        self.file = open(self.path, 'wb')
+        self.file.write('\x89PNG\r\n\x1a\n')
+        # 8 bit RGBA, no interlacing
+        self._chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+        # frame count is unknown until close(); remember where to patch it
+        self.actlOffset = self.file.tell()
+        self._chunk('acTL', struct.pack('>II', 0, 0))
+
+    def _compress(self, rgba):
+        # 'Up' filter on every row: each row stored as its difference from the row above
+        rows = rgba.reshape(self.height, self.width * 4)
+        filtered = np.empty((self.height, self.width * 4 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0]
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        return zlib.compress(filtered.tostring(), 6)
+
+    def write(self, rgba):
+        if self.file is None:
+            height, width, _ = rgba.shape
+            self._start(width, height)
+
+        # delay of 1/fps s; dispose none, blend source
+        self._chunk('fcTL', struct.pack('>IIIIIHHBB', self.sequence, self.width, self.height, 0, 0,
+                                        1, self.fps, 0, 0))
+        self.sequence += 1
+
+        data = self._compress(np.ascontiguousarray(rgba, dtype=np.uint8))
+        if self.numFrames == 0:
+            self._chunk('IDAT', data)
+        else:
+            self._chunk('fdAT', struct.pack('>I', self.sequence) + data)
+            self.sequence += 1
+
+        self.numFrames += 1
+
+    def close(self):
+        if self.file is None:
+            return
+
+        self._chunk('IEND', '')
+
+        self.file.seek(self.actlOffset)
+        self._chunk('acTL', struct.pack('>II', self.numFrames, 0))
+        self.file.close()
+        self.file = None
+
+
+def openFrameSink(path, fps=24, encoder='auto'):
+    """
+    return a sink writing to `path`. encoder is 'ffmpeg', 'apng', or 'auto' for ffmpeg
+    when it is on the PATH and the pure-Python APNG writer otherwise. the extension of
+    `path` is replaced to match the encoder
+    """
+    if encoder == 'auto':
+        encoder = 'ffmpeg' if find_executable('ffmpeg') else 'apng'
+
+    base = path.rsplit('.', 1)[0] if '.' in path.split('/')[-1] else path
+
+    if encoder == 'ffmpeg':
+        return FfmpegSink(base + '.mp4', fps)
+    if encoder == 'apng':
+        return ApngSink(base + '.png', fps)
+
+    raise ValueError('unknown encoder ' + encoder)
@@ -0,0 +1,108 @@
+__author__ = 'cguo'
+
+import numpy as np
+import math
+import copy
+
+
+class GridGeometry:
+    """
+    geometry of a Fargo2D polar grid. built once per run and shared by every diagnostic,
+    so that nothing has to materialize (numTimeIntervals, nr, ns) copies of r, theta or
+    the cell weights.
+
+    1-D attributes:
+    radialEdges (nr + 1), rInf, rSup, radialIntervals (cell-centre radii), dr (rSup - rInf),
+    rdr (radialIntervals * dr), centerDr (np.ediff1d(radialIntervals)), centerRdr (centerDr * radialIntervals[1:]),
+    thetaIntervals, sinTheta, cosTheta (ns), dtheta (scalar, 2 pi / ns)
+
+    broadcastable views, shaped to combine with (nr, ns) or (nt, nr, ns) arrays:
+    rCol, drCol, rInfCol, rSupCol (nr, 1); thetaRow, sinThetaRow, cosThetaRow (1, ns);
+    cellArea (nr, 1), the area of one cell in each ring; xCell, yCell (nr, ns), cell-centre coordinates
+
+    methods:
+    GridGeometry(radialEdges, numThetaIntervals, thetaIntervals=None, radialIntervals=None)
+
+    GridGeometry.fromParams(params): build from FargoParser.getParams()
+
+    GridGeometry.fromFile(usedRadPath, numThetaIntervals): build from a used_rad.dat file
+
+    astype(dtype): a copy whose broadcastable views are cast to dtype, so that arithmetic with (nr, ns)
+                   fields of that dtype is not promoted to double; the 1-D attributes stay double.
+                   cached per dtype; returns self for double
+    """
+
+    def __init__(self, radialEdges, numThetaIntervals, thetaIntervals=None, radialIntervals=None):
+        radialEdges = np.asarray(radialEdges, dtype='double')
+        n = len(radialEdges)
+
+        self.radialEdges = radialEdges
+        self.rInf = radialEdges[:n - 1]
+        self.rSup = radialEdges[1:]
+
+        if radialIntervals is None:
+            cube = lambda x: np.power(x, 3)
+            square = np.square
+            radialIntervals = np.multiply((2.0 / 3.0), ((cube(self.rSup) - cube(self.rInf)) /
+                                                        (square(self.rSup) - square(self.rInf))))
+
+        if thetaIntervals is None:
+            thetaIntervals = np.linspace(0, 2*math.pi, num=numThetaIntervals)
+
+        self.numRadialIntervals = n - 1
+        self.numThetaIntervals = numThetaIntervals
+
+        self.radialIntervals = np.asarray(radialIntervals, dtype='double')
+        self.thetaIntervals = np.asarray(thetaIntervals, dtype='double')
+        self.dtheta = 2 * math.pi / numThetaIntervals
+
+        self.dr = np.ediff1d(radialEdges)
+        self.rdr = np.multiply(self.dr, self.radialIntervals)
+
+        self.centerDr = np.ediff1d(self.radialIntervals)
+        self.centerRdr = np.multiply(self.centerDr, self.radialIntervals[1:])
+
+        self.sinTheta = np.sin(self.thetaIntervals)
+        self.cosTheta = np.cos(self.thetaIntervals)
+
+        self.rCol = self.radialIntervals.reshape(-1, 1)
+        self.drCol = self.dr.reshape(-1, 1)
+        self.rInfCol = self.rInf.reshape(-1, 1)
+        self.rSupCol = self.rSup.reshape(-1, 1)
+
+        self.thetaRow = self.thetaIntervals.reshape(1, -1)
+        self.sinThetaRow = self.sinTheta.reshape(1, -1)
+        self.cosThetaRow = self.cosTheta.reshape(1, -1)
+
+        self.cellArea = math.pi * (np.square(self.rSupCol) - np.square(self.rInfCol)) / numThetaIntervals
+
+        self.xCell = self.rCol * self.cosThetaRow
+        self.yCell = self.rCol * self.sinThetaRow
+
+        self._typed = {np.dtype('double'): self}
+
+    # broadcastable views converted by astype()
+    fieldViews = ['rCol', 'drCol', 'rInfCol', 'rSupCol', 'thetaRow', 'sinThetaRow', 'cosThetaRow',
+                  'cellArea', 'xCell', 'yCell']
+
+
+    def astype(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self._typed:
+            typed = copy.copy(self)
+            for name in self.fieldViews:
+                setattr(typed, name, getattr(self, name).astype(dtype))
+            self._typed[dtype] = typed
+
+        return self._typed[dtype]
+
+
+    @classmethod
+    def fromParams(cls, params):
+        return cls(params['radialEdges'], params['numThetaIntervals'],
+                   params['thetaIntervals'], params['radialIntervals'])
+
+
+    @classmethod
+    def fromFile(cls, usedRadPath, numThetaIntervals):
+        return cls(np.loadtxt(usedRadPath), numThetaIntervals)
@@ -1,25 +1,20 @@
 import numpy as np
+from gridGeometry import GridGeometry
+from planetTables import loadTable
+import kernels
 
 def main():
     nr, ns = 438, 574
-    radialEdges = np.loadtxt('used_rad.dat')
-    n = len(radialEdges)
-    r0 = radialEdges[:n - 1]
-    r1 = radialEdges[1:]
+    geometry = GridGeometry.fromFile('used_rad.dat', ns)
 
-    cube = lambda x: np.power(x, 3)
-    square = np.square
+    radIntervals = geometry.radialIntervals
+    rdiff = geometry.dr
 
-    radIntervals = np.multiply((2.0 / 3.0), ((cube(r1) - cube(r0)) / (square(r1) - square(r0))))
-    thetaIntervals = np.linspace(0, 2*np.pi, 574)
-    rdiff = np.ediff1d(radialEdges)
+    # (nr, 1) and (1, ns) views broadcast against (nr, ns) snapshots
+    r = geometry.rCol
+    theta = geometry.thetaRow
 
-    rmat = np.array([radIntervals] * ns).transpose()
-    drmat = np.array([rdiff]*ns).transpose()
-
-    theta, r = np.meshgrid(thetaIntervals, radIntervals)
-
-    sec = np.loadtxt('bigplanet0.dat')
+    sec = loadTable('bigplanet0.dat')
     secx = sec[:, 1]
     secy = sec[:, 2]
     secr = np.sqrt(np.square(secx)+np.square(secy))[::20]
@@ -52,7 +47,9 @@ def main():
     np.save('parsedDiagnostics/momLostInner', momLost)
 
 def specificAngMom(secr, sect, r, theta, vr, vtheta):
-    m = 0.2857
+    return kernels.run('specificAngMom', _specificAngMom, 0.2857, secr, sect, r, theta, vr, vtheta)
+
+def _specificAngMom(m, secr, sect, r, theta, vr, vtheta):
     psi = theta - sect
 
     a = m/(1.+m)
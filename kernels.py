@@ -0,0 +1,371 @@
+__author__ = 'cguo'
+
+import numpy as np
+import math
+import os
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+"""
+pluggable backends for the elementwise kernels of the diagnostics: the Mueller-Kley cell
+eccentricity and its averages, the cell torque density and total torque of tqAnalysis and the
+specific angular momentum of innerBoundaryMomentumLoss. numpy evaluates each of them as a
+chain of whole-array passes; with numba installed they run as single-pass, multithreaded
+compiled loops that fuse the reductions, and with numexpr as fused multithreaded expressions
+(one snapshot at a time) followed by numpy reductions.
+
+callers keep their numpy code and dispatch through
+    kernels.run(name, numpyFunction, *args)
+which calls the active backend's implementation of `name` with args, or numpyFunction(*args)
+when the backend has none (or declines these arguments by returning NotImplemented). with
+crossCheck every accelerated call is repeated with numpy and a ValueError is raised if the two
+disagree by more than the tolerance, relative to the largest magnitude of the numpy result.
+
+the backend is 'auto' by default (numba, else numexpr, else numpy), or the FARGO_KERNELS
+environment variable. pool workers are forked, so they inherit the parent's setting. numba
+compiles each kernel on its first call (cached on disk afterwards) and runs it on
+NUMBA_NUM_THREADS threads; numexpr uses NUMEXPR_MAX_THREADS
+"""
+
+BACKENDS = ['numpy', 'numexpr', 'numba']
+
+_modules = {'numpy': np, 'numexpr': numexpr, 'numba': numba}
+
+# backend -> kernel name -> implementation
+_kernels = dict((backend, {}) for backend in BACKENDS)
+
+_state = {'backend': 'numpy', 'crossCheck': False, 'tolerance': None}
+
+
+def available():
+    return [backend for backend in BACKENDS if _modules[backend] is not None]
+
+
+def setBackend(name='auto', crossCheck=False, tolerance=None):
+    """
+    select the backend by name, or 'auto' for the fastest one installed. tolerance is the
+    relative disagreement crossCheck accepts; by default 1e-9 for double and 1e-5 for single
+    precision arguments, as the Mueller-Kley cell terms are then float32 on every backend and
+    round differently from one to the next (by ~2e-8 on the synthetic runs of fakeFargoRun.py)
+    """
+    if name == 'auto':
+        name = available()[-1]
+    elif name not in BACKENDS:
+        raise ValueError('unknown kernel backend ' + name + '; choose from auto, ' + ', '.join(BACKENDS))
+    elif name not in available():
+        raise ValueError('kernel backend ' + name + ' is not installed')
+
+    _state.update(backend=name, crossCheck=crossCheck, tolerance=tolerance)
+
+
+def backend():
+    return _state['backend']
+
+
+def register(name, backend):
+    def decorator(function):
+        _kernels[backend][name] = function
+        return function
+    return decorator
+
+
+def run(name, numpyFunction, *args):
+    implementation = _kernels[_state['backend']].get(name)
+    if implementation is None:
+        return numpyFunction(*args)
+
+    result = implementation(*args)
+    if result is NotImplemented:
+        return numpyFunction(*args)
+
+    if _state['crossCheck']:
+        _compare(name, result, numpyFunction(*args), _tolerance(args))
+
+    return result
+
+
+def _tolerance(args):
+    if _state['tolerance'] is not None:
+        return _state['tolerance']
+
+    single = any(isinstance(arg, np.ndarray) and arg.dtype == np.float32 for arg in args)
+    return 1e-5 if single else 1e-9
+
+
+def _compare(name, result, expected, tolerance):
+    if isinstance(expected, dict):
+        pairs = [(name + '[' + key + ']', result[key], expected[key]) for key in sorted(expected)]
+    else:
+        pairs = [(name, result, expected)]
+
+    for label, value, reference in pairs:
+        value = np.asarray(value, dtype='double')
+        reference = np.asarray(reference, dtype='double')
+
+        if value.shape != reference.shape or not np.array_equal(np.isnan(value), np.isnan(reference)):
+            raise ValueError('kernel ' + label + ' on backend ' + _state['backend'] +
+                             ' does not match numpy in shape or NaNs')
+
+        scale = np.nanmax(np.absolute(reference)) if reference.size else 0.
+        error = np.nanmax(np.absolute(value - reference)) if reference.size else 0.
+        if error > tolerance * max(scale, np.finfo('double').tiny):
+            raise ValueError('kernel ' + label + ' on backend ' + _state['backend'] +
+                             ' differs from numpy by ' + str(error) + ' against a scale of ' + str(scale))
+
+
+"""
+Mueller-Kley eccentricity: (geometry, dens, vr, vtheta, radialDensity) -> the dict of
+MuellerKleyEngine.compute. the per-cell eccentricity and periastron are evaluated in the
+precision of vr and vtheta, in the same order of operations as the engine; the sums are double
+"""
+def _muellerKleyAverages(geometry, eccSum, periSum, massSum, radialDensity):
+    if radialDensity is None:
+        radialDensity = massSum
+
+    # disk averages skip the innermost ring and weight by r * dr between cell centres
+    weights = geometry.centerRdr
+    totalMass = massSum[:, 1:].dot(weights)
+
+    return {
+        "radialEccMK": eccSum / radialDensity,
+        "radialPeriMK": periSum / radialDensity,
+        "diskEccMK": eccSum[:, 1:].dot(weights) / totalMass,
+        "diskPeriMK": periSum[:, 1:].dot(weights) / totalMass
+    }
+
+
+if numexpr is not None:
+    _eccentricityX = 'r * vt * (vr * s + vt * c) - c'
+    _eccentricityY = 'r * vt * (vt * s - vr * c) - s'
+
+    @register('muellerKley', 'numexpr')
+    def _muellerKleyNumexpr(geometry, dens, vr, vtheta, radialDensity):
+        nt, nr, ns = vr.shape
+        typed = geometry.astype(np.result_type(vr, vtheta))
+        variables = {'r': typed.rCol, 's': typed.sinThetaRow, 'c': typed.cosThetaRow}
+
+        eccSum = np.empty((nt, nr))
+        periSum = np.empty((nt, nr))
+        massSum = np.empty((nt, nr))
+
+        for t in range(nt):
+            variables.update(vr=vr[t], vt=vtheta[t])
+            ex = numexpr.evaluate(_eccentricityX, local_dict=variables)
+            ey = numexpr.evaluate(_eccentricityY, local_dict=variables)
+
+            components = {'ex': ex, 'ey': ey}
+            ecc = numexpr.evaluate('sqrt(ex * ex + ey * ey)', local_dict=components)
+            peri = numexpr.evaluate('arctan2(ey, ex)', local_dict=components)
+
+            eccSum[t] = np.einsum('ij,ij->i', ecc, dens[t], dtype='double')
+            periSum[t] = np.einsum('ij,ij->i', peri, dens[t], dtype='double')
+            massSum[t] = np.sum(dens[t], 1, dtype='double')
+
+        return _muellerKleyAverages(geometry, eccSum, periSum, massSum, radialDensity)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _muellerKleySums(dens, vr, vtheta, r, sinTheta, cosTheta):
+        nt, nr, ns = vr.shape
+        eccSum = np.empty((nt, nr))
+        periSum = np.empty((nt, nr))
+        massSum = np.empty((nt, nr))
+
+        for row in numba.prange(nt * nr):
+            t = row // nr
+            i = row % nr
+
+            ecc = 0.
+            peri = 0.
+            mass = 0.
+            for j in range(ns):
+                vrCell = vr[t, i, j]
+                vtCell = vtheta[t, i, j]
+                rvt = r[i] * vtCell
+
+                ex = rvt * (vrCell * sinTheta[j] + vtCell * cosTheta[j]) - cosTheta[j]
+                ey = rvt * (vtCell * sinTheta[j] - vrCell * cosTheta[j]) - sinTheta[j]
+
+                d = float(dens[t, i, j])
+                ecc += float(np.sqrt(ex * ex + ey * ey)) * d
+                peri += float(np.arctan2(ey, ex)) * d
+                mass += d
+
+            eccSum[t, i] = ecc
+            periSum[t, i] = peri
+            massSum[t, i] = mass
+
+        return eccSum, periSum, massSum
+
+    @register('muellerKley', 'numba')
+    def _muellerKleyNumba(geometry, dens, vr, vtheta, radialDensity):
+        typed = geometry.astype(np.result_type(vr, vtheta))
+        eccSum, periSum, massSum = _muellerKleySums(dens, vr, vtheta, typed.rCol.ravel(),
+                                                    typed.sinThetaRow.ravel(), typed.cosThetaRow.ravel())
+        return _muellerKleyAverages(geometry, eccSum, periSum, massSum, radialDensity)
+
+
+"""
+cell torque density: (mb, secr, sect, dens, r_med, theta, indirect_term) -> dT/dr per cell of one
+(nr, ns) snapshot, in double whatever the type of dens, as in tqAnalysis.computeTorqueDensity.
+accelerated backends take r_med as nr radii and theta as ns azimuths and decline anything else
+"""
+def _torqueGrid(dens, r_med, theta):
+    nr, ns = dens.shape
+    r_med = np.ravel(r_med)
+    theta = np.ravel(theta)
+    if dens.ndim != 2 or len(r_med) != nr or len(theta) != ns:
+        return None
+    return r_med.astype('double'), theta.astype('double')
+
+
+if numexpr is not None:
+    @register('cellTorqueDensity', 'numexpr')
+    def _cellTorqueDensityNumexpr(mb, secr, sect, dens, r_med, theta, indirect_term):
+        grid = _torqueGrid(dens, r_med, theta)
+        if grid is None:
+            return NotImplemented
+
+        variables = {
+            'r': grid[0].reshape(-1, 1), 'psi': grid[1].reshape(1, -1) - sect, 'rho': dens,
+            'mb': float(mb), 'secr': float(secr), 'dtheta': 2. * math.pi / dens.shape[1],
+            'k': 1. / secr ** 3 if indirect_term else 0.
+        }
+        variables['dist'] = numexpr.evaluate('sqrt(r ** 2 + secr ** 2 - 2 * r * secr * cos(psi))',
+                                             local_dict=variables)
+        return numexpr.evaluate('r * dtheta * rho * r * mb * secr * (1 / dist ** 3 - k) * sin(psi) * secr / dist',
+                                local_dict=variables)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _cellTorqueDensityLoop(mb, secr, sect, dens, r, theta, indirect):
+        nr, ns = dens.shape
+        cell = np.empty((nr, ns))
+
+        for i in numba.prange(nr):
+            rDtheta = 2. * math.pi * r[i] / ns
+            for j in range(ns):
+                psi = theta[j] - sect
+                dist = math.sqrt(r[i] * r[i] + secr * secr - 2. * r[i] * secr * math.cos(psi))
+                accel = mb * secr * (1. / (dist * dist * dist) - indirect)
+                cell[i, j] = rDtheta * dens[i, j] * r[i] * accel * math.sin(psi) * secr / dist
+
+        return cell
+
+    @register('cellTorqueDensity', 'numba')
+    def _cellTorqueDensityNumba(mb, secr, sect, dens, r_med, theta, indirect_term):
+        grid = _torqueGrid(dens, r_med, theta)
+        if grid is None:
+            return NotImplemented
+
+        indirect = 1. / secr ** 3 if indirect_term else 0.
+        return _cellTorqueDensityLoop(float(mb), float(secr), float(sect), dens, grid[0], grid[1], indirect)
+
+
+"""
+total torque: (mb, secr, sect, dens, geometry, indirect_term) -> the torque of each of the nt
+snapshots in dens on the secondary at (secr, sect), as in tqAnalysis.computeTotalTqBatch. the
+lever arms are evaluated in double
+"""
+if numexpr is not None:
+    @register('torqueSum', 'numexpr')
+    def _torqueSumNumexpr(mb, secr, sect, dens, geometry, indirect_term):
+        area = geometry.cellArea.ravel()
+        torques = np.empty(len(dens))
+
+        for t in range(len(dens)):
+            variables = {
+                'x': geometry.xCell, 'y': geometry.yCell, 'rho': dens[t],
+                'xb': secr[t] * math.cos(sect[t]), 'yb': secr[t] * math.sin(sect[t]),
+                'k': 1. / secr[t] ** 3 if indirect_term else 0.
+            }
+            cell = numexpr.evaluate('rho * (yb * (x - xb) - xb * (y - yb)) * '
+                                    '(1 / ((x - xb) ** 2 + (y - yb) ** 2) ** 1.5 - k)', local_dict=variables)
+            torques[t] = np.sum(cell, 1).dot(area)
+
+        return mb * torques
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _torqueSumLoop(secr, sect, dens, x, y, area, indirect_term):
+        nt, nr, ns = dens.shape
+        ringTorque = np.empty((nt, nr))
+
+        for row in numba.prange(nt * nr):
+            t = row // nr
+            i = row % nr
+
+            xb = secr[t] * math.cos(sect[t])
+            yb = secr[t] * math.sin(sect[t])
+            indirect = 1. / secr[t] ** 3 if indirect_term else 0.
+
+            torque = 0.
+            for j in range(ns):
+                dx = x[i, j] - xb
+                dy = y[i, j] - yb
+                dist2 = dx * dx + dy * dy
+                torque += float(dens[t, i, j]) * (yb * dx - xb * dy) * (1. / (dist2 * math.sqrt(dist2)) - indirect)
+
+            ringTorque[t, i] = torque * area[i]
+
+        return ringTorque.sum(1)
+
+    @register('torqueSum', 'numba')
+    def _torqueSumNumba(mb, secr, sect, dens, geometry, indirect_term):
+        secr = np.asarray(secr, dtype='double')
+        sect = np.asarray(sect, dtype='double')
+        return mb * _torqueSumLoop(secr, sect, dens, geometry.xCell, geometry.yCell, geometry.cellArea.ravel(),
+                                   bool(indirect_term))
+
+
+"""
+specific angular momentum about the barycentre: (m, secr, sect, r, theta, vr, vtheta) -> (nr, ns),
+as in innerBoundaryMomentumLoss.specificAngMom. cos(arcsin(x)) is sqrt(1 - x^2), as alpha lies
+in [-pi/2, pi/2]
+"""
+if numexpr is not None:
+    @register('specificAngMom', 'numexpr')
+    def _specificAngMomNumexpr(m, secr, sect, r, theta, vr, vtheta):
+        a = m / (1. + m)
+        variables = {'a': a, 'r': r, 'psi': np.asarray(theta) - sect, 'vr': vr, 'vt': vtheta}
+        x = numexpr.evaluate('a * sin(psi) / sqrt(a ** 2 + r ** 2 - 2 * a * r * cos(psi))', local_dict=variables)
+        return numexpr.evaluate('vt * sqrt(1 - x ** 2) - vr * x', local_dict=dict(variables, x=x))
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _specificAngMomLoop(a, sect, r, theta, vr, vtheta):
+        nr, ns = vr.shape
+        momentum = np.empty((nr, ns))
+
+        for i in numba.prange(nr):
+            for j in range(ns):
+                psi = theta[j] - sect
+                x = a * math.sin(psi) / math.sqrt(a * a + r[i] * r[i] - 2. * a * r[i] * math.cos(psi))
+                momentum[i, j] = vtheta[i, j] * math.sqrt(1. - x * x) - vr[i, j] * x
+
+        return momentum
+
+    @register('specificAngMom', 'numba')
+    def _specificAngMomNumba(m, secr, sect, r, theta, vr, vtheta):
+        r = np.ravel(r)
+        theta = np.ravel(theta)
+        if np.ndim(vr) != 2 or np.shape(vr) != np.shape(vtheta) or np.shape(vr) != (len(r), len(theta)):
+            return NotImplemented
+
+        return _specificAngMomLoop(m / (1. + m), float(sect), r.astype('double'), theta.astype('double'),
+                                   vr, vtheta)
+
+
+setBackend(os.environ.get('FARGO_KERNELS', 'auto'))
@@ -0,0 +1,168 @@
+__author__ = 'cguo'
+
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def _cpuTime():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def _peakRSS(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Stage:
+    def __init__(self, monitor, name, numBytes, numSnapshots):
+        self.monitor = monitor
+        self.name = name
+        self.numBytes = numBytes
+        self.numSnapshots = numSnapshots
+
+    def __enter__(self):
+        self.wallStart = time.time()
+        self.cpuStart = _cpuTime()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.monitor.record(self.name, time.time() - self.wallStart, _cpuTime() - self.cpuStart,
+                            self.numBytes, self.numSnapshots)
+
+
+class PerfMonitor:
+    """
+    per-stage counters for a run: calls, wall time, CPU time, bytes read and snapshots
+    processed, plus the peak resident set size of the process and of its finished children.
+    recording costs two clock reads per stage, so stages are timed per batch or per plot,
+    never per cell.
+
+    CPU time is the process's, so stages running at the same time on different threads
+    (e.g. prefetched reads under computation) each see the other's CPU time as well.
+
+    methods:
+    PerfMonitor()
+
+    stage(name, numBytes=0, numSnapshots=0): context manager timing a block as one call of `name`;
+        numBytes and numSnapshots may also be set on the object it returns, before the block ends
+
+    record(name, wallTime, cpuTime=0., numBytes=0, numSnapshots=0)
+
+    stats(): dict of the counters, per stage; merge(stats) adds another process's counters
+
+    reset()
+
+    report(): stats plus totals, rates and peak RSS; writeReport(path) saves it as JSON
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.childPeakRSS = 0
+            self.wallStart = time.time()
+            self.cpuStart = _cpuTime()
+
+    @staticmethod
+    def _emptyEntry():
+        return {'calls': 0, 'wallTime': 0., 'cpuTime': 0., 'bytes': 0, 'snapshots': 0}
+
+    def stage(self, name, numBytes=0, numSnapshots=0):
+        return _Stage(self, name, numBytes, numSnapshots)
+
+    def record(self, name, wallTime, cpuTime=0., numBytes=0, numSnapshots=0):
+        with self.lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                entry = self.stages[name] = self._emptyEntry()
+
+            entry['calls'] += 1
+            entry['wallTime'] += wallTime
+            entry['cpuTime'] += cpuTime
+            entry['bytes'] += numBytes
+            entry['snapshots'] += numSnapshots
+
+    def stats(self):
+        with self.lock:
+            return {'stages': dict((name, dict(entry)) for name, entry in self.stages.items()),
+                    'peakRSS': _peakRSS(resource.RUSAGE_SELF)}
+
+    def merge(self, stats):
+        """
+        add the counters of stats() taken in another process, e.g. a pool worker
+        """
+        for name, entry in stats['stages'].items():
+            with self.lock:
+                mine = self.stages.setdefault(name, self._emptyEntry())
+                for key in mine:
+                    mine[key] += entry[key]
+
+        with self.lock:
+            self.childPeakRSS = max(self.childPeakRSS, stats['peakRSS'])
+
+    def report(self):
+        stats = self.stats()
+
+        for entry in stats['stages'].values():
+            wallTime = entry['wallTime']
+            entry['snapshotsPerSecond'] = entry['snapshots'] / wallTime if wallTime > 0 else None
+            entry['megabytesPerSecond'] = entry['bytes'] / 1e6 / wallTime if wallTime > 0 else None
+
+        stats['wallTime'] = time.time() - self.wallStart
+        stats['cpuTime'] = _cpuTime() - self.cpuStart
+        stats['peakChildRSS'] = max(self.childPeakRSS, _peakRSS(resource.RUSAGE_CHILDREN))
+
+        return stats
+
+    def writeReport(self, path):
+        report = self.report()
+
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True, separators=(',', ': '))
+        os.rename(tmpPath, path)
+
+        return report
+
+
+# the monitor shared by every module of a process
+monitor = PerfMonitor()
+
+
+def timed(name):
+    """
+    decorator timing every call of a function as one call of stage `name` of the shared monitor
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with monitor.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def printReport(report, out=None):
+    """
+    print a report as a table of stages, slowest first, to `out` (by default sys.stdout)
+    """
+    out = out or sys.stdout
+    out.write("%-16s %7s %10s %10s %10s %12s\n" % ('stage', 'calls', 'wall s', 'cpu s', 'MB', 'snapshots/s'))
+    for name, entry in sorted(report['stages'].items(), key=lambda item: -item[1]['wallTime']):
+        rate = entry.get('snapshotsPerSecond')
+        out.write("%-16s %7d %10.2f %10.2f %10.1f %12s\n" %
+                  (name, entry['calls'], entry['wallTime'], entry['cpuTime'], entry['bytes'] / 1e6,
+                   '%.1f' % rate if entry['snapshots'] else '-'))
+
+    out.write("total wall %.2f s, cpu %.2f s, peak RSS %.1f MB (children %.1f MB)\n" %
+              (report['wallTime'], report['cpuTime'], report['peakRSS'] / 1e6, report['peakChildRSS'] / 1e6))
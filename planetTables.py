@@ -0,0 +1,117 @@
+__author__ = 'cguo'
+
+import numpy as np
+import json
+import os
+
+"""
+cached loading of the Fargo planet and orbit tables (planet0.dat, bigplanet0.dat, orbit0.dat).
+on long runs these text files grow to hundreds of MB and np.loadtxt takes minutes, so
+    loadTable(path)
+parses a table once with a bulk parser and keeps it as a .npy file in a tableCache/ directory
+beside it, together with the size and mtime of the text file it was parsed from. later calls,
+from any script, memory-map the cache as long as the text file is unchanged. the cache is
+column-major, so each column is one contiguous read.
+
+Fargo repeats lines of bigplanet0.dat after a restart; with uniqueColumn (e.g. DATE_COLUMN)
+the table is deduplicated the way fixPlanetOutput.py does it -- the first row of every distinct
+value of that column, sorted by it -- and the deduplicated table is cached on its own.
+
+symlinked tables, like those of the pyramid levels (see snapshotPyramid.py), share the cache of
+the file they point to. if the cache cannot be written the parsed table is returned in memory
+"""
+
+# planet0.dat and bigplanet0.dat: index x y vx vy mass date omegaframe
+DATE_COLUMN = -2
+
+cacheDirectoryName = 'tableCache'
+
+
+def _parse(path):
+    with open(path) as f:
+        text = f.read()
+
+    lines = text.splitlines()
+    numColumns = len(lines[0].split()) if lines else 0
+    values = np.fromstring(text, sep=' ')
+
+    # fromstring stops quietly at anything it cannot parse, so check that every line was read;
+    # loadtxt copes with (or reports) comments, blank lines and ragged rows
+    if numColumns == 0 or values.size != numColumns * len(lines):
+        return np.loadtxt(path, ndmin=2)
+
+    return values.reshape(len(lines), numColumns)
+
+
+def _unique(table, column):
+    _, ixs = np.unique(table[:, column], return_index=True)
+    return table[ixs]
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def cachePaths(path, uniqueColumn=None):
+    """
+    (cache .npy path, signature .json path) of a table
+    """
+    path = os.path.realpath(path)
+    name = os.path.basename(path)
+    if name.endswith('.dat'):
+        name = name[:-len('.dat')]
+    if uniqueColumn is not None:
+        name += '.unique' + str(uniqueColumn)
+
+    prefix = os.path.dirname(path) + '/' + cacheDirectoryName + '/' + name
+    return prefix + '.npy', prefix + '.json'
+
+
+def _isCurrent(path, signaturePath):
+    try:
+        with open(signaturePath) as f:
+            return json.load(f) == _signature(path)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def _writeCache(table, signature, cachePath, signaturePath):
+    directory = os.path.dirname(cachePath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # write-then-rename, so concurrent readers never see half a cache; the pid keeps
+    # processes filling the same cache from sharing a temporary
+    suffix = '.tmp' + str(os.getpid())
+    with open(cachePath + suffix, 'wb') as f:
+        np.save(f, np.asfortranarray(table))
+    os.rename(cachePath + suffix, cachePath)
+
+    with open(signaturePath + suffix, 'w') as f:
+        json.dump(signature, f)
+    os.rename(signaturePath + suffix, signaturePath)
+
+
+def loadTable(path, uniqueColumn=None):
+    """
+    the table at path as a read-only (rows, columns) array, memory-mapped from its cache.
+    with uniqueColumn, only the first row of every distinct value of that column is kept,
+    sorted by it
+    """
+    cachePath, signaturePath = cachePaths(path, uniqueColumn)
+    if os.path.exists(cachePath) and _isCurrent(path, signaturePath):
+        return np.load(cachePath, mmap_mode='r')
+
+    # taken before parsing, so that a table rewritten meanwhile is parsed again next time
+    signature = _signature(path)
+    table = _parse(path)
+    if uniqueColumn is not None:
+        table = _unique(table, uniqueColumn)
+
+    try:
+        _writeCache(table, signature, cachePath, signaturePath)
+    except (IOError, OSError):
+        return table
+
+    return np.load(cachePath, mmap_mode='r')
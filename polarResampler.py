@@ -0,0 +1,87 @@
+__author__ = 'cguo'
+
+import numpy as np
+import math
+
+
+class PolarResampler:
+    """
+    precomputed map from the pixels of a square Cartesian image, covering [-rmax, rmax] in x
+    and y, to cells of a Fargo2D (nr, ns) polar grid. the map is built once per grid; after
+    that, turning a field into an image is a single fancy-indexing gather.
+
+    method 'nearest' takes each pixel from the nearest cell centre; 'bilinear' interpolates
+    between the four surrounding centres in (r, theta). pixels beyond rmax or outside the
+    grid's radial range are NaN.
+
+    methods:
+    PolarResampler(radialIntervals, thetaIntervals, rmax, size=512, method='nearest', radialEdges=None)
+
+    resample(field): field has shape (nr, ns); returns a (size, size) image, row 0 at y = -rmax
+    """
+
+    def __init__(self, radialIntervals, thetaIntervals, rmax, size=512, method='nearest', radialEdges=None):
+        radialIntervals = np.asarray(radialIntervals, dtype='double')
+        thetaIntervals = np.asarray(thetaIntervals, dtype='double')
+
+        self.rmax = rmax
+        self.size = size
+        self.method = method
+        self.extent = (-rmax, rmax, -rmax, rmax)
+
+        nr = len(radialIntervals)
+        ns = len(thetaIntervals)
+        self.fieldShape = (nr, ns)
+
+        # pixel centres
+        axis = (np.arange(size) + 0.5) * (2. * rmax / size) - rmax
+        x, y = np.meshgrid(axis, axis)
+        r = np.hypot(x, y).ravel()
+        phi = np.mod(np.arctan2(y, x), 2 * math.pi).ravel()
+
+        rmin, rout = (radialEdges[0], radialEdges[-1]) if radialEdges is not None else \
+            (radialIntervals[0], radialIntervals[-1])
+        self.valid = np.flatnonzero((r <= rmax) & (r >= rmin) & (r <= rout))
+        r = r[self.valid]
+        phi = phi[self.valid]
+
+        # fractional azimuthal index; thetaIntervals is uniformly spaced
+        dtheta = thetaIntervals[1] - thetaIntervals[0]
+        t = (phi - thetaIntervals[0]) / dtheta
+
+        if method == 'nearest':
+            ir = np.clip(np.searchsorted(radialIntervals, r), 1, nr - 1)
+            ir -= (r - radialIntervals[ir - 1]) < (radialIntervals[ir] - r)
+            it = np.mod(np.round(t).astype('int'), ns)
+
+            self.indices = (ir * ns + it).reshape(-1, 1)
+            self.weights = None
+
+        elif method == 'bilinear':
+            i0 = np.clip(np.searchsorted(radialIntervals, r) - 1, 0, nr - 2)
+            wr = np.clip((r - radialIntervals[i0]) / (radialIntervals[i0 + 1] - radialIntervals[i0]), 0., 1.)
+
+            j0 = np.mod(np.floor(t).astype('int'), ns)
+            j1 = np.mod(j0 + 1, ns)
+            wt = t - np.floor(t)
+
+            self.indices = np.column_stack([i0 * ns + j0, i0 * ns + j1, (i0 + 1) * ns + j0, (i0 + 1) * ns + j1])
+            self.weights = np.column_stack([(1 - wr) * (1 - wt), (1 - wr) * wt, wr * (1 - wt), wr * wt])
+
+        else:
+            raise ValueError('unknown resampling method ' + method)
+
+
+    def resample(self, field):
+        flat = np.asarray(field).reshape(-1)
+
+        image = np.empty(self.size * self.size)
+        image.fill(np.nan)
+
+        gathered = flat[self.indices]
+        if self.weights is None:
+            image[self.valid] = gathered[:, 0]
+        else:
+            image[self.valid] = np.einsum('pk,pk->p', gathered, self.weights)
+
+        return image.reshape(self.size, self.size)
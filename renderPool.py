@@ -0,0 +1,142 @@
+__author__ = 'cguo'
+
+from perfMonitor import monitor
+import multiprocessing
+import Queue
+import traceback
+
+
+def _renderWorker(tasks, results, rendererClass, rendererArgs, returnResults):
+    import matplotlib
+    if matplotlib.get_backend().lower() != 'agg':
+        matplotlib.use('Agg')
+
+    renderer = rendererClass(*rendererArgs)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            # hand this worker's timings to the parent's monitor
+            results.put((None, monitor.stats(), None))
+            return
+
+        sequence, methodName, args = task
+        try:
+            result = getattr(renderer, methodName)(*args)
+            if returnResults:
+                results.put((sequence, result, None))
+        except Exception:
+            results.put((sequence, None, traceback.format_exc()))
+
+
+class RenderPool:
+    """
+    renders and saves frames on worker processes. each worker has its own Agg backend and
+    builds its own renderer once, as rendererClass(*rendererArgs); submit(methodName, *args)
+    then calls renderer.methodName(*args) on whichever worker is free.
+
+    tasks go through a bounded queue, so a producer that computes frames faster than they
+    can be drawn blocks instead of piling per-frame arrays up in memory. with numWorkers=0
+    every call is made inline, in order.
+
+    if onResult is given, the value returned by each call (e.g. a frame's RGBA pixels) is
+    passed to onResult in the parent process, in submission order; at most maxPending
+    frames are in flight or waiting to be delivered at any time.
+
+    methods:
+    RenderPool(numWorkers, rendererClass, rendererArgs=(), maxPending=None, onResult=None)
+
+    submit(methodName, *args)
+
+    close(): waits until every submitted frame is written; raises RuntimeError if any failed.
+        the workers' perfMonitor timings are merged into the parent's
+    """
+
+    def __init__(self, numWorkers, rendererClass, rendererArgs=(), maxPending=None, onResult=None):
+        self.numWorkers = numWorkers
+        self.onResult = onResult
+
+        if numWorkers <= 0:
+            self.renderer = rendererClass(*rendererArgs)
+            return
+
+        if maxPending is None:
+            maxPending = 2 * numWorkers
+
+        self.maxPending = maxPending
+        self.submitted = 0
+        self.delivered = 0
+        self.finished = {}
+        self.failures = []
+
+        self.tasks = multiprocessing.Queue(maxPending)
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=_renderWorker,
+                                                args=(self.tasks, self.results, rendererClass, rendererArgs,
+                                                      onResult is not None))
+                        for _ in range(numWorkers)]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+
+    def _collect(self, block):
+        """
+        take one message from the workers, and deliver any results that are now in order
+        """
+        try:
+            sequence, result, failure = self.results.get(block, 0.1 if block else 0)
+        except Queue.Empty:
+            return
+
+        if sequence is None:
+            monitor.merge(result)
+            return
+
+        if failure is not None:
+            self.failures.append(failure)
+        self.finished[sequence] = result
+
+        while self.onResult is not None and self.delivered in self.finished:
+            result = self.finished.pop(self.delivered)
+            if result is not None:
+                self.onResult(result)
+            self.delivered += 1
+
+
+    def submit(self, methodName, *args):
+        if self.numWorkers <= 0:
+            result = getattr(self.renderer, methodName)(*args)
+            if self.onResult is not None:
+                self.onResult(result)
+            return
+
+        self._collect(False)
+        while self.onResult is not None and self.submitted - self.delivered >= self.maxPending:
+            self._collect(True)
+
+        self.tasks.put((self.submitted, methodName, args))
+        self.submitted += 1
+
+
+    def close(self):
+        if self.numWorkers <= 0:
+            return
+
+        while self.onResult is not None and self.delivered < self.submitted:
+            self._collect(True)
+
+        for _ in self.workers:
+            self.tasks.put(None)
+
+        # keep draining while workers exit, so none blocks flushing a message to a full pipe
+        while any(worker.is_alive() for worker in self.workers):
+            self._collect(True)
+        for worker in self.workers:
+            worker.join()
+        while not self.results.empty():
+            self._collect(False)
+
+        if self.failures:
+            raise RuntimeError(str(len(self.failures)) + " frames failed to render:\n" + self.failures[0])
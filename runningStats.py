@@ -0,0 +1,315 @@
+__author__ = 'cguo'
+
+import numpy as np
+import json
+import os
+
+"""
+streaming whole-run statistics. every accumulator is updated with a batch of shape (nt,) + shape
+and keeps O(prod(shape)) state however many batches it sees, so e.g. the time-averaged density
+field of a run costs a few (nr, ns) arrays. accumulators of the same kind merge exactly -- partial
+results from pool workers or from separate batch ranges combine into the result of one pass -- and
+RunStatistics saves and loads a named set of them, so partial results can be checkpointed on disk.
+sums are accumulated in float64 whatever the precision of the batches
+"""
+
+
+class RunningMoments:
+    """
+    count, mean and variance, updated a batch at a time with the Welford / Chan et al. update,
+    which stays accurate where the variance is small against the mean
+
+    methods:
+    RunningMoments()
+
+    update(batch), merge(other)
+
+    mean(), variance(ddof=0), std(ddof=0)
+    """
+
+    kind = 'moments'
+
+    def __init__(self):
+        self.count = 0
+        self.mu = None
+        self.m2 = None
+
+    def params(self):
+        return {}
+
+    def arrays(self):
+        if self.count == 0:
+            return {}
+        return {'count': np.array(self.count), 'mean': self.mu, 'm2': self.m2}
+
+    def _load(self, arrays):
+        if 'count' in arrays:
+            self.count = int(arrays['count'])
+            self.mu = arrays['mean']
+            self.m2 = arrays['m2']
+
+    def _combine(self, count, mu, m2):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mu, self.m2 = count, mu, m2
+            return
+
+        total = self.count + count
+        delta = mu - self.mu
+        self.mu = self.mu + delta * (float(count) / total)
+        self.m2 = self.m2 + m2 + np.square(delta) * (float(self.count) * count / total)
+        self.count = total
+
+    def update(self, batch):
+        batch = np.asarray(batch)
+        if len(batch) == 0:
+            return
+
+        mu = batch.mean(0, dtype='double')
+        m2 = np.square(batch - mu).sum(0, dtype='double')
+        self._combine(len(batch), mu, m2)
+
+    def merge(self, other):
+        self._combine(other.count, other.mu, other.m2)
+
+    def mean(self):
+        return self.mu
+
+    def variance(self, ddof=0):
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+
+class RunningExtrema:
+    """
+    elementwise minimum and maximum over time; NaNs are ignored
+
+    methods:
+    RunningExtrema()
+
+    update(batch), merge(other)
+
+    minimum(), maximum()
+    """
+
+    kind = 'extrema'
+
+    def __init__(self):
+        self.low = None
+        self.high = None
+
+    def params(self):
+        return {}
+
+    def arrays(self):
+        if self.low is None:
+            return {}
+        return {'minimum': self.low, 'maximum': self.high}
+
+    def _load(self, arrays):
+        if 'minimum' in arrays:
+            self.low = arrays['minimum']
+            self.high = arrays['maximum']
+
+    def _combine(self, low, high):
+        if low is None:
+            return
+        if self.low is None:
+            self.low, self.high = low, high
+            return
+
+        self.low = np.fmin(self.low, low)
+        self.high = np.fmax(self.high, high)
+
+    def update(self, batch):
+        batch = np.asarray(batch)
+        if len(batch) == 0:
+            return
+
+        self._combine(np.fmin.reduce(batch, 0).astype('double'), np.fmax.reduce(batch, 0).astype('double'))
+
+    def merge(self, other):
+        self._combine(other.low, other.high)
+
+    def minimum(self):
+        return self.low
+
+    def maximum(self):
+        return self.high
+
+
+class FixedHistogram:
+    """
+    elementwise histogram over time on numBins fixed bins spanning [low, high), evenly spaced in
+    the value or, with log, in its log10 (for amplitudes spanning decades). values below low or at
+    or above high are counted as underflow and overflow; NaNs are not counted. the bins are fixed
+    up front so that histograms of different batches or workers add up
+
+    methods:
+    FixedHistogram(low, high, numBins=50, log=False)
+
+    update(batch), merge(other)
+
+    edges(); counts has shape shape + (numBins,), underflow and overflow shape `shape`
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, low, high, numBins=50, log=False):
+        self.low = low
+        self.high = high
+        self.numBins = numBins
+        self.log = log
+
+        self.counts = None
+        self.underflow = None
+        self.overflow = None
+
+    def params(self):
+        return {'low': self.low, 'high': self.high, 'numBins': self.numBins, 'log': self.log}
+
+    def arrays(self):
+        if self.counts is None:
+            return {}
+        return {'counts': self.counts, 'underflow': self.underflow, 'overflow': self.overflow}
+
+    def _load(self, arrays):
+        if 'counts' in arrays:
+            self.counts = arrays['counts']
+            self.underflow = arrays['underflow']
+            self.overflow = arrays['overflow']
+
+    def edges(self):
+        if self.log:
+            return np.logspace(np.log10(self.low), np.log10(self.high), self.numBins + 1)
+        return np.linspace(self.low, self.high, self.numBins + 1)
+
+    def _combine(self, counts, underflow, overflow):
+        if counts is None:
+            return
+        if self.counts is None:
+            self.counts, self.underflow, self.overflow = counts, underflow, overflow
+            return
+
+        self.counts = self.counts + counts
+        self.underflow = self.underflow + underflow
+        self.overflow = self.overflow + overflow
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype='double')
+        if len(batch) == 0:
+            return
+
+        shape = batch.shape[1:]
+        numCells = int(np.prod(shape))
+
+        if self.log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                position = (np.log10(batch) - np.log10(self.low)) / (np.log10(self.high) - np.log10(self.low))
+                # non-positive values lie below any log bin
+                position[batch <= 0] = -1.
+        else:
+            position = (batch - self.low) / float(self.high - self.low)
+
+        with np.errstate(invalid='ignore'):
+            binIndex = np.floor(position * self.numBins)
+            under = (binIndex < 0).sum(0)
+            over = (binIndex >= self.numBins).sum(0)
+            inRange = (binIndex >= 0) & (binIndex < self.numBins)
+
+        cellIndex = np.broadcast_to(np.arange(numCells).reshape(shape), batch.shape)
+        flatIndex = cellIndex[inRange] * self.numBins + binIndex[inRange].astype('int64')
+        counts = np.bincount(flatIndex, minlength=numCells * self.numBins).reshape(shape + (self.numBins,))
+
+        self._combine(counts, under, over)
+
+    def merge(self, other):
+        if (self.low, self.high, self.numBins, self.log) != (other.low, other.high, other.numBins, other.log):
+            raise ValueError('cannot merge histograms with different bins')
+        self._combine(other.counts, other.underflow, other.overflow)
+
+
+ACCUMULATORS = dict((cls.kind, cls) for cls in (RunningMoments, RunningExtrema, FixedHistogram))
+
+
+class RunStatistics:
+    """
+    a named set of accumulators, e.g. statistics['radialDens.moments']. update() feeds a batch to
+    every accumulator registered under a quantity; merge() adds another RunStatistics with the same
+    accumulators, and save()/load() checkpoint the set as one .npz file
+
+    methods:
+    RunStatistics()
+
+    add(quantity, accumulator): registers accumulator as '<quantity>.<kind>'
+
+    update(quantity, batch), merge(other)
+
+    names(), statistics[name]
+
+    save(path), RunStatistics.load(path), RunStatistics.mergeFiles(paths)
+    """
+
+    def __init__(self):
+        self.accumulators = {}
+
+    def add(self, quantity, accumulator):
+        self.accumulators[quantity + '.' + accumulator.kind] = accumulator
+        return self
+
+    def names(self):
+        return sorted(self.accumulators)
+
+    def __getitem__(self, name):
+        return self.accumulators[name]
+
+    def update(self, quantity, batch):
+        prefix = quantity + '.'
+        for name, accumulator in self.accumulators.items():
+            if name.startswith(prefix):
+                accumulator.update(batch)
+
+    def merge(self, other):
+        for name, accumulator in other.accumulators.items():
+            if name not in self.accumulators:
+                self.accumulators[name] = ACCUMULATORS[accumulator.kind](**accumulator.params())
+            self.accumulators[name].merge(accumulator)
+
+    def save(self, path):
+        spec = {}
+        arrays = {}
+        for name, accumulator in self.accumulators.items():
+            spec[name] = {'kind': accumulator.kind, 'params': accumulator.params()}
+            for key, arr in accumulator.arrays().items():
+                arrays[name + '/' + key] = arr
+
+        # write-then-rename, so a checkpoint is never left half written
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            np.savez(f, spec=np.array(json.dumps(spec, sort_keys=True)), **arrays)
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        statistics = cls()
+        with np.load(path) as data:
+            spec = json.loads(str(data['spec']))
+            for name, entry in spec.items():
+                params = dict((str(key), value) for key, value in entry['params'].items())
+                accumulator = ACCUMULATORS[entry['kind']](**params)
+                prefix = name + '/'
+                accumulator._load(dict((key[len(prefix):], data[key]) for key in data.files
+                                       if key.startswith(prefix)))
+                statistics.accumulators[name] = accumulator
+
+        return statistics
+
+    @classmethod
+    def mergeFiles(cls, paths):
+        statistics = cls()
+        for path in paths:
+            statistics.merge(cls.load(path))
+        return statistics
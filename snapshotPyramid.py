@@ -0,0 +1,262 @@
+__author__ = 'cguo'
+
+from gridGeometry import GridGeometry
+from optparse import OptionParser
+import numpy as np
+import multiprocessing
+import glob
+import os
+import re
+
+
+def coarsenSnapshot(dens, vr, vtheta, radialEdges, factor=2):
+    """
+    coarsen one (nr, ns) snapshot by `factor` in r and theta. a coarse cell's density is the
+    mass of the fine cells it covers divided by its area, and its velocities are their
+    mass-weighted averages, so mass and momentum are conserved. when nr or ns is not a
+    multiple of factor, the last coarse ring or sector covers the remainder.
+    returns (dens, vr, vtheta, radialEdges) on the coarse grid
+    """
+    nr, ns = dens.shape
+    rows = np.arange(0, nr, factor)
+    cols = np.arange(0, ns, factor)
+
+    # ring areas; the 1 / ns of each sector is common to every cell and cancels
+    area = (np.square(radialEdges[1:]) - np.square(radialEdges[:-1])).reshape(-1, 1)
+    mass = dens * area
+
+    def groupSum(arr):
+        return np.add.reduceat(np.add.reduceat(arr, rows, axis=0), cols, axis=1)
+
+    coarseMass = groupSum(mass)
+    cellsPerSector = np.diff(np.append(cols, ns)).reshape(1, -1)
+    coarseArea = np.add.reduceat(area, rows, axis=0) * cellsPerSector
+
+    coarseEdges = radialEdges[np.append(rows, nr)]
+
+    return (coarseMass / coarseArea,
+            groupSum(mass * vr) / coarseMass,
+            groupSum(mass * vtheta) / coarseMass,
+            coarseEdges)
+
+
+def coarsenAzimuths(thetaIntervals, factor=2):
+    """
+    azimuths of the coarse columns of coarsenSnapshot: the mean azimuth of the fine columns each
+    one merges, so a coarse column sits between the columns it covers rather than on the first
+    """
+    ns = len(thetaIntervals)
+    cols = np.arange(0, ns, factor)
+    return np.add.reduceat(thetaIntervals, cols) / np.diff(np.append(cols, ns))
+
+
+def _buildOutput(task):
+    pyramid, outputIndex = task
+    pyramid.buildOutput(outputIndex)
+    return outputIndex
+
+
+class SnapshotPyramid:
+    """
+    cache of downsampled copies of a run's gas outputs, kept next to the run in
+    <runDir>/pyramid/level<k>/, level k being coarsened 2^k times in r and theta (see
+    coarsenSnapshot). every level directory is itself a Fargo2D output directory -- dims.dat
+    and used_rad.dat for the coarse grid, links to the run's other .dat files, and
+    gasdens/gasvrad/gasvtheta<i>.dat -- so FargoParser(runDir, level=k) reads it like a run.
+    the centres of the coarse cells cannot be rebuilt from dims.dat and used_rad.dat alone, so
+    each level also holds them, derived from the fine cells merged (see coarsenAzimuths), in
+    radialIntervals.dat and thetaIntervals.dat; FargoParser reads those instead.
+
+    build() only coarsens outputs whose cached files are missing or older than the originals,
+    so it can be rerun as a simulation progresses.
+
+    methods:
+    SnapshotPyramid(runDir, numLevels=3)
+
+    build(workers=1): brings every level up to date, spreading outputs over `workers` processes
+
+    buildOutput(outputIndex): coarsens one output into every level
+
+    SnapshotPyramid.levelDirectory(runDir, level)
+
+    SnapshotPyramid.levelGrids(runDir): list of (level, radialEdges, numThetaIntervals) for level 0
+        and every complete level
+
+    SnapshotPyramid.coarsestLevel(runDir, pixelSize, rmax=None, radialOnly=False): the coarsest
+        complete level none of whose cells within rmax is larger than pixelSize, in r or, unless
+        radialOnly, along theta; 0 without a pyramid
+    """
+
+    gasVarTypes = ['dens', 'vrad', 'vtheta']
+
+    radialIntervalsName = 'radialIntervals.dat'
+    thetaIntervalsName = 'thetaIntervals.dat'
+
+    def __init__(self, runDir, numLevels=3):
+        if runDir.endswith('/'):
+            runDir = runDir[:-1]
+
+        self.runDir = runDir
+        self.numLevels = numLevels
+
+        self.dims = np.loadtxt(runDir + '/dims.dat')
+        self.radialEdges = np.loadtxt(runDir + '/used_rad.dat')
+        self.numThetaIntervals = int(self.dims[7])
+        self.thetaIntervals = GridGeometry(self.radialEdges, self.numThetaIntervals).thetaIntervals
+
+
+    @staticmethod
+    def levelDirectory(runDir, level):
+        if runDir.endswith('/'):
+            runDir = runDir[:-1]
+        if level == 0:
+            return runDir
+        return runDir + '/pyramid/level' + str(level)
+
+
+    @staticmethod
+    def _outputIndices(directory):
+        paths = glob.glob(directory + '/gasdens*.dat')
+        return sorted(int(re.search('[0-9]+', path.split('/')[-1]).group(0)) for path in paths)
+
+
+    def _prepareLevel(self, level, radialEdges, thetaIntervals):
+        directory = self.levelDirectory(self.runDir, level)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        dims = self.dims.copy()
+        dims[6] = len(radialEdges) - 1
+        dims[7] = len(thetaIntervals)
+        np.savetxt(directory + '/dims.dat', dims.reshape(1, -1))
+        np.savetxt(directory + '/used_rad.dat', radialEdges)
+
+        # a coarse ring spans whole fine rings, so its centre is that of the fine rings merged
+        radialIntervals = GridGeometry(radialEdges, len(thetaIntervals)).radialIntervals
+        np.savetxt(directory + '/' + self.radialIntervalsName, radialIntervals)
+        np.savetxt(directory + '/' + self.thetaIntervalsName, thetaIntervals)
+
+        # orbit and planet files are shared with the run
+        ownFiles = ('dims.dat', 'used_rad.dat', self.radialIntervalsName, self.thetaIntervalsName)
+        for path in glob.glob(self.runDir + '/*.dat'):
+            name = path.split('/')[-1]
+            if name.startswith('gas') or name in ownFiles:
+                continue
+            link = directory + '/' + name
+            if not os.path.lexists(link):
+                os.symlink(os.path.relpath(path, directory), link)
+
+
+    def _isCurrent(self, outputIndex):
+        for varType in self.gasVarTypes:
+            name = 'gas' + varType + str(outputIndex) + '.dat'
+            sourceTime = os.path.getmtime(self.runDir + '/' + name)
+            for level in range(1, self.numLevels + 1):
+                path = self.levelDirectory(self.runDir, level) + '/' + name
+                if not os.path.exists(path) or os.path.getmtime(path) < sourceTime:
+                    return False
+        return True
+
+
+    def buildOutput(self, outputIndex):
+        shape = (len(self.radialEdges) - 1, self.numThetaIntervals)
+        fields = [np.fromfile(self.runDir + '/gas' + varType + str(outputIndex) + '.dat').reshape(shape)
+                  for varType in self.gasVarTypes]
+        radialEdges = self.radialEdges
+
+        # each level is coarsened from the one before it
+        for level in range(1, self.numLevels + 1):
+            dens, vr, vtheta, radialEdges = coarsenSnapshot(fields[0], fields[1], fields[2], radialEdges)
+            fields = [dens, vr, vtheta]
+
+            directory = self.levelDirectory(self.runDir, level)
+            for varType, field in zip(self.gasVarTypes, fields):
+                field.tofile(directory + '/gas' + varType + str(outputIndex) + '.dat')
+
+
+    def build(self, workers=1):
+        radialEdges = self.radialEdges
+        thetaIntervals = self.thetaIntervals
+        for level in range(1, self.numLevels + 1):
+            numRadialIntervals = len(radialEdges) - 1
+            radialEdges = radialEdges[np.append(np.arange(0, numRadialIntervals, 2), numRadialIntervals)]
+            thetaIntervals = coarsenAzimuths(thetaIntervals)
+            self._prepareLevel(level, radialEdges, thetaIntervals)
+
+        pending = [ix for ix in self._outputIndices(self.runDir) if not self._isCurrent(ix)]
+        print "coarsening " + str(len(pending)) + " outputs into " + str(self.numLevels) + " levels"
+
+        tasks = [(self, ix) for ix in pending]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            for _ in pool.imap_unordered(_buildOutput, tasks, chunksize=8):
+                pass
+            pool.close()
+            pool.join()
+        else:
+            for task in tasks:
+                _buildOutput(task)
+
+
+    @classmethod
+    def levelGrids(cls, runDir):
+        grids = []
+        numOutputs = len(glob.glob(cls.levelDirectory(runDir, 0) + '/gasdens*.dat'))
+
+        level = 0
+        while True:
+            directory = cls.levelDirectory(runDir, level)
+            if not os.path.exists(directory + '/dims.dat'):
+                break
+            # a level still being built does not count
+            if len(glob.glob(directory + '/gasdens*.dat')) < numOutputs:
+                break
+
+            dims = np.loadtxt(directory + '/dims.dat')
+            grids.append((level, np.loadtxt(directory + '/used_rad.dat'), int(dims[7])))
+            level += 1
+
+        return grids
+
+
+    @classmethod
+    def coarsestLevel(cls, runDir, pixelSize, rmax=None, radialOnly=False):
+        best = 0
+        for level, radialEdges, numThetaIntervals in cls.levelGrids(runDir):
+            # cells that start inside rmax; all of them when rmax lies beyond the outer edge
+            visible = len(radialEdges) - 1 if rmax is None else \
+                min(max(1, np.searchsorted(radialEdges, rmax, side='left')), len(radialEdges) - 1)
+            rOuter = radialEdges[visible] if rmax is None else min(radialEdges[visible], rmax)
+
+            cellSize = np.ediff1d(radialEdges[:visible + 1]).max()
+            if not radialOnly:
+                cellSize = max(cellSize, 2 * np.pi * rOuter / numThetaIntervals)
+
+            if cellSize <= pixelSize:
+                best = level
+
+        return best
+
+
+def main():
+    optParser = OptionParser(usage='%prog -i RUNDIR [-l LEVELS] [-w WORKERS]')
+    optParser.add_option('-i', '--inputdirectory', action='store',
+                         type='string', dest='inputDirectory')
+
+    optParser.add_option('-l', '--levels', action='store',
+                         type='int', dest='numLevels', default=3,
+                         help='number of levels, each coarsened 2x from the one before (default 3: 2x, 4x, 8x)')
+
+    optParser.add_option('-w', '--workers', action='store',
+                         type='int', dest='workers', default=1,
+                         help='number of processes coarsening outputs')
+
+    (options, args) = optParser.parse_args()
+
+    if not options.inputDirectory:
+        optParser.error('you must specify an input directory with -i or --inputdirectory')
+
+    SnapshotPyramid(options.inputDirectory, options.numLevels).build(options.workers)
+
+if __name__ == '__main__':
+    main()
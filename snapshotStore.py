@@ -0,0 +1,107 @@
+__author__ = 'cguo'
+
+import numpy as np
+import io
+
+
+class SnapshotStore:
+    """
+    a lazy, memory-mapped view over a sorted list of Fargo2D gas output files
+    (one (numRadialIntervals, numThetaIntervals) array of doubles per file).
+
+    the store is indexed like a (time, r, theta) array; only the selected
+    snapshots are opened, and each one is memory-mapped so that a radial band
+    or azimuthal range only touches the pages it needs:
+
+        store[10]               -> (nr, ns) array for snapshot 10
+        store[100:200]          -> (100, nr, ns) array
+        store[::20, 50:80]      -> every 20th snapshot, radial cells 50..79
+        store[[3, 7], :, 0:64]  -> snapshots 3 and 7, first 64 azimuthal cells
+
+    methods:
+    SnapshotStore(paths, numRadialIntervals, numThetaIntervals, dtype='double', outDtype=None)
+        dtype is the type stored in the files; arrays returned by indexing and readInto are converted
+        to outDtype (e.g. 'single') as they are read. outDtype defaults to dtype
+
+    snapshot(index): returns the read-only np.memmap of shape (nr, ns) for one snapshot
+
+    store[time, r, theta]: returns a new ndarray holding the selection
+
+    readInto(index, out): reads a whole snapshot with readinto straight into `out`, a contiguous
+                          (nr, ns) array of the store's dtype, e.g. one row of a preallocated batch
+    """
+
+    def __init__(self, paths, numRadialIntervals, numThetaIntervals, dtype='double', outDtype=None):
+        self.paths = list(paths)
+        self.dtype = np.dtype(dtype)
+        self.outDtype = self.dtype if outDtype is None else np.dtype(outDtype)
+        self.frameShape = (numRadialIntervals, numThetaIntervals)
+        self.shape = (len(self.paths),) + self.frameShape
+
+
+    def __len__(self):
+        return len(self.paths)
+
+
+    def snapshot(self, index):
+        return np.memmap(self.paths[index], dtype=self.dtype, mode='r', shape=self.frameShape)
+
+
+    def readInto(self, index, out):
+        if out.dtype != self.dtype:
+            # read at the file's precision, then convert
+            out[...] = self.readInto(index, np.empty(self.frameShape, dtype=self.dtype))
+            return out
+
+        buf = out.reshape(-1).view(np.uint8)
+        numBytes = len(buf)
+
+        f = io.open(self.paths[index], 'rb', buffering=0)
+        try:
+            filled = 0
+            while filled < numBytes:
+                n = f.readinto(buf[filled:])
+                if not n:
+                    raise IOError(self.paths[index] + ' holds ' + str(filled) + ' bytes, expected ' +
+                                  str(numBytes))
+                filled += n
+        finally:
+            f.close()
+
+        return out
+
+
+    def _timeIndices(self, timeKey):
+        numSnapshots = len(self.paths)
+
+        if isinstance(timeKey, slice):
+            return range(*timeKey.indices(numSnapshots))
+
+        indices = np.arange(numSnapshots)[timeKey]
+        return [int(ix) for ix in np.atleast_1d(indices)]
+
+
+    def _selectedFrameShape(self, spatialKey):
+        # index a zero-strided dummy frame to find the selection's shape without allocating
+        dummy = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=self.dtype), shape=self.frameShape,
+                                                strides=(0, 0))
+        return dummy[spatialKey].shape
+
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        timeKey = key[0]
+        spatialKey = key[1:]
+
+        if isinstance(timeKey, (int, long, np.integer)):
+            return np.array(self.snapshot(timeKey)[spatialKey], dtype=self.outDtype)
+
+        indices = self._timeIndices(timeKey)
+
+        out = np.empty((len(indices),) + self._selectedFrameShape(spatialKey), dtype=self.outDtype)
+        for k, ix in enumerate(indices):
+            out[k] = self.snapshot(ix)[spatialKey]
+
+        return out
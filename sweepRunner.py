@@ -0,0 +1,386 @@
+__author__ = 'cguo'
+
+from diagnosticsRunner import FargoDiagnosticsRunner, parseDiagnostics
+from snapshotPyramid import SnapshotPyramid
+from perfMonitor import monitor, printReport
+from optparse import OptionParser
+import fargoDiagnostics as fd
+import kernels
+import numpy as np
+import collections
+import multiprocessing
+import Queue
+import hashlib
+import glob
+import json
+import os
+
+
+# per-process state of the sweep pool; set up once per worker by _initSweepWorker
+_sweepConfigs = None
+_sweepGeometries = None
+_sweepEngines = {}
+_sweepRunners = collections.OrderedDict()
+
+# runners a worker keeps between tasks; tasks arrive run by run, so a few cover the runs in flight
+_maxCachedRunners = 4
+
+
+def _initSweepWorker(configs, geometries):
+    global _sweepConfigs, _sweepGeometries
+    _sweepConfigs = configs
+    _sweepGeometries = geometries
+
+
+def _makeRunner(runIndex):
+    config = dict(_sweepConfigs[runIndex])
+    gridKey = config.pop('gridKey')
+
+    if gridKey not in _sweepEngines:
+        _sweepEngines[gridKey] = fd.MuellerKleyEngine(_sweepGeometries[gridKey])
+
+    return FargoDiagnosticsRunner(geometry=_sweepGeometries[gridKey], mkEngine=_sweepEngines[gridKey], **config)
+
+
+def _cachedRunner(runIndex):
+    runner = _sweepRunners.pop(runIndex, None)
+    if runner is None:
+        runner = _makeRunner(runIndex)
+
+    # most recently used last
+    _sweepRunners[runIndex] = runner
+    while len(_sweepRunners) > _maxCachedRunners:
+        _sweepRunners.popitem(last=False)
+
+    return runner
+
+
+def _runSweepRange(task):
+    runIndex, startIndex, endIndex = task
+
+    monitor.reset()
+    try:
+        outputs = _cachedRunner(runIndex).runBatchRange(startIndex, endIndex)
+    except Exception as e:
+        # raised again in the scheduler, which would otherwise wait for this task forever
+        return task, e, None
+    return task, outputs, monitor.stats()
+
+
+def _runSweepDiskTime(runIndex):
+    # a new runner, so that its store sees every batch committed by the scheduler
+    monitor.reset()
+    _makeRunner(runIndex).runDiskTime()
+    return monitor.stats()
+
+
+def gridKey(runDir, level=0):
+    """
+    identifies a run's grid: runs whose used_rad.dat and number of sectors (at the analyzed
+    pyramid level) agree have the same key and can share a GridGeometry
+    """
+    directory = SnapshotPyramid.levelDirectory(runDir, level)
+    dims = np.loadtxt(directory + '/dims.dat')
+    radialEdges = np.loadtxt(directory + '/used_rad.dat')
+
+    return hashlib.sha1(radialEdges.tostring()).hexdigest() + '-' + str(int(dims[7]))
+
+
+def physicalMemory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class FargoSweepRunner:
+    """
+    runs the diagnostics of many Fargo2D runs, e.g. a parameter study, over one process pool.
+    the batches of every run are queued run by run and handed to `workers` processes; a batch
+    is only started while the estimated memory of the batches in flight stays within
+    memoryBudget bytes (one batch always runs, however large).
+
+    each run gets its own output directory, <sweepDir>/<run name>/, with plots in its plots/
+    subdirectory, and keeps its own manifest, so an interrupted sweep resumes where it stopped.
+    batches of a run complete in any order, but its time series only become valid up to its first
+    batch that has not completed (see FargoDiagnosticsRunner.completeBatch). a failed batch stops
+    the sweep, and every run keeps exactly the rows before its first missing batch.
+    runs whose grids match (see gridKey) share one GridGeometry and, per process, one
+    MuellerKleyEngine. when every batch is done, the disk-vs-time reductions run on the pool
+    too, and summary() tabulates the disk time series of all runs side by side.
+
+    methods:
+    FargoSweepRunner(runDirs, sweepDir, batchSize, workers=None, memoryBudget=None, start=0, stop=None,
+                     stride=1, precision='double', level=0, diagnostics=None)
+        workers defaults to the number of CPUs and memoryBudget to half the physical memory
+
+    runBatches(resume=True)
+
+    runDiskTime()
+
+    summary(): list of dicts, one per run, of the statistics of each series in summarySeries;
+        writeSummary() also saves them to sweepSummary.json and sweepSummary.txt in sweepDir
+    """
+
+    # peak memory of a batch in a worker, in multiples of the bytes of one of its gas fields:
+    # the three fields plus the diagnostics' temporaries
+    memoryPerFieldBytes = 6
+
+    # (store dataset, column label)
+    summarySeries = [
+        ('diskEccMK', 'eccMK'),
+        ('diskEccLubow', 'eccLubow'),
+        ('totalMass', 'mass'),
+        ('diskRadius90', 'r90'),
+        ('diskRadius95', 'r95')
+    ]
+
+    def __init__(self, runDirs, sweepDir, batchSize, workers=None, memoryBudget=None, start=0, stop=None,
+                 stride=1, precision='double', level=0, diagnostics=None):
+        if sweepDir.endswith('/'):
+            sweepDir = sweepDir[:-1]
+
+        self.sweepDir = sweepDir
+        self.workers = workers or multiprocessing.cpu_count()
+        self.memoryBudget = memoryBudget or (physicalMemory() or 0) // 2 or None
+        self.itemSize = np.dtype(precision).itemsize
+
+        self.names = self._runNames(runDirs)
+        self.configs = []
+        self.geometries = {}
+        self.runners = []
+
+        engines = {}
+        for runDir, name in zip(runDirs, self.names):
+            runLevel = FargoDiagnosticsRunner.resolveLevel(runDir, level, diagnostics)
+            key = gridKey(runDir, runLevel)
+
+            outputDir = sweepDir + '/' + name
+            plotDir = outputDir + '/plots'
+            if not os.path.isdir(plotDir):
+                os.makedirs(plotDir)
+
+            config = {'inputDir': runDir, 'outputDir': outputDir, 'plotDir': plotDir, 'batchSize': batchSize,
+                      'start': start, 'stop': stop, 'stride': stride, 'precision': precision, 'level': runLevel,
+                      'diagnostics': diagnostics}
+
+            runner = FargoDiagnosticsRunner(geometry=self.geometries.get(key), mkEngine=engines.get(key), **config)
+            self.geometries.setdefault(key, runner.geometry)
+            engines.setdefault(key, runner.mkEngine)
+
+            config['gridKey'] = key
+            self.configs.append(config)
+            self.runners.append(runner)
+
+        print str(len(runDirs)) + " runs on " + str(len(self.geometries)) + " distinct grids"
+
+    @staticmethod
+    def _runNames(runDirs):
+        names = []
+        for runDir in runDirs:
+            base = os.path.basename(os.path.normpath(runDir))
+            name = base
+            suffix = 1
+            while name in names:
+                suffix += 1
+                name = base + '-' + str(suffix)
+            names.append(name)
+        return names
+
+    def _taskBytes(self, task):
+        runIndex, startIndex, endIndex = task
+        runner = self.runners[runIndex]
+        params = runner.params
+        # the fields a batch does not read take no memory
+        fieldBytes = len(runner.parser.variables) / 3.0 * \
+            (endIndex - startIndex) * params['numRadialIntervals'] * params['numThetaIntervals'] * \
+            self.itemSize
+        return int(self.memoryPerFieldBytes * fieldBytes)
+
+    def _pool(self):
+        return multiprocessing.Pool(self.workers, _initSweepWorker, (self.configs, self.geometries))
+
+    def runBatches(self, resume=True):
+        manifests = []
+        tasks = collections.deque()
+        for runIndex, runner in enumerate(self.runners):
+            manifest, pending = runner.prepareBatches(resume)
+            manifests.append(manifest)
+            tasks.extend((runIndex, startIndex, endIndex) for startIndex, endIndex in pending)
+
+        print "scheduling " + str(len(tasks)) + " batches over " + str(self.workers) + " workers" + \
+              ("" if self.memoryBudget is None else
+               " within " + str(self.memoryBudget // (1024 * 1024)) + " MB")
+
+        pool = self._pool()
+        finished = Queue.Queue()
+        running = {}
+        inFlightBytes = 0
+
+        try:
+            while tasks or running:
+                while tasks and len(running) < self.workers:
+                    taskBytes = self._taskBytes(tasks[0])
+                    if running and self.memoryBudget is not None and \
+                            inFlightBytes + taskBytes > self.memoryBudget:
+                        break
+
+                    task = tasks.popleft()
+                    running[task] = taskBytes
+                    inFlightBytes += taskBytes
+                    pool.apply_async(_runSweepRange, (task,), callback=finished.put)
+
+                task, outputs, stats = finished.get()
+                inFlightBytes -= running.pop(task)
+                runIndex, startIndex, endIndex = task
+                if isinstance(outputs, Exception):
+                    print self.names[runIndex] + ": batch " + str(startIndex) + " to " + str(endIndex) + \
+                          " failed; stopping the sweep with " + str(len(running)) + " batches in flight"
+                    raise outputs
+
+                print self.names[runIndex] + ":",
+                self.runners[runIndex].completeBatch(manifests[runIndex], startIndex, endIndex, outputs, stats)
+        except:
+            pool.terminate()
+            raise
+
+        pool.close()
+        pool.join()
+
+    def runDiskTime(self):
+        pool = self._pool()
+        for stats in pool.imap_unordered(_runSweepDiskTime, range(len(self.runners))):
+            monitor.merge(stats)
+        pool.close()
+        pool.join()
+
+    def summary(self):
+        rows = []
+        for name, runner in zip(self.names, self.runners):
+            params = runner.params
+            row = {'run': name, 'inputDir': runner.inputDir, 'level': runner.level,
+                   'grid': str(params['numRadialIntervals']) + 'x' + str(params['numThetaIntervals']),
+                   'outputs': 0}
+
+            for dataset, label in self.summarySeries:
+                series = np.asarray(runner._getDiagnostic(dataset), dtype='double')
+                row['outputs'] = max(row['outputs'], len(series))
+                if len(series) == 0:
+                    continue
+                row[label] = {'first': series[0], 'last': series[-1], 'mean': series.mean(),
+                              'std': series.std(), 'min': series.min(), 'max': series.max()}
+            rows.append(row)
+
+        return rows
+
+    def writeSummary(self):
+        rows = self.summary()
+
+        with open(self.sweepDir + '/sweepSummary.json', 'w') as f:
+            json.dump(rows, f, indent=1, sort_keys=True, separators=(',', ': '))
+
+        labels = [label for _, label in self.summarySeries]
+        header = "%-24s %9s %7s " % ('run', 'grid', 'outputs') + \
+                 " ".join("%11s %11s" % (label + ' mean', label + ' last') for label in labels)
+        lines = [header]
+        for row in rows:
+            line = "%-24s %9s %7d " % (row['run'], row['grid'], row['outputs'])
+            line += " ".join("%11.4g %11.4g" % (row[label]['mean'], row[label]['last']) if label in row
+                             else "%11s %11s" % ('-', '-') for label in labels)
+            lines.append(line)
+
+        with open(self.sweepDir + '/sweepSummary.txt', 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        print "\n".join(lines)
+
+        return rows
+
+
+def main():
+    optParser = OptionParser(usage='%prog -o SWEEPDIR [options] RUNDIR|GLOB ...')
+    optParser.add_option('-o', '--outputdirectory', action='store',
+                         type='string', dest='outputDirectory',
+                         help='directory receiving one output directory per run and the sweep summary')
+
+    optParser.add_option('-b', '--batchsize', action='store',
+                         type='int', dest='batchSize', default=100)
+
+    optParser.add_option('-w', '--workers', action='store',
+                         type='int', dest='workers',
+                         help='number of worker processes shared by all runs (default: one per CPU)')
+
+    optParser.add_option('-m', '--memory', action='store',
+                         type='int', dest='memory',
+                         help='memory budget of the batches in flight, in MB (default: half the physical memory)')
+
+    optParser.add_option('-d', '--diskonly', action='store_true',
+                         dest='diskOnly')
+
+    optParser.add_option('--start', action='store',
+                         type='int', dest='start', default=0,
+                         help='first output to analyze in every run')
+
+    optParser.add_option('--stop', action='store',
+                         type='int', dest='stop',
+                         help='analyze outputs before this one')
+
+    optParser.add_option('--stride', action='store',
+                         type='int', dest='stride', default=1,
+                         help='analyze every stride-th output')
+
+    optParser.add_option('--fresh', action='store_true', dest='fresh',
+                         help='ignore the batch manifests and recompute every batch')
+
+    optParser.add_option('--precision', action='store',
+                         type='choice', choices=['double', 'single'], dest='precision', default='double',
+                         help='precision of the gas fields in memory (see diagnosticsRunner.py)')
+
+    optParser.add_option('--level', action='store',
+                         type='string', dest='level', default='0',
+                         help='pyramid level to analyze, or auto (see diagnosticsRunner.py)')
+
+    optParser.add_option('--diagnostics', action='store',
+                         type='string', dest='diagnostics', default='all',
+                         help='comma-separated datasets to compute, or density or all (see diagnosticsRunner.py)')
+
+    optParser.add_option('--kernels', action='store',
+                         type='choice', choices=['auto'] + kernels.BACKENDS, dest='kernels',
+                         help='backend of the Mueller-Kley kernel (see kernels.py)')
+
+    optParser.add_option('--crosscheck', action='store_true', dest='crossCheck',
+                         help='repeat every accelerated kernel call with numpy and stop if they disagree')
+
+    (options, args) = optParser.parse_args()
+
+    if not options.outputDirectory:
+        optParser.error('you must specify a sweep directory with -o or --outputdirectory')
+
+    runDirs = []
+    for pattern in args:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.exists(path + '/used_rad.dat') and path not in runDirs:
+                runDirs.append(path)
+
+    if not runDirs:
+        optParser.error('no run directories (holding used_rad.dat) match ' + ' '.join(args))
+
+    try:
+        diagnostics = parseDiagnostics(options.diagnostics)
+        kernels.setBackend(options.kernels or kernels.backend(), options.crossCheck)
+        level = options.level if options.level == 'auto' else int(options.level)
+        FargoDiagnosticsRunner.resolveLevel(runDirs[0], level, diagnostics)
+    except ValueError as e:
+        optParser.error(str(e))
+
+    sweep = FargoSweepRunner(runDirs, options.outputDirectory, options.batchSize, options.workers,
+                             options.memory * 1024 * 1024 if options.memory else None,
+                             options.start, options.stop, options.stride, options.precision, level, diagnostics)
+    if not options.diskOnly:
+        sweep.runBatches(not options.fresh)
+    sweep.runDiskTime()
+    sweep.writeSummary()
+
+    printReport(monitor.writeReport(sweep.sweepDir + '/perfReport.json'))
+
+if __name__ == '__main__':
+    main()
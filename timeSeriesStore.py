@@ -0,0 +1,165 @@
+__author__ = 'cguo'
+
+import numpy as np
+import json
+import os
+
+
+class TimeSeriesStore:
+    """
+    a directory of appendable time series, one dataset per diagnostic. each dataset is a
+    preallocated .npy file whose first axis is time; index.json records the number of
+    valid rows in each. reads are memory-mapped, so opening a dataset costs no copy.
+
+    rows are addressed by output index, so separate processes can fill disjoint row ranges
+    of a preallocated dataset concurrently; only the owning process should commit the index.
+
+    methods:
+    TimeSeriesStore(directory)
+
+    create(name, rowShape=(), dtype='double', capacity=0, overwrite=False): creates the dataset, or
+        keeps an existing compatible one (growing it to at least `capacity` rows) unless overwrite
+
+    write(name, start, array): writes rows [start, start + len(array)), growing the file if needed
+
+    append(name, array): writes array after the last valid row
+
+    commit(lengths=None): saves the index; `lengths` maps datasets to their valid lengths, which are set first.
+        rows a process wrote past a gap are only valid once its owner says so here
+
+    open(name): read-only memmap of the valid rows
+
+    names(), length(name), pathTo(name), trim(name)
+    """
+
+    indexName = 'index.json'
+
+    def __init__(self, directory):
+        if directory.endswith('/'):
+            directory = directory[:-1]
+
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        try:
+            with open(self._indexPath()) as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            self.index = {}
+
+
+    def _indexPath(self):
+        return self.directory + '/' + self.indexName
+
+
+    def pathTo(self, name):
+        return self.directory + '/' + name + '.npy'
+
+
+    def names(self):
+        return sorted(name for name in self.index if os.path.exists(self.pathTo(name)))
+
+
+    def length(self, name):
+        return self.index[name]['length']
+
+
+    def _capacity(self, name):
+        return np.load(self.pathTo(name), mmap_mode='r').shape[0]
+
+
+    def _allocate(self, path, capacity, rowShape, dtype):
+        mm = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(capacity,) + tuple(rowShape))
+        del mm
+
+
+    def create(self, name, rowShape=(), dtype='double', capacity=0, overwrite=False):
+        rowShape = list(rowShape)
+        dtype = np.dtype(dtype).str
+
+        entry = self.index.get(name)
+        if not overwrite and entry is not None and entry['rowShape'] == rowShape and entry['dtype'] == dtype \
+                and os.path.exists(self.pathTo(name)):
+            if self._capacity(name) < capacity:
+                self._grow(name, capacity)
+            return
+
+        self._allocate(self.pathTo(name), capacity, rowShape, dtype)
+        self.index[name] = {'length': 0, 'rowShape': rowShape, 'dtype': dtype}
+
+
+    def _grow(self, name, capacity):
+        """
+        reallocate a dataset with room for `capacity` rows, copying its rows across
+        """
+        entry = self.index[name]
+        path = self.pathTo(name)
+        tmpPath = path + '.tmp'
+
+        self._allocate(tmpPath, capacity, entry['rowShape'], entry['dtype'])
+
+        # every row, not only the valid ones: rows past a gap may become valid with a later commit
+        old = np.load(path, mmap_mode='r')
+        new = np.load(tmpPath, mmap_mode='r+')
+        new[:len(old)] = old
+        new.flush()
+        del old, new
+
+        os.rename(tmpPath, path)
+
+
+    def write(self, name, start, array):
+        array = np.asarray(array)
+        end = start + len(array)
+
+        capacity = self._capacity(name)
+        if end > capacity:
+            self._grow(name, max(end, 2 * capacity))
+
+        mm = np.load(self.pathTo(name), mmap_mode='r+')
+        mm[start:end] = array
+        mm.flush()
+        del mm
+
+        entry = self.index[name]
+        entry['length'] = max(entry['length'], end)
+
+
+    def append(self, name, array):
+        self.write(name, self.length(name), array)
+
+
+    def commit(self, lengths=None):
+        for name, length in (lengths or {}).items():
+            self.index[name]['length'] = length
+
+        tmpPath = self._indexPath() + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True, separators=(',', ': '))
+        os.rename(tmpPath, self._indexPath())
+
+
+    def open(self, name):
+        return np.load(self.pathTo(name), mmap_mode='r')[:self.length(name)]
+
+
+    def trim(self, name):
+        """
+        shrink a dataset's file to exactly its valid rows, so it loads as a plain .npy array
+        """
+        entry = self.index[name]
+        if self._capacity(name) == entry['length']:
+            return
+
+        path = self.pathTo(name)
+        tmpPath = path + '.tmp'
+        self._allocate(tmpPath, entry['length'], entry['rowShape'], entry['dtype'])
+
+        old = np.load(path, mmap_mode='r')
+        new = np.load(tmpPath, mmap_mode='r+')
+        new[:] = old[:entry['length']]
+        new.flush()
+        del old, new
+
+        os.rename(tmpPath, path)
@@ -1,16 +1,21 @@
 
 from argparse import ArgumentParser
+from gridGeometry import GridGeometry
+from timeSeriesStore import TimeSeriesStore
+from perfMonitor import monitor, printReport
+from runningStats import RunStatistics, RunningMoments, RunningExtrema, FixedHistogram
+from planetTables import loadTable, DATE_COLUMN
+import kernels
 import numpy as np
+import glob
+import os
 
 """
 return tuple of secondary r, theta
 (r, theta)
 """
 def getTrajectory():
-    sec = np.loadtxt('bigplanet0.dat')
-    date = sec[:, -2]
-    _, ixs = np.unique(date, return_index=True)
-    sec = sec[ixs]
+    sec = loadTable('bigplanet0.dat', DATE_COLUMN)
 
     secx = sec[:, 1]
     secy = sec[:, 2]
@@ -27,14 +32,15 @@ def azimuthalStack(a, ns):
 
 
 """
-calculate torque density dT/dr(r) for specified azimuthal modes.
-parameters (dens, r_sup, r_inf, r_med, theta) have shape (nr, ns)
-`modes` has shape (n_modes)
-returns array of shape (len(modes), nr)
+numpy implementation of the 'cellTorqueDensity' kernel (see kernels): dT/dr per cell, in float64.
+the specific torque comes from the grid and the orbit, not from the gas fields, so it is evaluated
+in float64 whatever the type of dens: in float32, dist cancels to 0 in the cells next to the
+secondary and the torque there becomes NaN
 """
-def computeTorqueDensity(mb, secr, sect, dens, r_med, theta, modes, indirect_term):
-    nr, ns = r_med.shape
-    n_modes = len(modes)
+def _cellTorqueDensity(mb, secr, sect, dens, r_med, theta, indirect_term):
+    nr, ns = dens.shape
+    r_med = np.asarray(r_med, dtype='double')
+    theta = np.asarray(theta, dtype='double')
     psi = theta - sect
 
     dist = np.sqrt(np.square(r_med) + np.square(secr) - 2. * r_med * secr * np.cos(psi))
@@ -51,23 +57,36 @@ def computeTorqueDensity(mb, secr, sect, dens, r_med, theta, modes, indirect_ter
     r_dtheta = 2. * np.pi * r_med / ns
 
     # dT/dr per cell. shape (nr, ns)
-    cell_tq = r_dtheta * dens * spec_tq
+    return r_dtheta * dens * spec_tq
 
-    # tile cell_tq along z axis n_modes times
-    # resulting array has shape (n_modes, nr, ns)
-    cell_tq_mat = np.tile(cell_tq, (n_modes, 1, 1))
 
-    # promote theta to (n_modes, nr, ns)
-    theta_mat = np.tile(theta, (n_modes, 1, 1))
+"""
+calculate torque density dT/dr(r) for specified azimuthal modes.
+parameters (dens, r_med, theta) broadcast to shape (nr, ns); theta must be uniformly spaced,
+either over [0, 2 pi) or, like the Fargo thetaIntervals, over [0, 2 pi] inclusive.
+`modes` has shape (n_modes), with every mode at most half the number of distinct azimuths.
+the amplitudes |sum_theta dT/dr e^(i m theta)| come from one real FFT along the azimuth.
+per-cell terms are evaluated in float64, whatever the precision of dens.
+returns array of shape (len(modes), nr)
+"""
+def computeTorqueDensity(mb, secr, sect, dens, r_med, theta, modes, indirect_term):
+    cell_tq = kernels.run('cellTorqueDensity', _cellTorqueDensity, mb, secr, sect, dens, r_med, theta,
+                          indirect_term)
 
-    # promote modes to (n_modes, nr, ns)
-    modes_mat = np.array([np.zeros((nr, ns), dtype='float')+m for m in modes])
+    thetaRow = np.ravel(np.asarray(theta)[..., 0, :]) if np.ndim(theta) > 1 else np.ravel(theta)
+    if np.isclose(thetaRow[-1] - thetaRow[0], 2. * np.pi):
+        # the last azimuth repeats the first one: fold it in and transform the ns - 1 distinct ones
+        cell_tq[:, 0] += cell_tq[:, -1]
+        cell_tq = cell_tq[:, :-1]
 
-    # summed along ns to give shape (n_modes, nr)
-    sine = np.sum(cell_tq_mat * np.sin(modes_mat * theta_mat), axis=2)
-    cosine = np.sum(cell_tq_mat * np.cos(modes_mat * theta_mat), axis=2)
+    modes = np.asarray(modes, dtype='int')
+    if modes.max() > cell_tq.shape[1] // 2:
+        raise ValueError('modes must be at most ' + str(cell_tq.shape[1] // 2))
 
-    return np.sqrt(np.square(sine) + np.square(cosine))
+    # shape (nr, n_distinct // 2 + 1); the modulus does not depend on the transform's sign or theta offset
+    amplitudes = np.absolute(np.fft.rfft(cell_tq, axis=1))
+
+    return amplitudes[:, modes].transpose()
 
 """
 Total torque
@@ -139,27 +158,18 @@ def computeFargoTorque(mb, secr, sect, dens, r_sup, r_inf, r_med, theta):
 
 def initvars():
     nr, ns = 438, 574
-    radialEdges = np.loadtxt('used_rad.dat')
-    n = len(radialEdges)
-    r_inf = radialEdges[:n - 1]
-    r_sup = radialEdges[1:]
-
-    cube = lambda x: np.power(x, 3)
-    square = np.square
-
-    radIntervals = np.multiply((2.0 / 3.0), ((cube(r_sup) - cube(r_inf)) / (square(r_sup) - square(r_inf))))
-    thetaIntervals = np.linspace(0, 2*np.pi, 574)
-    dr = np.ediff1d(radialEdges)
-
-    r_med = azimuthalStack(radIntervals, ns)
-    r_sup = azimuthalStack(r_sup, ns)
-    r_inf = azimuthalStack(r_inf, ns)
+    geometry = GridGeometry.fromFile('used_rad.dat', ns)
 
-    theta, r = np.meshgrid(thetaIntervals, radIntervals)
+    # (nr, 1) and (1, ns) views broadcast against (nr, ns) snapshots
+    r_med = geometry.rCol
+    r_sup = geometry.rSupCol
+    r_inf = geometry.rInfCol
+    theta = geometry.thetaRow
+    dr = geometry.dr
 
     secr, sectheta = getTrajectory()
 
-    return nr, ns, secr, sectheta, r_inf, r_sup, r_med, theta, dr
+    return nr, ns, secr, sectheta, r_inf, r_sup, r_med, theta, dr, geometry
 
 def deltaL(dens, vtheta, r_med, dm):
     # avg vtheta at edge
@@ -174,153 +184,317 @@ def mass(dens, r_sup, r_inf):
     return np.sum(surf * dens)
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument('-m', '--binary-mass', nargs='?', default=0.2857, type=float)
-    parser.add_argument('-c', '--computation', nargs='?', default='all', type=str)
-    parser.add_argument('-e', '--end', nargs='?', default=-1, type=int)
-    args = parser.parse_args()
+"""
+batched versions of the torque and angular momentum diagnostics above, evaluated for a whole
+block of snapshots at once. `dens` and `vtheta` have shape (nt, nr, ns), `secr` and `sect`
+shape (nt); cell areas and coordinates come from the shared GridGeometry instead of being
+rebuilt per snapshot. each returns one value per snapshot, shape (nt).
+with float32 fields only the gas fields are float32. the torque lever arms come from the grid and
+the orbit, so they are float64 here and in computeTorqueDensity. the sums over cells are
+accumulated in float64, as in fargoDiagnostics. the largest relative errors against float64
+fields, measured on a synthetic 438 x 574 run of 15 outputs (fakeFargoRun.py), are:
+  5e-7 for the torques (fargoTq, totalTq)
+  2e-10 for angular momentum
+  2.3e-6 for tqDirect
+  9.5e-6 for the torque density modes, relative to the largest amplitude of each mode
+  2e-4 for deltaL, which differences the masses of successive snapshots
+the torques and modes are sums of signed terms that largely cancel
+"""
+def _torqueLever(secr, sect, geometry, indirect_term):
+    """
+    (y_b dx - x_b dy) / |d|^3 per cell, times (1 - |d|^3 / secr^3) with the indirect term;
+    the torque is then mb * sum(m_cell * lever). shape (nt, nr, ns), in float64 whatever the
+    precision of the gas fields, as in _cellTorqueDensity
+    """
+    xb = (secr * np.cos(sect)).reshape(-1, 1, 1)
+    yb = (secr * np.sin(sect)).reshape(-1, 1, 1)
+
+    dx = geometry.xCell - xb
+    dy = geometry.yCell - yb
+
+    dist3 = np.square(dx)
+    dist3 += np.square(dy)
+    np.power(dist3, 1.5, out=dist3)
+
+    lever = yb * dx
+    np.multiply(xb, dy, out=dx)
+    lever -= dx
+
+    np.divide(1., dist3, out=dist3)
+    if indirect_term:
+        dist3 -= (1. / np.power(secr, 3)).reshape(-1, 1, 1)
+    lever *= dist3
 
-    mb = args.binary_mass
-    compute = args.computation
-    end = args.end
+    return lever
 
-    print 'using binary mass ' + str(mb)
-    print 'computing ' + compute
+def _torqueSum(mb, secr, sect, dens, geometry, indirect_term):
+    lever = _torqueLever(secr, sect, geometry, indirect_term)
+    return mb * np.einsum('tij,tij,i->t', dens, lever, geometry.cellArea.ravel(), dtype='double')
 
-    if end == -1:
-        print 'for all orbits'
-    else:
-        print 'until orbit ' + str(end)
+def computeFargoTorqueBatch(mb, secr, sect, dens, geometry):
+    return kernels.run('torqueSum', _torqueSum, mb, secr, sect, dens, geometry, False)
 
-    nr, ns, secr, sectheta, r_inf, r_sup, r_med, theta, dr = initvars()
-
-    if compute == 'all':
-        i = 0
-        tqDensityFourier = []
-        totalTqDirect = []
-        angularMomentum = []
-        dL = []
-        m0 = mass(np.fromfile('gasdens0.dat').reshape(nr, ns), r_sup, r_inf)
-        while True:
-            if end > 0 and i > end:
-                break
+def computeTotalTqBatch(mb, secr, sect, dens, geometry):
+    return kernels.run('torqueSum', _torqueSum, mb, secr, sect, dens, geometry, True)
 
-            try:
-                dens = np.fromfile('gasdens'+str(i)+'.dat').reshape(nr, ns)
-                vtheta = np.fromfile('gasvtheta'+str(i)+'.dat').reshape(nr, ns)
-            except IOError:
-                break
+def computeLBatch(dens, vtheta, geometry):
+    return np.einsum('tij,tij,i->t', dens, vtheta, (geometry.cellArea * geometry.rCol).ravel(),
+                     dtype='double')
 
-            tqDensityFourier.append(computeTorqueDensity(mb, secr[i], sectheta[i], dens, r_med, theta, np.arange(11), True))
-            directDens = computeTorqueDensity(mb, secr[i], sectheta[i], dens, r_med, theta, [0], False)[0]
-            totalTqDirect.append(np.sum(directDens * dr))
-            angularMomentum.append(computeL(dens, vtheta, r_sup, r_inf, r_med))
-
-            m1 = mass(dens, r_sup, r_inf)
-            dL.append(deltaL(dens, vtheta, r_med, m1-m0))
-            m0 = m1
-
-            if i%100 == 0:
-                print i
-            i += 1
-
-        print 'finished at ' + str(i)
-        print 'saving'
-        np.save('parsedDiagnostics/tqFourier', tqDensityFourier)
-        np.save('parsedDiagnostics/tqDirect', totalTqDirect)
-        np.save('parsedDiagnostics/angularMomentum', angularMomentum)
-        np.save('parsedDiagnostics/deltaL', dL)
-        return
-
-    elif compute == 'fargo':
-        i = 0
-        fargoTq = []
-        while True:
-            try:
-                dens = np.fromfile('gasdens'+str(i)+'.dat').reshape(nr, ns)
-            except IOError:
-                print 'finished at ' + str(i)
-                break
+def massBatch(dens, geometry):
+    return np.einsum('tij,i->t', dens, geometry.cellArea.ravel(), dtype='double')
 
-            fargoTq.append(computeFargoTorque(mb, secr[i], sectheta[i], dens, r_sup, r_inf, r_med, theta))
+"""
+returns (dL, m) where dL has shape (nt) and m is the mass of the last snapshot, to be passed
+as m0 for the next block. m0 is the mass of the snapshot preceding the block; without it the
+first snapshot is its own predecessor
+"""
+def deltaLBatch(dens, vtheta, geometry, m0=None):
+    masses = massBatch(dens, geometry)
+    if m0 is None:
+        m0 = masses[0]
 
-            if i%100 == 0:
-                print i
-            i += 1
+    dm = np.ediff1d(masses, to_begin=masses[0] - m0)
 
-        print 'saving'
-        np.save('parsedDiagnostics/fargoTq', fargoTq)
-        return
+    # avg vtheta at edge
+    avgVtheta = (np.einsum('ts,ts->t', dens[:, -1], vtheta[:, -1], dtype='double') /
+                 dens[:, -1].sum(1, dtype='double'))
 
-    elif compute == 'deltal':
-        i = 0
-        dL = []
-        m0 = mass(np.fromfile('gasdens0.dat').reshape(nr, ns), r_sup, r_inf)
-        while True:
+    return dm * avgVtheta * geometry.radialIntervals[-1], masses[-1]
+
+
+"""
+streaming computations for main(). each factory takes (mb, grid), where grid is the dict
+built from initvars(), and returns a function (indices, block) -> output rows for the
+snapshots in `indices`. `block` maps each requested gas variable ('dens', 'vtheta') to its
+(nt, nr, ns) array
+"""
+def _tqFourier(mb, grid):
+    def compute(indices, block):
+        return np.array([computeTorqueDensity(mb, grid['secr'][i], grid['sectheta'][i], dens,
+                                              grid['r_med'], grid['theta'], np.arange(11), True)
+                         for i, dens in zip(indices, block['dens'])])
+    return compute
+
+def _tqDirect(mb, grid):
+    def compute(indices, block):
+        directDens = np.array([computeTorqueDensity(mb, grid['secr'][i], grid['sectheta'][i], dens,
+                                                    grid['r_med'], grid['theta'], [0], False)[0]
+                               for i, dens in zip(indices, block['dens'])])
+        return np.dot(directDens, grid['dr'])
+    return compute
+
+def _angularMomentum(mb, grid):
+    def compute(indices, block):
+        return computeLBatch(block['dens'], block['vtheta'], grid['geometry'])
+    return compute
+
+def _deltaL(mb, grid):
+    # mass of the last snapshot of the previous block
+    previous = {}
+
+    def compute(indices, block):
+        dL, previous['mass'] = deltaLBatch(block['dens'], block['vtheta'], grid['geometry'], previous.get('mass'))
+        return dL
+    return compute
+
+def _fargoTq(mb, grid):
+    def compute(indices, block):
+        return computeFargoTorqueBatch(mb, grid['secr'][indices], grid['sectheta'][indices], block['dens'],
+                                       grid['geometry'])
+    return compute
+
+def _totalTq(mb, grid):
+    def compute(indices, block):
+        return computeTotalTqBatch(mb, grid['secr'][indices], grid['sectheta'][indices], block['dens'],
+                                   grid['geometry'])
+    return compute
+
+
+"""
+name -> (output dataset in parsedDiagnostics/, gas variables needed, factory)
+"""
+COMPUTATIONS = {
+    'tqfourier': ('tqFourier', ['dens'], _tqFourier),
+    'tqdirect': ('tqDirect', ['dens'], _tqDirect),
+    'angularmom': ('angularMomentum', ['dens', 'vtheta'], _angularMomentum),
+    'deltal': ('deltaL', ['dens', 'vtheta'], _deltaL),
+    'fargo': ('fargoTq', ['dens'], _fargoTq),
+    'totaltq': ('totalTq', ['dens'], _totalTq)
+}
+
+COMPUTATION_GROUPS = {
+    'all': ['tqfourier', 'tqdirect', 'angularmom', 'deltal']
+}
+
+
+def parseComputations(spec):
+    """
+    turn a -c argument such as 'fargo,totaltq' or 'all' into a list of computation names
+    """
+    names = []
+    for name in spec.split(','):
+        name = name.strip().lower()
+        for expanded in COMPUTATION_GROUPS.get(name, [name]):
+            if expanded not in COMPUTATIONS:
+                raise ValueError('unknown computation ' + expanded + '; choose from ' +
+                                 ', '.join(sorted(COMPUTATIONS.keys() + COMPUTATION_GROUPS.keys())))
+            if expanded not in names:
+                names.append(expanded)
+
+    return names
+
+
+def _readBlock(variables, start, blockSize, end, nr, ns, precision='double'):
+    """
+    read up to blockSize snapshots from `start`, stopping early at `end` or at the first missing
+    file. returns (indices, block) with block mapping variable -> (nt, nr, ns) array, converted to
+    `precision` as it is read
+    """
+    if end > 0:
+        blockSize = min(blockSize, end + 1 - start)
+
+    block = dict((var, np.empty((blockSize, nr, ns), dtype=precision)) for var in variables)
+
+    nt = 0
+    with monitor.stage('read') as stage:
+        while nt < blockSize:
+            i = start + nt
             try:
-                dens = np.fromfile('gasdens'+str(i)+'.dat').reshape(nr, ns)
-                vtheta = np.fromfile('gasvtheta'+str(i)+'.dat').reshape(nr, ns)
+                for var in variables:
+                    block[var][nt] = np.fromfile('gas' + var + str(i) + '.dat').reshape(nr, ns)
             except IOError:
-                print 'finished at ' + str(i)
                 break
+            nt += 1
+
+        stage.numBytes = nt * len(variables) * nr * ns * np.dtype('double').itemsize
+        stage.numSnapshots = nt
+
+    return np.arange(start, start + nt), dict((var, arr[:nt]) for var, arr in block.items())
+
+
+def runComputations(names, mb, grid, end=-1, outputDir='parsedDiagnostics', blockSize=50, precision='double'):
+    """
+    single streaming pass over the snapshots in the working directory: blocks of blockSize
+    snapshots are read once, with only the gas variables needed by any of `names`, handed to
+    every computation, and the resulting rows are appended to their datasets in `outputDir`. the
+    store's index is committed after every block, so an interrupted run keeps every block it finished.
+    with precision='single' the blocks are held as float32 (see computeTorqueDensity and the
+    batched functions).
+    each computation is timed as its own perfMonitor stage, and the report is written to
+    perfReport.json in `outputDir`.
+    the mean, variance and extrema of every computation's rows over the run, and a histogram of
+    the torque density mode amplitudes, are accumulated as the blocks stream past (see
+    runningStats) and checkpointed with every block to runStatistics.npz in `outputDir`. the
+    entries of computations not run this time are kept, like their datasets
+    """
+    nr, ns = grid['nr'], grid['ns']
+
+    variables = []
+    for name in names:
+        for var in COMPUTATIONS[name][1]:
+            if var not in variables:
+                variables.append(var)
+
+    computations = [(COMPUTATIONS[name][0], COMPUTATIONS[name][2](mb, grid)) for name in names]
+
+    statistics = RunStatistics()
+    for output, _ in computations:
+        statistics.add(output, RunningMoments()).add(output, RunningExtrema())
+        if output == 'tqFourier':
+            # amplitudes span many decades; 5 log bins per decade, the rest counted as under/overflow
+            statistics.add(output, FixedHistogram(1e-14, 1e0, 70, log=True))
+
+    statisticsPath = outputDir + '/runStatistics.npz'
+    if os.path.exists(statisticsPath):
+        outputs = set(output for output, _ in computations)
+        previous = RunStatistics.load(statisticsPath)
+        for name in previous.names():
+            quantity = name.rsplit('.', 1)[0]
+            if quantity not in outputs:
+                statistics.add(quantity, previous[name])
+
+    store = TimeSeriesStore(outputDir)
+    capacity = len(glob.glob('gasdens*.dat'))
+
+    i = 0
+    while True:
+        indices, block = _readBlock(variables, i, blockSize, end, nr, ns, precision)
+        if len(indices) == 0:
+            break
+
+        for output, compute in computations:
+            with monitor.stage(output, numSnapshots=len(indices)):
+                rows = np.asarray(compute(indices, block))
+                statistics.update(output, rows)
+
+            with monitor.stage('store'):
+                if i == 0:
+                    store.create(output, rows.shape[1:], capacity=capacity, overwrite=True)
+                store.write(output, i, rows)
+
+        with monitor.stage('store'):
+            store.commit()
+            statistics.save(statisticsPath)
+        i += len(indices)
+        print i
+
+        if len(indices) < blockSize:
+            break
+
+    print 'finished at ' + str(i)
+    print 'saving'
+    store.commit()
+    for output, _ in computations:
+        if output in store.index:
+            store.trim(output)
+
+    printReport(monitor.writeReport(outputDir + '/perfReport.json'))
 
-            m1 = mass(dens, r_sup, r_inf)
-            dL.append(deltaL(dens, vtheta, r_med, m1-m0))
-            m0 = m1
 
-            if i%100 == 0:
-                print i
-            i += 1
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--binary-mass', nargs='?', default=0.2857, type=float)
+    parser.add_argument('-c', '--computation', nargs='?', default='all', type=str,
+                        help='comma-separated list from ' + ', '.join(sorted(COMPUTATIONS.keys())) +
+                             ', or all')
+    parser.add_argument('-e', '--end', nargs='?', default=-1, type=int)
+    parser.add_argument('-b', '--block-size', nargs='?', default=50, type=int,
+                        help='number of snapshots read and processed together')
+    parser.add_argument('-p', '--precision', default='double', choices=['double', 'single'],
+                        help='precision of the gas fields; sums are accumulated in double either way')
+    parser.add_argument('--kernels', choices=['auto'] + kernels.BACKENDS,
+                        help='backend of the torque kernels; auto picks the fastest one installed. '
+                             'default: $FARGO_KERNELS, else auto')
+    parser.add_argument('--crosscheck', action='store_true',
+                        help='repeat every accelerated kernel with numpy and stop if they disagree')
+    args = parser.parse_args()
 
-        print 'saving'
-        np.save('parsedDiagnostics/deltaL', dL)
-        return
+    mb = args.binary_mass
+    end = args.end
 
-    elif compute == 'angularmom':
-        i = 0
-        angularMomentum = []
-        while True:
-            if end > 0 and i > end:
-                break
+    try:
+        names = parseComputations(args.computation)
+        kernels.setBackend(args.kernels or kernels.backend(), args.crosscheck)
+    except ValueError as e:
+        parser.error(str(e))
 
-            try:
-                dens = np.fromfile('gasdens'+str(i)+'.dat').reshape(nr, ns)
-                vtheta = np.fromfile('gasvtheta'+str(i)+'.dat').reshape(nr, ns)
-            except IOError:
-                break
-            angularMomentum.append(computeL(dens, vtheta, r_sup, r_inf, r_med))
-
-            if i%100 == 0:
-                print i
-            i += 1
-
-        print 'finished at ' + str(i)
-        print 'saving'
-        np.save('parsedDiagnostics/angularMomentum', angularMomentum)
-        return
-
-    elif compute == 'totaltq':
-        i = 0
-        tq = []
-        while True:
-            if end > 0 and i > end:
-                break
+    print 'using binary mass ' + str(mb)
+    print 'computing ' + ', '.join(names)
 
-            try:
-                dens = np.fromfile('gasdens'+str(i)+'.dat').reshape(nr, ns)
-            except IOError:
-                break
-            tq.append(computeTotalTq(mb, secr[i], sectheta[i], dens, r_sup, r_inf, r_med, theta))
+    if end == -1:
+        print 'for all orbits'
+    else:
+        print 'until orbit ' + str(end)
 
-            if i%100 == 0:
-                print i
-            i += 1
+    nr, ns, secr, sectheta, r_inf, r_sup, r_med, theta, dr, geometry = initvars()
+    grid = {
+        'nr': nr, 'ns': ns, 'secr': secr, 'sectheta': sectheta,
+        'r_inf': r_inf, 'r_sup': r_sup, 'r_med': r_med, 'theta': theta, 'dr': dr,
+        'geometry': geometry
+    }
 
-        print 'finished at ' + str(i)
-        print 'saving'
-        np.save('parsedDiagnostics/totalTq', tq)
-        return
+    runComputations(names, mb, grid, end, blockSize=args.block_size, precision=args.precision)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()